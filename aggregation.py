@@ -0,0 +1,185 @@
+import torch
+
+
+class StateLayout(object):
+    """
+    Key/offset layout of a state_dict packed into flat buffers, computed once per model.
+
+    Entries are grouped by dtype, so a model becomes one contiguous tensor per dtype
+    (normally a float32 buffer for the weights and an int64 buffer for BatchNorm's
+    num_batches_tracked), following the offset scheme of utils.get_trainable_parameters.
+    """
+    def __init__(self, state_dict):
+        self.keys = list(state_dict.keys())
+        self.shapes = {}
+        self.entries = {}
+        self.sizes = {}
+        for key, value in state_dict.items():
+            entries = self.entries.setdefault(value.dtype, [])
+            offset = self.sizes.get(value.dtype, 0)
+            numel = value.numel()
+            entries.append((key, offset, offset + numel))
+            self.shapes[key] = value.shape
+            self.sizes[value.dtype] = offset + numel
+
+    def zeros(self, device="cpu", as_float=False):
+        """
+        Zero flat buffers. With as_float=True integer groups are floating point, which is
+        what sums and deltas of integer buffers are.
+        """
+        flat = {}
+        for dtype, size in self.sizes.items():
+            if as_float and not dtype.is_floating_point:
+                flat[dtype] = torch.zeros(size, dtype=torch.get_default_dtype(), device=device)
+            else:
+                flat[dtype] = torch.zeros(size, dtype=dtype, device=device)
+        return flat
+
+    def views(self, flat, dtype):
+        return [flat[dtype][start:end].view(self.shapes[key]) for key, start, end in self.entries[dtype]]
+
+    def tensors(self, state_dict, dtype):
+        return [state_dict[key] for key, _, _ in self.entries[dtype]]
+
+    def flatten(self, state_dict, as_float=False):
+        """
+        Pack state_dict into {dtype: flat tensor}.
+        """
+        flat = self.zeros(device=state_dict[self.keys[0]].device, as_float=as_float)
+        for dtype in self.entries:
+            torch._foreach_copy_(self.views(flat, dtype), self.tensors(state_dict, dtype))
+        return flat
+
+    def unflatten(self, flat, state_dict=None):
+        """
+        Unpack flat buffers. Values are cast to the layout dtypes, so floating point results
+        for integer buffers are truncated the same way .type(torch.LongTensor) does.
+        If state_dict is given its tensors are overwritten in place.
+        """
+        out = {}
+        for dtype in self.entries:
+            buf = flat[dtype] if flat[dtype].dtype == dtype else flat[dtype].to(dtype)
+            if state_dict is None:
+                out.update(zip([key for key, _, _ in self.entries[dtype]], self.views({dtype: buf}, dtype)))
+            else:
+                torch._foreach_copy_(self.tensors(state_dict, dtype), self.views({dtype: buf}, dtype))
+        if state_dict is not None:
+            return state_dict
+        return {key: out[key] for key in self.keys}
+
+
+def accumulate(layout, total, state_dict, weight=1.0):
+    """
+    total += weight * state_dict on flat buffers, one fused axpy per dtype group.
+    total=None starts a new sum; integer groups are accumulated in floating point.
+    """
+    if total is None:
+        total = layout.zeros(device=state_dict[layout.keys[0]].device, as_float=True)
+    for dtype in layout.entries:
+        tensors = layout.tensors(state_dict, dtype)
+        if tensors[0].dtype != total[dtype].dtype:
+            tensors = [tensor.to(total[dtype].dtype) for tensor in tensors]
+        torch._foreach_add_(layout.views(total, dtype), tensors, alpha=weight)
+    return total
+
+
+def weighted_sum(layout, state_dicts, weights):
+    """
+    sum_i weights[i] * state_dicts[i] as flat buffers.
+    """
+    total = None
+    for state_dict, weight in zip(state_dicts, weights):
+        total = accumulate(layout, total, state_dict, weight)
+    return total
+
+
+def apply_update(layout, state_dict, update, alpha=1.0):
+    """
+    state_dict += alpha * update in place. For integer buffers alpha * update is truncated
+    before it is added, as the per-key .type(torch.LongTensor) updates did.
+    """
+    for dtype in layout.entries:
+        tensors = layout.tensors(state_dict, dtype)
+        views = layout.views(update, dtype)
+        if dtype.is_floating_point:
+            torch._foreach_add_(tensors, views, alpha=alpha)
+        else:
+            for tensor, view in zip(tensors, views):
+                tensor += (alpha * view).to(dtype)
+    return state_dict
+
+
+def fedavg_aggregate(layout, state_dicts, weights):
+    """
+    Weighted average of the clients' state_dicts, returned as a new state_dict.
+    """
+    return layout.unflatten(weighted_sum(layout, state_dicts, weights))
+
+
+def fednova_aggregate(layout, global_state, d_list, weights, coeff):
+    """
+    FedNova server step: global -= coeff * sum_i weights[i] * d_i, updating global_state in place.
+    """
+    return apply_update(layout, global_state, weighted_sum(layout, d_list, weights), alpha=-coeff)
+
+
+def scaffold_update_c(layout, c_global_state, total_delta, n_parties):
+    """
+    SCAFFOLD control variate update: c_global += total_delta / n_parties, in place, where
+    total_delta is the accumulate()d sum of the clients' c deltas.
+    """
+    update = {dtype: buf / n_parties for dtype, buf in total_delta.items()}
+    return apply_update(layout, c_global_state, update)
+
+
+class ScaffoldCorrection(object):
+    """
+    SCAFFOLD local-step correction w -= lr * (c_global - c_local). The control variates are
+    fixed during local training, so the correction is computed once per client and applied
+    in place to the net's state after every optimizer step.
+    """
+    def __init__(self, net, c_global, c_local, lr):
+        c_global_para = c_global.state_dict()
+        c_local_para = c_local.state_dict()
+        self.float_tensors, self.float_corrections = [], []
+        self.int_tensors, self.int_corrections = [], []
+        for key, tensor in net.state_dict().items():
+            correction = lr * (c_global_para[key] - c_local_para[key])
+            if tensor.is_floating_point():
+                self.float_tensors.append(tensor)
+                self.float_corrections.append(correction.to(tensor.dtype))
+            else:
+                self.int_tensors.append(tensor)
+                self.int_corrections.append(correction)
+
+    @torch.no_grad()
+    def step(self):
+        torch._foreach_sub_(self.float_tensors, self.float_corrections)
+        # integer buffers (num_batches_tracked) are updated in floating point and truncated
+        for tensor, correction in zip(self.int_tensors, self.int_corrections):
+            tensor.copy_(tensor - correction)
+
+
+class ProximalTerm(object):
+    """
+    FedProx penalty mu/2 * ||w - w_global||^2 against a flat snapshot of the global weights
+    taken once per round. step() adds its gradient mu * (w - w_global) to the parameter
+    gradients with multi-tensor ops and returns the penalty value for the logged loss.
+    """
+    def __init__(self, net, global_net, mu):
+        self.mu = mu
+        self.params = list(net.parameters())
+        snapshot = torch.cat([param.detach().reshape(-1) for param in global_net.parameters()])
+        self.global_weights = [weights.view_as(param) for weights, param in
+                               zip(snapshot.split([param.numel() for param in self.params]), self.params)]
+
+    @torch.no_grad()
+    def step(self):
+        diffs = torch._foreach_sub(self.params, self.global_weights)
+        grads, grad_diffs = [], []
+        for param, diff in zip(self.params, diffs):
+            if param.grad is not None:
+                grads.append(param.grad)
+                grad_diffs.append(diff)
+        torch._foreach_add_(grads, grad_diffs, alpha=self.mu)
+        return (self.mu / 2) * torch.stack(torch._foreach_norm(diffs)).pow(2).sum()
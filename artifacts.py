@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+
+from utils import get_dataloader
+
+ARTIFACT_VERSION = 1
+
+
+def artifact_paths(name):
+    return name + '.pt', name + '.json'
+
+
+def save_artifact(name, net_id, net, global_model, args, dataidxs, noise_level=0, params=None, metrics=None):
+    """
+    Write a trained client as <name>.pt (the client's and the global model's state_dicts) and
+    <name>.json (architecture, run arguments, the client's partition indices and metrics).
+    Unlike the dill pickles this stores no datasets or DataLoaders; load_artifact rebuilds them.
+    """
+    weights_path, manifest_path = artifact_paths(name)
+    torch.save({'net': net.state_dict(), 'global_model': global_model.state_dict()}, weights_path)
+    manifest = {
+        'version': ARTIFACT_VERSION,
+        'net_id': int(net_id),
+        'model': args.model,
+        'dataset': args.dataset,
+        'args': vars(args),
+        'dataidxs': np.asarray(dataidxs, dtype=np.int64).tolist(),
+        'noise_level': noise_level,
+        'params': params or {},
+        'metrics': metrics or {},
+    }
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+
+def load_weights(path):
+    """
+    Memory-map the saved tensors where torch supports it instead of reading them into memory.
+    """
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    except TypeError:
+        # torch versions without mmap/weights_only
+        return torch.load(path, map_location='cpu')
+
+
+def build_net(init_nets, args, state_dict):
+    """
+    Build the architecture and load state_dict into it. Where torch supports it the net is built
+    on the meta device and takes over the (memory-mapped) tensors, skipping the random weight
+    initialisation; building the net never advances the caller's RNG, as loading a pickle did not.
+    """
+    try:
+        with torch.device('meta'):
+            nets, _, _ = init_nets(args.net_config, 0, 1, args)
+        net = nets[0]
+        net.load_state_dict(state_dict, assign=True)
+        if not any(tensor.is_meta for tensor in net.state_dict().values()):
+            return net
+    except (AttributeError, TypeError):
+        # torch versions without device contexts or load_state_dict(assign=True)
+        pass
+    with torch.random.fork_rng(devices=[]):
+        nets, _, _ = init_nets(args.net_config, 0, 1, args)
+    net = nets[0]
+    net.load_state_dict(state_dict)
+    return net
+
+
+def load_artifact(name, init_nets, dataloaders=True, datadir=None):
+    """
+    Load an artifact written by save_artifact. init_nets builds the architecture from the saved
+    arguments (scaffold_train.init_nets). Returns the same tuple as the old pickles:
+    (net_id, net, global_model, train_dl_local, test_dl_global, current_params, lr, optimizer, batch_size),
+    with the DataLoaders rebuilt from the saved partition indices, or None if dataloaders=False.
+    """
+    weights_path, manifest_path = artifact_paths(name)
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    args = argparse.Namespace(**manifest['args'])
+    if datadir is not None:
+        args.datadir = datadir
+
+    weights = load_weights(weights_path)
+    net, global_model = build_net(init_nets, args, weights['net']), build_net(init_nets, args, weights['global_model'])
+
+    train_dl_local, test_dl_global = None, None
+    if dataloaders:
+        dataidxs = np.asarray(manifest['dataidxs'], dtype=np.int64)
+        if args.noise_type == 'space':
+            train_dl_local, _, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, manifest['noise_level'], manifest['net_id'], args.n_parties-1)
+        else:
+            train_dl_local, _, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, manifest['noise_level'])
+        _, test_dl_global, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32)
+
+    params = manifest['params']
+    return (manifest['net_id'], net, global_model, train_dl_local, test_dl_global,
+            params.get('current_params'), params.get('lr'), params.get('optimizer'), params.get('batch_size'))
+
+
+def artifact_exists(name):
+    return all(os.path.exists(path) for path in artifact_paths(name))
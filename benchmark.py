@@ -0,0 +1,509 @@
+import argparse
+import contextlib
+import io
+import logging
+import os
+import random
+import tempfile
+import time
+
+import dill as pickle
+import numpy as np
+import scipy.sparse
+import torch
+
+import bestresponse
+import datasets
+import experiments
+import generalized_bestresponse
+import scaffold_train
+from artifacts import save_artifact, load_artifact
+from datasets import save_generated
+from aggregation import StateLayout, ScaffoldCorrection, fedavg_aggregate
+from model import FcNet, SimpleCNN
+from stacked import StackedClients
+from resnetcifar import ResNet18_cifar10
+from utils import partition_data, get_dataloader, compute_accuracy, compute_accuracy_multi
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench', type=str, default='round_time', choices=['round_time', 'aggregation', 'scaffold_step', 'eval_multi', 'stacked', 'artifacts', 'sparse', 'mnist_items', 'best_response', 'profits', 'surplus', 'market_share'],
+                        help='which benchmark to run')
+    parser.add_argument('--model', type=str, default='simple-cnn', help='neural network used in training')
+    parser.add_argument('--dataset', type=str, default='cifar10', help='dataset used for training')
+    parser.add_argument('--partition', type=str, default='noniid-labeldir', help='the data partitioning strategy')
+    parser.add_argument('--n_parties', type=int, default=100, help='number of workers in a distributed cluster')
+    parser.add_argument('--sample', type=float, default=0.1, help='Sample ratio for each communication round')
+    parser.add_argument('--rounds', type=int, default=3, help='number of timed communication rounds')
+    parser.add_argument('--epochs', type=int, default=1, help='number of local epochs')
+    parser.add_argument('--batch-size', type=int, default=64, help='input batch size for training')
+    parser.add_argument('--datadir', type=str, default='./data/', help='Data directory')
+    parser.add_argument('--logdir', type=str, default='./logs/', help='Log directory path')
+    parser.add_argument('--device', type=str, default='cpu', help='The device to run the program')
+    parser.add_argument('--init_seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed repetitions')
+    parser.add_argument('--n_samples', type=int, default=4000, help='number of synthetic training samples')
+    args = parser.parse_args()
+    return args
+
+
+def experiment_args(args, **overrides):
+    """
+    Build the experiments.py argument namespace for a benchmark run.
+    """
+    argv = ['--model=%s' % args.model, '--dataset=%s' % args.dataset, '--partition=%s' % args.partition,
+            '--n_parties=%d' % args.n_parties, '--sample=%f' % args.sample, '--epochs=%d' % args.epochs,
+            '--batch-size=%d' % args.batch_size, '--datadir=%s' % args.datadir, '--logdir=%s' % args.logdir,
+            '--device=%s' % args.device, '--init_seed=%d' % args.init_seed]
+    exp_args = experiments.get_args(argv)
+    for key, value in overrides.items():
+        setattr(exp_args, key, value)
+    experiments.args = exp_args
+    return exp_args
+
+
+def seed_everything(seed):
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    random.seed(seed)
+
+
+def bench_round_time(args):
+    """
+    Seconds per FedAvg communication round with the process-wide dataset cache disabled and enabled.
+    """
+    exp_args = experiment_args(args)
+    device = torch.device(args.device)
+    seed_everything(args.init_seed)
+    _, _, _, _, net_dataidx_map, _ = partition_data(
+        exp_args.dataset, exp_args.datadir, exp_args.logdir, exp_args.partition, exp_args.n_parties, beta=exp_args.beta)
+    _, test_dl_global, _, _ = get_dataloader(exp_args.dataset, exp_args.datadir, exp_args.batch_size, 32)
+
+    results = {}
+    for cache_enabled in (False, True):
+        datasets.DATASET_CACHE_ENABLED = cache_enabled
+        datasets.clear_dataset_cache()
+        seed_everything(args.init_seed)
+        nets, _, _ = experiments.init_nets(exp_args.net_config, exp_args.dropout_p, exp_args.n_parties, exp_args)
+        global_models, _, _ = experiments.init_nets(exp_args.net_config, 0, 1, exp_args)
+        global_model = global_models[0]
+
+        round_times = []
+        for round in range(args.rounds):
+            start = time.perf_counter()
+            arr = np.arange(exp_args.n_parties)
+            np.random.shuffle(arr)
+            selected = arr[:int(exp_args.n_parties * exp_args.sample)]
+
+            global_para = global_model.state_dict()
+            for idx in selected:
+                nets[idx].load_state_dict(global_para)
+            experiments.local_train_net(nets, selected, exp_args, net_dataidx_map, test_dl=test_dl_global, device=device)
+
+            total_data_points = sum([len(net_dataidx_map[r]) for r in selected])
+            fed_avg_freqs = [len(net_dataidx_map[r]) / total_data_points for r in selected]
+            for idx in range(len(selected)):
+                net_para = nets[selected[idx]].cpu().state_dict()
+                for key in net_para:
+                    if idx == 0:
+                        global_para[key] = net_para[key] * fed_avg_freqs[idx]
+                    else:
+                        global_para[key] += net_para[key] * fed_avg_freqs[idx]
+            global_model.load_state_dict(global_para)
+            round_times.append(time.perf_counter() - start)
+
+        results[cache_enabled] = round_times
+        print('dataset cache %s: %.3f s/round (%s)' % ('on' if cache_enabled else 'off', np.mean(round_times),
+                                                      ', '.join('%.3f' % t for t in round_times)))
+    datasets.DATASET_CACHE_ENABLED = True
+    print('speedup: %.2fx' % (np.mean(results[False]) / np.mean(results[True])))
+    return results
+
+
+def bench_aggregation(args):
+    """
+    FedAvg server step for ResNet-18 at 10 and 100 parties: per-key state_dict loop vs flat buffers.
+    A handful of distinct client models is reused to fill the parties.
+    """
+    seed_everything(args.init_seed)
+    global_model = ResNet18_cifar10(num_classes=10)
+    clients = [ResNet18_cifar10(num_classes=10).state_dict() for _ in range(4)]
+    layout = StateLayout(global_model.state_dict())
+
+    for n_parties in (10, 100):
+        state_dicts = [clients[i % len(clients)] for i in range(n_parties)]
+        freqs = [1.0 / n_parties] * n_parties
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            global_para = global_model.state_dict()
+            for idx in range(n_parties):
+                net_para = state_dicts[idx]
+                if idx == 0:
+                    for key in net_para:
+                        global_para[key] = net_para[key] * freqs[idx]
+                else:
+                    for key in net_para:
+                        global_para[key] += net_para[key] * freqs[idx]
+            global_model.load_state_dict(global_para)
+        per_key = (time.perf_counter() - start) / args.repeat
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            global_model.load_state_dict(fedavg_aggregate(layout, state_dicts, freqs))
+        flat = (time.perf_counter() - start) / args.repeat
+
+        print('resnet18 %3d parties: per-key %.3f s, flat %.3f s (%.2fx)' % (n_parties, per_key, flat, per_key / flat))
+
+
+def bench_scaffold_step(args):
+    """
+    Time of one SCAFFOLD local step: per-batch state_dict reload vs in-place ScaffoldCorrection,
+    next to a plain SGD step.
+    """
+    seed_everything(args.init_seed)
+    lr = 0.01
+    x = torch.randn(args.batch_size, 3, 32, 32)
+    target = torch.randint(0, 10, (args.batch_size,))
+    criterion = torch.nn.CrossEntropyLoss()
+    for name, make_net in (('simple-cnn', lambda: SimpleCNN(input_dim=(16 * 5 * 5), hidden_dims=[120, 84], output_dim=10)),
+                           ('resnet18', lambda: ResNet18_cifar10(num_classes=10))):
+        net, c_global, c_local = make_net(), make_net(), make_net()
+        c_global_para = c_global.state_dict()
+        c_local_para = c_local.state_dict()
+        optimizer = torch.optim.SGD(net.parameters(), lr=lr, momentum=0.9)
+
+        def sgd_step():
+            optimizer.zero_grad()
+            criterion(net(x), target).backward()
+            optimizer.step()
+
+        def reload_step():
+            sgd_step()
+            net_para = net.state_dict()
+            for key in net_para:
+                net_para[key] = net_para[key] - lr * (c_global_para[key] - c_local_para[key])
+            net.load_state_dict(net_para)
+
+        correction = ScaffoldCorrection(net, c_global, c_local, lr)
+
+        def correction_step():
+            sgd_step()
+            correction.step()
+
+        times = {}
+        for label, step in (('sgd', sgd_step), ('reload', reload_step), ('in-place', correction_step)):
+            step()
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                step()
+            times[label] = (time.perf_counter() - start) / args.repeat
+        print('%s: sgd %.4f s/step, state_dict reload %.4f s/step, in-place correction %.4f s/step'
+              % (name, times['sgd'], times['reload'], times['in-place']))
+
+
+def bench_eval_multi(args):
+    """
+    Test-set evaluation of a three-client coalition: one compute_accuracy pass per model vs a
+    single compute_accuracy_multi pass.
+    """
+    exp_args = experiment_args(args)
+    seed_everything(args.init_seed)
+    _, test_dl_global, _, _ = get_dataloader(exp_args.dataset, exp_args.datadir, exp_args.batch_size, 32)
+    nets, _, _ = experiments.init_nets(exp_args.net_config, exp_args.dropout_p, 3, exp_args)
+    models = list(nets.values())
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        separate = [compute_accuracy(model, test_dl_global, get_confusion_matrix=True) for model in models]
+    separate_time = (time.perf_counter() - start) / args.repeat
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        shared = compute_accuracy_multi(models, test_dl_global, get_confusion_matrix=True)
+    shared_time = (time.perf_counter() - start) / args.repeat
+
+    assert [acc for acc, _ in separate] == [acc for acc, _ in shared]
+    print('3 models on %s test set: separate %.3f s, single pass %.3f s (%.2fx)'
+          % (exp_args.dataset, separate_time, shared_time, separate_time / shared_time))
+
+
+def bench_stacked(args):
+    """
+    Local training of the selected clients on random batches: one torch.optim.SGD loop per client
+    vs StackedClients, for an a9a-sized MLP and simple-cnn.
+    """
+    seed_everything(args.init_seed)
+    device = torch.device(args.device)
+    n_clients = max(1, int(args.n_parties * args.sample))
+    n_steps = 20
+    for name, make_net, shape, n_classes in (('mlp', lambda: FcNet(123, [32, 16, 8], 2), (123,), 2),
+                                             ('simple-cnn', lambda: SimpleCNN(input_dim=(16 * 5 * 5), hidden_dims=[120, 84], output_dim=10), (3, 32, 32), 10)):
+        nets = [make_net().to(device) for _ in range(n_clients)]
+        batches = [[(torch.randn((args.batch_size,) + shape), torch.randint(0, n_classes, (args.batch_size,)))
+                    for _ in range(n_steps)] for _ in range(n_clients)]
+
+        start = time.perf_counter()
+        for net, client_batches in zip(nets, batches):
+            optimizer = torch.optim.SGD(net.parameters(), lr=0.01, momentum=0.9, weight_decay=1e-5)
+            for x, target in client_batches:
+                x, target = x.to(device), target.to(device)
+                optimizer.zero_grad()
+                loss = torch.nn.functional.cross_entropy(net(x), target)
+                loss.backward()
+                optimizer.step()
+                loss.item()
+        loop = time.perf_counter() - start
+
+        start = time.perf_counter()
+        trainer = StackedClients(nets, 0.01, momentum=0.9, weight_decay=1e-5, device=device)
+        trainer.train(batches, 1)
+        trainer.write_back()
+        stacked = time.perf_counter() - start
+
+        print('%s, %d clients x %d steps: per-client loop %.3f s, stacked %.3f s (%.2fx)'
+              % (name, n_clients, n_steps, loop, stacked, loop / stacked))
+
+
+def bench_artifacts(args):
+    """
+    Size and load time of a scaffold_train.py client: dill pickle with the DataLoaders vs the
+    state_dict + JSON manifest artifact (weights alone, and with the DataLoaders rebuilt).
+    """
+    seed_everything(args.init_seed)
+    st_args = scaffold_train.get_args(['--model=%s' % args.model, '--dataset=%s' % args.dataset, '--n_parties=3',
+                                       '--batch-size=%d' % args.batch_size, '--datadir=%s' % args.datadir, '--abc=AB'])
+    scaffold_train.args = st_args
+    nets, _, _ = scaffold_train.init_nets(st_args.net_config, 0, 2, st_args)
+    net, global_model = nets[0], nets[1]
+    _, _, train_ds, _ = get_dataloader(st_args.dataset, st_args.datadir, st_args.batch_size, 32)
+    dataidxs = np.random.permutation(len(train_ds))[:3000]
+    train_dl_local, _, _, _ = get_dataloader(st_args.dataset, st_args.datadir, st_args.batch_size, 32, dataidxs, 0)
+    _, test_dl_global, _, _ = get_dataloader(st_args.dataset, st_args.datadir, st_args.batch_size, 32)
+    params = {'current_params': 'lr=0.001, optimizer=sgd, batch_size=64', 'lr': 0.001, 'optimizer': 'sgd', 'batch_size': 64}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pickle_path = os.path.join(tmpdir, 'client.pickle')
+        with open(pickle_path, 'wb') as handle:
+            pickle.dump((0, net, global_model, train_dl_local, test_dl_global, params['current_params'], params['lr'],
+                         params['optimizer'], params['batch_size']), handle, protocol=pickle.HIGHEST_PROTOCOL)
+        name = os.path.join(tmpdir, 'client')
+        save_artifact(name, 0, net, global_model, st_args, dataidxs, 0, params=params)
+
+        pickle_size = os.path.getsize(pickle_path)
+        artifact_size = os.path.getsize(name + '.pt') + os.path.getsize(name + '.json')
+
+        datasets.clear_dataset_cache()
+        timings = {}
+        for label, load in (('pickle', lambda: pickle.load(open(pickle_path, 'rb'))),
+                            ('artifact weights', lambda: load_artifact(name, scaffold_train.init_nets, dataloaders=False)),
+                            ('artifact + dataloaders', lambda: load_artifact(name, scaffold_train.init_nets))):
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                load()
+            timings[label] = (time.perf_counter() - start) / args.repeat
+
+    print('%s/%s client: pickle %.1f MB, artifact %.1f MB' % (args.model, args.dataset, pickle_size / 2**20, artifact_size / 2**20))
+    print('load: ' + ', '.join('%s %.3f s' % (label, t) for label, t in timings.items()))
+
+
+def bench_sparse(args):
+    """
+    rcv1-shaped data (47236 features, about 74 nonzeros per row): memory of the training set and
+    samples/s of FcNet training epochs through get_dataloader, dense .npy (Generated) vs CSR
+    (SparseGenerated + sparse_collate + torch.sparse.mm).
+    """
+    seed_everything(args.init_seed)
+    n_features = 47236
+    X = scipy.sparse.random(args.n_samples, n_features, density=74 / n_features, format='csr',
+                            dtype=np.float32, random_state=args.init_seed)
+    y = np.random.randint(0, 2, args.n_samples).astype(np.int32)
+    dense_bytes = X.shape[0] * X.shape[1] * 4
+    sparse_bytes = X.data.nbytes + X.indices.nbytes + X.indptr.nbytes
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        save_generated(tmpdir, 'generated', X.toarray(), y, X[:1].toarray(), y[:1])
+        save_generated(tmpdir, 'rcv1', X, y, X[:1], y[:1])
+
+        timings = {}
+        for label, dataset in (('dense', 'generated'), ('sparse', 'rcv1')):
+            train_dl, _, _, _ = get_dataloader(dataset, tmpdir, args.batch_size, 32)
+            seed_everything(args.init_seed)
+            net = FcNet(n_features, [32, 16, 8], 2).to(args.device)
+            optimizer = torch.optim.SGD(net.parameters(), lr=0.01, momentum=0.9)
+            start = time.perf_counter()
+            for epoch in range(args.epochs):
+                for x, target in train_dl:
+                    x, target = x.to(args.device), target.to(args.device).long()
+                    optimizer.zero_grad()
+                    loss = torch.nn.functional.cross_entropy(net(x), target)
+                    loss.backward()
+                    optimizer.step()
+            timings[label] = time.perf_counter() - start
+
+    n = args.n_samples * args.epochs
+    print('rcv1-shaped, %d samples: dense %.1f MB, CSR %.1f MB' % (args.n_samples, dense_bytes / 2**20, sparse_bytes / 2**20))
+    print('training: dense %.0f samples/s, sparse %.0f samples/s (%.2fx)'
+          % (n / timings['dense'], n / timings['sparse'], timings['dense'] / timings['sparse']))
+
+
+def write_mnist_raw(root, n_train, n_test, seed=0):
+    """
+    Write random images and labels in the MNIST idx format under <root>/MNIST/raw.
+    """
+    rng = np.random.RandomState(seed)
+    raw = os.path.join(root, 'MNIST', 'raw')
+    os.makedirs(raw, exist_ok=True)
+    for prefix, n in (('train', n_train), ('t10k', n_test)):
+        images = rng.randint(0, 256, (n, 28, 28)).astype(np.uint8)
+        labels = rng.randint(0, 10, n).astype(np.uint8)
+        with open(os.path.join(raw, '%s-images-idx3-ubyte' % prefix), 'wb') as f:
+            f.write(np.array([2051, n, 28, 28], dtype='>i4').tobytes() + images.tobytes())
+        with open(os.path.join(raw, '%s-labels-idx1-ubyte' % prefix), 'wb') as f:
+            f.write(np.array([2049, n], dtype='>i4').tobytes() + labels.tobytes())
+
+
+def bench_mnist_items(args):
+    """
+    samples/s of one pass over an MNIST-shaped training set through get_dataloader: per-item PIL
+    round-trip + transforms.ToTensor (batch_augment=False) vs the pre-converted as_tensor split
+    indexed batch by batch (batch_augment=True), with and without noise.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_mnist_raw(tmpdir, args.n_samples, 1000, args.init_seed)
+        timings = {}
+        for noise_level in (0, 0.1):
+            for label, batch_augment in (('PIL', False), ('tensor', True)):
+                datasets.clear_dataset_cache()
+                train_dl, _, _, _ = get_dataloader('mnist', tmpdir, args.batch_size, 32, noise_level=noise_level,
+                                                   batch_augment=batch_augment)
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    for x, target in train_dl:
+                        pass
+                timings[label, noise_level] = (time.perf_counter() - start) / args.repeat
+
+    for noise_level in (0, 0.1):
+        pil, tensor = timings['PIL', noise_level], timings['tensor', noise_level]
+        print('mnist, %d samples, noise %g: PIL %.0f samples/s, tensor %.0f samples/s (%.1fx)'
+              % (args.n_samples, noise_level, args.n_samples / pil, args.n_samples / tensor, pil / tensor))
+
+
+def bench_best_response(args):
+    """
+    Wall time of bestresponse.createTableFromCoalition for the custom-quantity coalition with the
+    uniform customer distribution: exact best responses vs the original basinhopping search.
+    """
+    coalition = bestresponse.quantity_coalition
+    coalition = bestresponse.Coalition(coalition.C_size, *[[x for _, x in row] for row in (coalition.ABC, coalition.AB_C, coalition.AC_B, coalition.A_BC, coalition.A_B_C_)], coalition.beta)
+    timings, tables = {}, {}
+    for solver in ('exact', 'basinhopping'):
+        bestresponse.BEST_RESPONSE_SOLVER = solver
+        seed_everything(args.init_seed)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            tables[solver] = bestresponse.createTableFromCoalition(coalition, 10000, is_uniform=True, is_squared=True)
+        timings[solver] = time.perf_counter() - start
+    bestresponse.BEST_RESPONSE_SOLVER = 'exact'
+
+    diff = np.abs(tables['exact'][3] - tables['basinhopping'][3]).max() / np.abs(tables['basinhopping'][3]).max()
+    print('createTableFromCoalition (uniform): exact %.3f s, basinhopping %.1f s (%.0fx), max relative price difference %.1e'
+          % (timings['exact'], timings['basinhopping'], timings['basinhopping'] / timings['exact'], diff))
+
+
+def bench_profits(args):
+    """
+    Price profiles per second evaluated by the scalar W0/W1/W2 (through get_profit) vs
+    bestresponse.vectorized_W, for the uniform and the truncated-normal customer distribution.
+    Also checks that both agree on score triples with ties, where sigma is inf or nan.
+    """
+    rng = np.random.RandomState(args.init_seed)
+    profiles = rng.uniform(0, 3000, (args.n_samples, 3))
+    scores = [0.7091, 0.6116, 0.5004]
+    n_scalar = min(args.n_samples, 500)
+    tied_scores = np.array([[0.7, 0.7, 0.5], [0.7, 0.5, 0.5], [0.7, 0.5, 0.7], [0.6, 0.6, 0.6]])
+    tied_profiles = np.concatenate([rng.uniform(-1000, 3000, (50, 3)), [[1000.] * 3, [1000., 1000., 2000.], [2000., 1000., 1000.], [1000., 2000., 1000.]]])
+    for label, is_uniform, mean, sd in (('uniform', True, 1, 1), ('truncnorm', False, 5000, 234)):
+        start = time.perf_counter()
+        for p in profiles[:n_scalar]:
+            [bestresponse.get_profit(i, list(p), scores, mean, sd, 10000, is_uniform, True) for i in range(3)]
+        scalar = n_scalar / (time.perf_counter() - start)
+        start = time.perf_counter()
+        bestresponse.vectorized_W(profiles, scores, mean, sd, 10000, is_uniform, True)
+        vectorized = args.n_samples / (time.perf_counter() - start)
+        print('%s: scalar %.0f profiles/s, vectorized %.0f profiles/s (%.0fx)' % (label, scalar, vectorized, vectorized / scalar))
+        for A in tied_scores:
+            with np.errstate(invalid='ignore'):
+                expected = [[bestresponse.get_profit(i, p, A, mean, sd, 10000, is_uniform, True) for i in range(3)] for p in tied_profiles]
+            assert np.allclose(bestresponse.vectorized_W(tied_profiles, A, mean, sd, 10000, is_uniform, True), expected, equal_nan=True)
+
+
+def bench_surplus(args):
+    """
+    Customer surpluses per second from calculate_customer_surplus (three quad integrals per profile)
+    vs the closed-form bestresponse.vectorized_customer_surplus.
+    """
+    rng = np.random.RandomState(args.init_seed)
+    scores = np.sort(rng.uniform(0.5, 0.95, (args.n_samples, 3)))[:, ::-1]
+    prices = rng.uniform(0, 1500, (args.n_samples, 3))
+    n_scalar = min(args.n_samples, 200)
+    for label, is_uniform, mean, sd in (('uniform', True, 1, 1), ('truncnorm', False, 5000, 500)):
+        start = time.perf_counter()
+        for A, p in zip(scores[:n_scalar], prices[:n_scalar]):
+            bestresponse.calculate_customer_surplus(list(A), list(p), mean, sd, 10000, is_uniform, True)
+        scalar = n_scalar / (time.perf_counter() - start)
+        start = time.perf_counter()
+        bestresponse.vectorized_customer_surplus(scores, prices, mean, sd, 10000, is_uniform, True)
+        vectorized = args.n_samples / (time.perf_counter() - start)
+        print('%s: quad %.0f surpluses/s, closed form %.0f surpluses/s (%.0fx)' % (label, scalar, vectorized, vectorized / scalar))
+
+
+def bench_market_share(args):
+    """
+    generalized_bestresponse.market_share for the 10-firm run_competition setup: profiles per second
+    one call per profile (as inside basinhopping) vs one batched call.
+    """
+    rng = np.random.RandomState(args.init_seed)
+    scores = np.array([85.07, 85.18, 85.07, 85.41, 85.17, 85.71, 85.53, 85.08, 85.53, 85.68]) / 100
+    prices = rng.uniform(0, 5e7, (args.n_samples, len(scores)))
+    start = time.perf_counter()
+    for p in prices:
+        generalized_bestresponse.market_share(p, scores, 1e9, 5e8, 5e7, True)
+    single = args.n_samples / (time.perf_counter() - start)
+    start = time.perf_counter()
+    generalized_bestresponse.market_share(prices, scores, 1e9, 5e8, 5e7, True)
+    batched = args.n_samples / (time.perf_counter() - start)
+    print('market_share, %d firms: %.0f profiles/s one at a time, %.0f profiles/s batched' % (len(scores), single, batched))
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.bench == 'round_time':
+        bench_round_time(args)
+    elif args.bench == 'aggregation':
+        bench_aggregation(args)
+    elif args.bench == 'scaffold_step':
+        bench_scaffold_step(args)
+    elif args.bench == 'eval_multi':
+        bench_eval_multi(args)
+    elif args.bench == 'stacked':
+        bench_stacked(args)
+    elif args.bench == 'artifacts':
+        bench_artifacts(args)
+    elif args.bench == 'sparse':
+        bench_sparse(args)
+    elif args.bench == 'mnist_items':
+        bench_mnist_items(args)
+    elif args.bench == 'best_response':
+        bench_best_response(args)
+    elif args.bench == 'profits':
+        bench_profits(args)
+    elif args.bench == 'surplus':
+        bench_surplus(args)
+    elif args.bench == 'market_share':
+        bench_market_share(args)
@@ -6,9 +6,11 @@ import warnings
 # from jax import grad
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.optimize import minimize
-from scipy.stats import truncnorm
+from scipy.optimize import minimize, minimize_scalar
+from scipy.stats import truncnorm, norm
 from scipy.integrate import quad
+from scipy.interpolate import CubicSpline
+from numpy.polynomial import hermite_e
 from scipy.optimize import basinhopping
 
 import dill as pickle
@@ -32,6 +34,7 @@ class Coalition:
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--calculate', default=False, required=False, action='store_true', help='whether to calculate price values instead of loading from pickle')
+    parser.add_argument('--solver', type=str, default='exact', choices=['exact', 'basinhopping'], help='how each firm\'s best-response price is computed')
     args = parser.parse_args()
     return args
 
@@ -71,6 +74,74 @@ def sigma(m, n, p, A, is_squared):
         return (p[m] - p[n]) / (A[m] - A[n])
     
 
+# With TRUNCNORM_TABLE_SIZE > 0 the truncated normal H reads its CDF from a TruncnormTable of that
+# many points ('cubic' or 'linear' TRUNCNORM_INTERPOLATION) instead of calling scipy.
+TRUNCNORM_TABLE_SIZE = 0
+TRUNCNORM_INTERPOLATION = 'cubic'
+_truncnorm_cache = {}
+
+def _max_abs_pdf_derivative(k, a, b):
+    """
+    max over z in [a, b] of |He_k(z) phi(z)|, the k-th derivative of the standard normal pdf up to sign.
+    Its extrema are the roots of He_(k+1).
+    """
+    z = np.concatenate([[a, b], hermite_e.hermeroots([0] * (k + 1) + [1])])
+    z = z[(z >= a) & (z <= b)]
+    return np.abs(hermite_e.hermeval(z, [0] * k + [1]) * norm.pdf(z)).max()
+
+class TruncnormTable:
+    """
+    CDF and PDF of a frozen truncated normal on [0, theta_max], tabulated at n points and interpolated
+    linearly or with a cubic spline clamped to the exact end derivatives. With h = theta_max / (n - 1)
+    the absolute CDF error is at most cdf_error_bound = h^2/8 max|F^(2)| (linear) or 5/384 h^4 max|F^(4)|
+    (clamped cubic); pdf_error_bound is the same bound one derivative higher.
+    """
+    def __init__(self, dist, theta_max, n=4097, kind='cubic'):
+        self.kind = kind
+        self.theta = np.linspace(0, theta_max, n)
+        h = theta_max / (n - 1)
+        a, b, mean, sd = dist.a, dist.b, dist.kwds['loc'], dist.kwds['scale']
+        mass = norm.cdf(b) - norm.cdf(a)
+        # max |k-th derivative of the pdf| in theta
+        derivative = lambda k: _max_abs_pdf_derivative(k, a, b) / (sd ** (k + 1) * mass)
+        cdf, pdf = dist.cdf(self.theta), dist.pdf(self.theta)
+        if kind == 'linear':
+            self.cdf_table, self.pdf_table = cdf, pdf
+            self.cdf_error_bound = h ** 2 / 8 * derivative(1)
+            self.pdf_error_bound = h ** 2 / 8 * derivative(2)
+        elif kind == 'cubic':
+            self.cdf_spline = CubicSpline(self.theta, cdf, bc_type=((1, pdf[0]), (1, pdf[-1])))
+            slope = -(self.theta - mean) / sd ** 2 * pdf
+            self.pdf_spline = CubicSpline(self.theta, pdf, bc_type=((1, slope[0]), (1, slope[-1])))
+            self.cdf_error_bound = 5 / 384 * h ** 4 * derivative(3)
+            self.pdf_error_bound = 5 / 384 * h ** 4 * derivative(4)
+        else:
+            raise ValueError('unknown interpolation %s' % kind)
+
+    def cdf(self, theta):
+        if self.kind == 'linear':
+            return np.interp(theta, self.theta, self.cdf_table)
+        return self.cdf_spline(np.clip(theta, self.theta[0], self.theta[-1]))[()]
+
+    def pdf(self, theta):
+        if self.kind == 'linear':
+            return np.interp(theta, self.theta, self.pdf_table)
+        return self.pdf_spline(np.clip(theta, self.theta[0], self.theta[-1]))[()]
+
+def truncnorm_dist(mean, sd, theta_max):
+    """
+    The truncated normal customer distribution on [0, theta_max], frozen once per (mean, sd, theta_max)
+    and wrapped in a TruncnormTable if TRUNCNORM_TABLE_SIZE is set.
+    """
+    key = (mean, sd, theta_max, TRUNCNORM_TABLE_SIZE, TRUNCNORM_INTERPOLATION)
+    if key not in _truncnorm_cache:
+        a, b = (0 - mean) / sd, (theta_max - mean) / sd
+        dist = truncnorm(a, b, loc=mean, scale=sd)
+        if TRUNCNORM_TABLE_SIZE:
+            dist = TruncnormTable(dist, theta_max, TRUNCNORM_TABLE_SIZE, TRUNCNORM_INTERPOLATION)
+        _truncnorm_cache[key] = dist
+    return _truncnorm_cache[key]
+
 def H(theta, mean, sd, theta_max, is_uniform=True):
     if theta < 0:
         return 0
@@ -79,8 +150,19 @@ def H(theta, mean, sd, theta_max, is_uniform=True):
     if is_uniform:
         return theta / theta_max
     else:
-        a, b = (0 - mean) / sd, (theta_max - mean) / sd
-        return truncnorm.cdf(theta, a, b, loc=mean, scale=sd)# / (truncnorm.cdf(theta_max, a, b, loc=mean, scale=sd) - truncnorm.cdf(0, a, b, loc=mean, scale=sd))
+        return truncnorm_dist(mean, sd, theta_max).cdf(theta)# / (truncnorm.cdf(theta_max, a, b, loc=mean, scale=sd) - truncnorm.cdf(0, a, b, loc=mean, scale=sd))
+def vectorized_H(theta, mean, sd, theta_max, is_uniform=True):
+    """
+    H applied elementwise to an array of theta.
+    """
+    theta = np.asarray(theta, dtype=float)
+    inside = np.clip(theta, 0, theta_max)
+    if is_uniform:
+        cdf = inside / theta_max
+    else:
+        cdf = truncnorm_dist(mean, sd, theta_max).cdf(inside)
+    return np.where(theta < 0, 0., np.where(theta >= theta_max, 1., cdf))
+
 # # create an array of theta values to plot
 # theta_max = 10000
 # mean = 5000
@@ -124,6 +206,28 @@ def W2(p, A, mean, sd, theta_max, is_uniform, is_squared):
     except ZeroDivisionError:
         return 0
 
+def vectorized_W(p, A, mean, sd, theta_max, is_uniform, is_squared):
+    """
+    W0, W1 and W2 for many price profiles at once: p has shape (..., 3) and A broadcasts against it
+    (one score triple or one per profile). Returns the (..., 3) profits, equal to the scalar versions
+    called with numpy floats: a sigma over two equal scores is inf or nan, and max/min keep their
+    first argument when the comparison with nan fails.
+    """
+    p = np.asarray(p, dtype=float)
+    A = np.asarray(A, dtype=float)
+    q = np.square(A) if is_squared else A
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma_0_1, sigma_0_2, sigma_1_2 = ((p[..., m] - p[..., n]) / (q[..., m] - q[..., n]) for m, n in ((0, 1), (0, 2), (1, 2)))
+        sigma_1 = sigma_0_1 - sigma_1_2
+
+    def h(theta):
+        return vectorized_H(theta, mean, sd, theta_max, is_uniform)
+
+    # max(a, b) and min(a, b) as python evaluates them, b only if the comparison holds
+    return np.stack([p[..., 0] * (1 - h(np.where(sigma_0_2 > sigma_0_1, sigma_0_2, sigma_0_1))),
+                     p[..., 1] * h(sigma_1),
+                     p[..., 2] * h(np.where(sigma_0_2 < sigma_1_2, sigma_0_2, sigma_1_2))], axis=-1)
+
 def W0Obj(p, A, mean, sd, theta_max, is_uniform, is_squared):
     return -W0(p, A, mean, sd, theta_max, is_uniform, is_squared)
 
@@ -133,7 +237,81 @@ def W1Obj(p, A, mean, sd, theta_max, is_uniform, is_squared):
 def W2Obj(p, A, mean, sd, theta_max, is_uniform, is_squared):
     return -W2(p, A, mean, sd, theta_max, is_uniform, is_squared)
 
+# 'exact': best_response below, 'basinhopping': the original global search
+BEST_RESPONSE_SOLVER = 'exact'
+# grid points per piece when H is the truncated normal, before the bounded refinement
+BEST_RESPONSE_GRID = 64
+
+def own_price_lines(i, p, A, is_squared):
+    """
+    The sigma terms in firm i's profit as lines (a, b), a + b * x in its own price x, and how W combines
+    them ('max', 'min' or a single line), or None if two scores are equal and sigma is undefined.
+    """
+    q = np.square(A) if is_squared else np.asarray(A, dtype=float)
+    d01, d02, d12 = q[0] - q[1], q[0] - q[2], q[1] - q[2]
+    if d01 == 0 or d02 == 0 or d12 == 0:
+        return None
+    if i == 0:
+        return 'max', [(-p[1] / d01, 1 / d01), (-p[2] / d02, 1 / d02)]
+    elif i == 1:
+        # sigma_0_1 - sigma_1_2
+        return 'single', [(p[0] / d01 + p[2] / d12, -1 / d01 - 1 / d12)]
+    else:
+        return 'min', [(p[1] / d12, -1 / d12), (p[0] / d02, -1 / d02)]
+
+def best_response(i, p, A, mean, sd, theta_max, is_uniform, is_squared):
+    """
+    Firm i's profit-maximizing price given the other prices, or None where sigma is undefined.
+    Between the breakpoints (the sigma lines crossing or reaching 0 and theta_max) the profit is
+    x * H(a + b * x): for the uniform H a quadratic with a closed-form vertex, for the truncated
+    normal maximized on a grid and refined with a bounded scalar search.
+    """
+    lines = own_price_lines(i, p, A, is_squared)
+    if lines is None or any(b == 0 for _, b in lines[1]):
+        return None
+    kind, lines = lines
+
+    def profit(x):
+        price = list(p)
+        price[i] = x
+        return get_profit(i, price, A, mean, sd, theta_max, is_uniform, is_squared)
+
+    breakpoints = {(level - a) / b for a, b in lines for level in (0, theta_max)}
+    if kind != 'single':
+        (a1, b1), (a2, b2) = lines
+        if b1 != b2:
+            breakpoints.add((a2 - a1) / (b1 - b2))
+    breakpoints = sorted(breakpoints)
+    candidates = list(breakpoints)
+    for lo, hi in zip(breakpoints[:-1], breakpoints[1:]):
+        mid = (lo + hi) / 2
+        values = [a + b * mid for a, b in lines]
+        a, b = lines[int(np.argmax(values) if kind == 'max' else np.argmin(values))]
+        if not 0 < a + b * mid < theta_max:
+            # H is constant on the piece and the profit linear in x
+            continue
+        if is_uniform:
+            # W0 = x * (1 - (a + b x) / theta_max), W1 and W2 = x * (a + b x) / theta_max
+            vertex = (theta_max - a) / (2 * b) if i == 0 else -a / (2 * b)
+            if lo < vertex < hi:
+                candidates.append(vertex)
+        else:
+            grid = np.linspace(lo, hi, BEST_RESPONSE_GRID)
+            profiles = np.tile(np.asarray(p, dtype=float), (len(grid), 1))
+            profiles[:, i] = grid
+            k = int(np.argmax(vectorized_W(profiles, A, mean, sd, theta_max, is_uniform, is_squared)[:, i]))
+            res = minimize_scalar(lambda x: -profit(x), bounds=(grid[max(k - 1, 0)], grid[min(k + 1, len(grid) - 1)]), method='bounded')
+            candidates += [grid[k], res.x]
+    profits = [profit(x) for x in candidates]
+    return candidates[int(np.nanargmax(profits))]
+
 def update_price(i, p, A, mean, sd, theta_max, is_uniform, is_squared):
+    if BEST_RESPONSE_SOLVER == 'exact':
+        x = best_response(int(i), p, A, mean, sd, theta_max, is_uniform, is_squared)
+        if x is not None:
+            price = list(p)
+            price[int(i)] = float(x)
+            return price
     if i == 0:
         res = basinhopping(lambda x: W0Obj([x, p[1], p[2]], A, mean, sd, theta_max, is_uniform, is_squared), x0=p[0], minimizer_kwargs={'method': 'BFGS'})
         return [res.x[0], p[1], p[2]]
@@ -165,6 +343,47 @@ def calculate_customer_surplus(A, p, mean, sd, theta_max, is_uniform, is_squared
     CP = integral1 + integral2 + integral3
     return CP
 
+def _surplus_antiderivative(A, p, theta, mean, sd, theta_max, is_uniform):
+    """
+    G(theta) with G(0) = 0 and G' = (theta * A - p) * H(theta), in closed form: 0 below 0, the
+    integral against the uniform or truncated normal CDF up to theta_max and H = 1 above it.
+    """
+    inside = np.clip(theta, 0, theta_max)
+    above = np.maximum(theta, theta_max)
+
+    def K(x):
+        if is_uniform:
+            return (A * x ** 3 / 3 - p * x ** 2 / 2) / theta_max
+        # H = (Phi(z) - Phi(alpha)) / mass with z = (x - mean) / sd, integrated by parts
+        alpha, beta = (0 - mean) / sd, (theta_max - mean) / sd
+        mass = norm.cdf(beta) - norm.cdf(alpha)
+        z = (x - mean) / sd
+        cdf, pdf = norm.cdf(z), norm.pdf(z)
+        integral_cdf = sd * (z * cdf + pdf)
+        integral_theta_cdf = mean * integral_cdf + sd ** 2 * ((z ** 2 - 1) * cdf + z * pdf) / 2
+        return (A * integral_theta_cdf - p * integral_cdf - norm.cdf(alpha) * (A * x ** 2 / 2 - p * x)) / mass
+
+    return K(inside) - K(0.) + A * (above ** 2 - theta_max ** 2) / 2 - p * (above - theta_max)
+
+def vectorized_customer_surplus(A, p, mean, sd, theta_max, is_uniform, is_squared=False):
+    """
+    calculate_customer_surplus for many (A, p) profiles at once: A and p of shape (..., 3), returns
+    the (...) surpluses. The integrals are evaluated in closed form instead of with quad.
+    """
+    A = np.asarray(A, dtype=float)
+    p = np.asarray(p, dtype=float)
+    q = np.square(A) if is_squared else A
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma_0_1 = (p[..., 0] - p[..., 1]) / (q[..., 0] - q[..., 1])
+        sigma_1_2 = (p[..., 1] - p[..., 2]) / (q[..., 1] - q[..., 2])
+
+    def integral(k, a, b):
+        G = lambda theta: _surplus_antiderivative(A[..., k], p[..., k], theta, mean, sd, theta_max, is_uniform)
+        return G(b) - G(a)
+
+    return (integral(0, sigma_0_1, theta_max) + integral(1, sigma_1_2, sigma_0_1)
+            + integral(2, np.zeros_like(sigma_1_2), sigma_1_2))
+
 text_name = ['ABC', 'AB_C', 'AC_B', 'A_BC', 'A_B_C_']
 quantity_arrays = [ABC_Quantity, AB_C_Quantity, AC_B_Quantity, A_BC_Quantity, A_B_C_Quantity]
 dirichlet_arrays = [ABC_Dirichlet, AB_C_Dirichlet, AC_B_Dirichlet, A_BC_Dirichlet, A_B_C_Dirichlet]
@@ -576,16 +795,9 @@ def check_individual_stability(final_table):
     return result_dict
 
 def get_customer_surpluses_and_welfare(accuracies_as_table, reordered_prices, reordered_profits, mean, sd, theta_max, is_uniform, is_squared):
-    customer_surpluses = []
-    social_welfares = []
-
-    for i in range(len(accuracies_as_table)):
-        surplus = calculate_customer_surplus(accuracies_as_table[i], reordered_prices[i], mean, sd, theta_max, is_uniform, is_squared)
-        social_welfare = reordered_profits[i][0] + reordered_profits[i][1] + reordered_profits[i][2] + surplus
-        customer_surpluses += [surplus]
-        social_welfares += [social_welfare]
-    
-    return customer_surpluses, social_welfares
+    customer_surpluses = vectorized_customer_surplus(np.array(accuracies_as_table, dtype=float), reordered_prices, mean, sd, theta_max, is_uniform, is_squared)
+    social_welfares = np.sum(reordered_profits, axis=1) + customer_surpluses
+    return customer_surpluses.tolist(), social_welfares.tolist()
 
 def createTableFromCoalition(coalition, theta_max, is_uniform=True, is_squared=True, mean=1, sd=1):
     np.set_printoptions(precision=8, suppress=True)
@@ -686,6 +898,7 @@ def model_degredation_best_response(A_max):
 
 if __name__ == '__main__':
     args = get_args()
+    BEST_RESPONSE_SOLVER = args.solver
     custom_array = []
     non_iid_array = []
     is_uniform = True
@@ -0,0 +1,149 @@
+import os
+import random
+import tempfile
+
+import numpy as np
+import torch
+
+MANIFEST = 'checkpoint.pt'
+
+
+def get_rng_states():
+    cuda_states = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    return random.getstate(), np.random.get_state(), torch.get_rng_state(), cuda_states
+
+
+def set_rng_states(states):
+    py_state, np_state, torch_state, cuda_states = states
+    random.setstate(py_state)
+    np.random.set_state(np_state)
+    torch.set_rng_state(torch_state)
+    if cuda_states is not None:
+        torch.cuda.set_rng_state_all(cuda_states)
+
+
+def atomic_save(obj, path):
+    """
+    torch.save to a temporary file in the same directory and rename it over path, so path always
+    holds either the old or the new complete file.
+    """
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_file(path):
+    try:
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:
+        # torch versions without the weights_only argument
+        return torch.load(path, map_location='cpu')
+
+
+class GradState(object):
+    """
+    state_dict view of a module's accumulated parameter gradients.
+    """
+    def __init__(self, net):
+        self.net = net
+
+    def state_dict(self):
+        return {name: param.grad for name, param in self.net.named_parameters() if param.grad is not None}
+
+    def load_state_dict(self, state_dict):
+        for name, param in self.net.named_parameters():
+            param.grad = state_dict[name].to(param.device).clone() if name in state_dict else None
+
+
+class Checkpointer(object):
+    """
+    Round-level checkpoints of a training run in one directory.
+
+    A checkpoint is a manifest (checkpoint.pt) holding the round index, the RNG states, the
+    run's metric history and the state_dicts of the single models/optimizers, plus one file per
+    client model of each group (nets, c_nets, ...). Client files carry the round they were written
+    in and are only rewritten for clients marked dirty since the last checkpoint; the manifest
+    lists the current file of every client. The manifest is replaced atomically after all new
+    client files are on disk, and files it no longer references are deleted afterwards, so a
+    crash at any point leaves the previous checkpoint intact.
+    """
+    def __init__(self, directory, every=1, run_key=None):
+        self.directory = directory
+        self.every = every
+        self.run_key = run_key
+        self.files = {}
+        self.dirty = {}
+        if self.every > 0:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def should_save(self, round, n_rounds):
+        return self.every > 0 and ((round + 1) % self.every == 0 or round == n_rounds - 1)
+
+    def mark_dirty(self, group, ids):
+        self.dirty.setdefault(group, set()).update(int(i) for i in ids)
+
+    def save(self, round, singles=None, groups=None, state=None):
+        """
+        Checkpoint the state after `round`. singles maps names to objects with a state_dict()
+        (global model, c_global, optimizers), groups maps group names to {id: model}.
+        """
+        groups = groups or {}
+        for group, members in groups.items():
+            files = self.files.setdefault(group, {})
+            dirty = self.dirty.get(group, set())
+            for member_id, member in members.items():
+                if member_id in files and member_id not in dirty:
+                    continue
+                filename = '%s-%d-r%d.pt' % (group, member_id, round)
+                atomic_save(member.state_dict(), os.path.join(self.directory, filename))
+                files[member_id] = filename
+        manifest = {
+            'round': round,
+            'run_key': self.run_key,
+            'rng_states': get_rng_states(),
+            'singles': {name: obj.state_dict() for name, obj in (singles or {}).items()},
+            'files': {group: dict(files) for group, files in self.files.items() if group in groups},
+            'state': state or {},
+        }
+        atomic_save(manifest, os.path.join(self.directory, MANIFEST))
+        self.dirty = {}
+        self._remove_stale_files(manifest['files'])
+
+    def _remove_stale_files(self, files):
+        referenced = {filename for group_files in files.values() for filename in group_files.values()}
+        for filename in os.listdir(self.directory):
+            stale = filename.endswith('.pt') and filename != MANIFEST and filename not in referenced
+            if stale or filename.startswith('.tmp-'):
+                os.remove(os.path.join(self.directory, filename))
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.directory, MANIFEST))
+
+    def restore(self, singles=None, groups=None):
+        """
+        Load the last checkpoint into the given objects and restore the RNG states. Returns the
+        first round still to run and the saved state dict.
+        """
+        manifest = load_file(os.path.join(self.directory, MANIFEST))
+        if manifest['run_key'] != self.run_key:
+            raise ValueError('checkpoint in %s belongs to run %s, not %s'
+                             % (self.directory, manifest['run_key'], self.run_key))
+        for name, obj in (singles or {}).items():
+            obj.load_state_dict(manifest['singles'][name])
+        for group, members in (groups or {}).items():
+            for member_id, member in members.items():
+                filename = manifest['files'][group][member_id]
+                member.load_state_dict(load_file(os.path.join(self.directory, filename)))
+        self.files = {group: dict(files) for group, files in manifest['files'].items()}
+        self.dirty = {}
+        set_rng_states(manifest['rng_states'])
+        return manifest['round'] + 1, manifest['state']
@@ -2,6 +2,7 @@ import torch.utils.data as data
 import torch
 from PIL import Image
 import numpy as np
+import scipy.sparse
 from torchvision.datasets import MNIST, CIFAR10, SVHN, FashionMNIST, CIFAR100, ImageFolder, DatasetFolder, utils
 from torchvision.datasets.vision import VisionDataset
 from torchvision.datasets.utils import download_file_from_google_drive, check_integrity
@@ -12,9 +13,12 @@ import PIL
 import tarfile
 import torchvision
 
+import atexit
+import multiprocessing
 import os
 import os.path
 import logging
+from multiprocessing import shared_memory
 import torchvision.datasets.utils as utils
 
 logging.basicConfig()
@@ -23,6 +27,131 @@ logger.setLevel(logging.INFO)
 
 IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff', '.webp')
 
+# Process-wide registry of full (un-truncated) splits keyed by (dataset, root, train).
+# The truncated datasets below only keep an index array into these, so building a
+# client DataLoader does not re-read the dataset from disk.
+DATASET_CACHE_ENABLED = True
+_base_dataset_cache = {}
+
+# With SHARED_MEMORY_ENABLED the cached splits are moved into multiprocessing.shared_memory
+# blocks owned by this process; worker processes attach to them through the handles from
+# shared_base_handles() instead of loading (or unpickling) their own copy.
+SHARED_MEMORY_ENABLED = False
+_shared_blocks = []
+_shared_handles = {}
+
+def get_base_dataset(name, root, train, load_fn):
+    """
+    Return the cached (data, target, ...) tuple of a full split, calling load_fn() on first use.
+    """
+    if not DATASET_CACHE_ENABLED:
+        return load_fn()
+    key = (name, os.path.abspath(root), train)
+    if key not in _base_dataset_cache:
+        if key in _shared_handles:
+            _base_dataset_cache[key] = tuple(_attach_shared(handle) for handle in _shared_handles[key])
+        elif SHARED_MEMORY_ENABLED:
+            base = tuple(load_fn())
+            _shared_handles[key] = tuple(_share(value) for value in base)
+            _base_dataset_cache[key] = tuple(_attach_shared(handle) for handle in _shared_handles[key])
+        else:
+            _base_dataset_cache[key] = load_fn()
+    return _base_dataset_cache[key]
+
+def clear_dataset_cache():
+    _base_dataset_cache.clear()
+
+def _share(value):
+    """
+    Copy a numpy array or CPU tensor into a new shared memory block and return its handle; other
+    values are passed through by value.
+    """
+    is_tensor = isinstance(value, torch.Tensor)
+    array = value.numpy() if is_tensor else value
+    if not isinstance(array, np.ndarray) or array.dtype == object:
+        return ('value', value)
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    _shared_blocks.append(block)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return ('tensor' if is_tensor else 'array', block.name, array.shape, array.dtype.str)
+
+def _attach_shared(handle):
+    if handle[0] == 'value':
+        return handle[1]
+    kind, name, shape, dtype = handle
+    block = shared_memory.SharedMemory(name=name)
+    _shared_blocks.append(block)
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    return torch.from_numpy(array) if kind == 'tensor' else array
+
+def shared_base_handles():
+    return dict(_shared_handles)
+
+def attach_shared_bases(handles):
+    """
+    Called in a worker process with the parent's shared_base_handles(): later get_base_dataset calls
+    for these splits map the parent's blocks.
+    """
+    _shared_handles.update(handles)
+
+@atexit.register
+def _release_shared_blocks():
+    _base_dataset_cache.clear()
+    owned = {handle[1] for handles in _shared_handles.values() for handle in handles if handle[0] != 'value'}
+    for block in _shared_blocks:
+        try:
+            block.close()
+        except BufferError:
+            # a view into the block is still alive; the mapping goes away with the process
+            pass
+    if multiprocessing.parent_process() is None:
+        for block in _shared_blocks:
+            if block.name in owned:
+                try:
+                    block.unlink()
+                except FileNotFoundError:
+                    pass
+    _shared_blocks.clear()
+
+
+class BaseIndexDataset(data.Dataset):
+    """
+    A client's dataset: the full split from get_base_dataset held in the fields named by base_fields
+    plus the client's dataidxs, read through in __getitem__. Pickling (e.g. to a worker process)
+    leaves the base arrays out and the unpickled dataset fetches them again with
+    __build_truncated_dataset__, from the worker's cache or the shared memory blocks.
+    """
+    base_fields = ('data', 'target')
+    as_tensor = False
+
+    def __build_truncated_dataset__(self):
+        raise NotImplementedError
+
+    def __getitems__(self, indices):
+        """
+        Batched fetch for the DataLoader: with as_tensor and no transforms the whole batch is one
+        index into the pre-converted split, otherwise the items are fetched one by one.
+        """
+        if not self.as_tensor or self.transform is not None or self.target_transform is not None:
+            return [self[index] for index in indices]
+        indices = torch.from_numpy(np.asarray(indices, dtype=np.int64))
+        if self.dataidxs is not None:
+            indices = torch.from_numpy(self.dataidxs)[indices]
+        data, target = (getattr(self, field) for field in self.base_fields[:2])
+        return data[indices], torch.as_tensor(target)[indices].long()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for field in self.base_fields:
+            state.pop(field, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if not all(field in state for field in self.base_fields):
+            for field, value in zip(self.base_fields, self.__build_truncated_dataset__()):
+                setattr(self, field, value)
+
 def mkdirs(dirpath):
     try:
         os.makedirs(dirpath)
@@ -57,37 +186,39 @@ class CustomTensorDataset(data.TensorDataset):
         return tuple(tensor[index] for tensor in self.tensors) + (index,)
 
 
-class MNIST_truncated(data.Dataset):
+class MNIST_truncated(BaseIndexDataset):
 
-    def __init__(self, root, dataidxs=None, train=True, transform=None, target_transform=None, download=False):
+    def __init__(self, root, dataidxs=None, train=True, transform=None, target_transform=None, download=False,
+                 as_tensor=False):
 
         self.root = root
-        self.dataidxs = dataidxs
+        self.dataidxs = None if dataidxs is None else np.asarray(dataidxs, dtype=np.int64)
         self.train = train
         self.transform = transform
         self.target_transform = target_transform
         self.download = download
+        self.as_tensor = as_tensor
 
         self.data, self.target = self.__build_truncated_dataset__()
 
     def __build_truncated_dataset__(self):
 
-        mnist_dataobj = MNIST(self.root, self.train, self.transform, self.target_transform, self.download)
+        def load():
+            mnist_dataobj = MNIST(self.root, self.train, self.transform, self.target_transform, self.download)
 
-        # if self.train:
-        #     data = mnist_dataobj.train_data
-        #     target = mnist_dataobj.train_labels
-        # else:
-        #     data = mnist_dataobj.test_data
-        #     target = mnist_dataobj.test_labels
+            # if self.train:
+            #     data = mnist_dataobj.train_data
+            #     target = mnist_dataobj.train_labels
+            # else:
+            #     data = mnist_dataobj.test_data
+            #     target = mnist_dataobj.test_labels
 
-        data = mnist_dataobj.data
-        target = mnist_dataobj.targets
-
-        if self.dataidxs is not None:
-            data = data[self.dataidxs]
-            target = target[self.dataidxs]
+            return mnist_dataobj.data, mnist_dataobj.targets
 
+        data, target = get_base_dataset('mnist', self.root, self.train, load)
+        if self.as_tensor:
+            # the split as transforms.ToTensor would return it, converted once
+            data, = get_base_dataset('mnist-tensor', self.root, self.train, lambda: (data.float().div(255).unsqueeze(1),))
         return data, target
 
     def __getitem__(self, index):
@@ -98,11 +229,14 @@ class MNIST_truncated(data.Dataset):
         Returns:
             tuple: (image, target) where target is index of the target class.
         """
+        if self.dataidxs is not None:
+            index = self.dataidxs[index]
         img, target = self.data[index], self.target[index]
 
         # doing this so that it is consistent with all other datasets
         # to return a PIL Image
-        img = Image.fromarray(img.numpy(), mode='L')
+        if not self.as_tensor:
+            img = Image.fromarray(img.numpy(), mode='L')
 
         # print("mnist img:", img)
         # print("mnist target:", target)
@@ -116,39 +250,43 @@ class MNIST_truncated(data.Dataset):
         return img, target
 
     def __len__(self):
+        if self.dataidxs is not None:
+            return len(self.dataidxs)
         return len(self.data)
 
-class FashionMNIST_truncated(data.Dataset):
+class FashionMNIST_truncated(BaseIndexDataset):
 
-    def __init__(self, root, dataidxs=None, train=True, transform=None, target_transform=None, download=False):
+    def __init__(self, root, dataidxs=None, train=True, transform=None, target_transform=None, download=False,
+                 as_tensor=False):
 
         self.root = root
-        self.dataidxs = dataidxs
+        self.dataidxs = None if dataidxs is None else np.asarray(dataidxs, dtype=np.int64)
         self.train = train
         self.transform = transform
         self.target_transform = target_transform
         self.download = download
+        self.as_tensor = as_tensor
 
         self.data, self.target = self.__build_truncated_dataset__()
 
     def __build_truncated_dataset__(self):
 
-        mnist_dataobj = FashionMNIST(self.root, self.train, self.transform, self.target_transform, self.download)
+        def load():
+            mnist_dataobj = FashionMNIST(self.root, self.train, self.transform, self.target_transform, self.download)
 
-        # if self.train:
-        #     data = mnist_dataobj.train_data
-        #     target = mnist_dataobj.train_labels
-        # else:
-        #     data = mnist_dataobj.test_data
-        #     target = mnist_dataobj.test_labels
+            # if self.train:
+            #     data = mnist_dataobj.train_data
+            #     target = mnist_dataobj.train_labels
+            # else:
+            #     data = mnist_dataobj.test_data
+            #     target = mnist_dataobj.test_labels
 
-        data = mnist_dataobj.data
-        target = mnist_dataobj.targets
-
-        if self.dataidxs is not None:
-            data = data[self.dataidxs]
-            target = target[self.dataidxs]
+            return mnist_dataobj.data, mnist_dataobj.targets
 
+        data, target = get_base_dataset('fmnist', self.root, self.train, load)
+        if self.as_tensor:
+            # the split as transforms.ToTensor would return it, converted once
+            data, = get_base_dataset('fmnist-tensor', self.root, self.train, lambda: (data.float().div(255).unsqueeze(1),))
         return data, target
 
     def __getitem__(self, index):
@@ -159,11 +297,14 @@ class FashionMNIST_truncated(data.Dataset):
         Returns:
             tuple: (image, target) where target is index of the target class.
         """
+        if self.dataidxs is not None:
+            index = self.dataidxs[index]
         img, target = self.data[index], self.target[index]
 
         # doing this so that it is consistent with all other datasets
         # to return a PIL Image
-        img = Image.fromarray(img.numpy(), mode='L')
+        if not self.as_tensor:
+            img = Image.fromarray(img.numpy(), mode='L')
 
         # print("mnist img:", img)
         # print("mnist target:", target)
@@ -177,14 +318,16 @@ class FashionMNIST_truncated(data.Dataset):
         return img, target
 
     def __len__(self):
+        if self.dataidxs is not None:
+            return len(self.dataidxs)
         return len(self.data)
 
-class SVHN_custom(data.Dataset):
+class SVHN_custom(BaseIndexDataset):
 
     def __init__(self, root, dataidxs=None, train=True, transform=None, target_transform=None, download=False):
 
         self.root = root
-        self.dataidxs = dataidxs
+        self.dataidxs = None if dataidxs is None else np.asarray(dataidxs, dtype=np.int64)
         self.train = train
         self.transform = transform
         self.target_transform = target_transform
@@ -193,23 +336,19 @@ class SVHN_custom(data.Dataset):
         self.data, self.target = self.__build_truncated_dataset__()
 
     def __build_truncated_dataset__(self):
-        if self.train is True:
-            # svhn_dataobj1 = SVHN(self.root, 'train', self.transform, self.target_transform, self.download)
-            # svhn_dataobj2 = SVHN(self.root, 'extra', self.transform, self.target_transform, self.download)
-            # data = np.concatenate((svhn_dataobj1.data, svhn_dataobj2.data), axis=0)
-            # target = np.concatenate((svhn_dataobj1.labels, svhn_dataobj2.labels), axis=0)
-
-            svhn_dataobj = SVHN(self.root, 'train', self.transform, self.target_transform, self.download)
-            data = svhn_dataobj.data
-            target = svhn_dataobj.labels
-        else:
-            svhn_dataobj = SVHN(self.root, 'test', self.transform, self.target_transform, self.download)
-            data = svhn_dataobj.data
-            target = svhn_dataobj.labels
+        def load():
+            if self.train is True:
+                # svhn_dataobj1 = SVHN(self.root, 'train', self.transform, self.target_transform, self.download)
+                # svhn_dataobj2 = SVHN(self.root, 'extra', self.transform, self.target_transform, self.download)
+                # data = np.concatenate((svhn_dataobj1.data, svhn_dataobj2.data), axis=0)
+                # target = np.concatenate((svhn_dataobj1.labels, svhn_dataobj2.labels), axis=0)
+
+                svhn_dataobj = SVHN(self.root, 'train', self.transform, self.target_transform, self.download)
+            else:
+                svhn_dataobj = SVHN(self.root, 'test', self.transform, self.target_transform, self.download)
+            return svhn_dataobj.data, svhn_dataobj.labels
 
-        if self.dataidxs is not None:
-            data = data[self.dataidxs]
-            target = target[self.dataidxs]
+        data, target = get_base_dataset('svhn', self.root, self.train, load)
         # print("svhn data:", data)
         # print("len svhn data:", len(data))
         # print("type svhn data:", type(data))
@@ -231,6 +370,8 @@ class SVHN_custom(data.Dataset):
         Returns:
             tuple: (image, target) where target is index of the target class.
         """
+        if self.dataidxs is not None:
+            index = self.dataidxs[index]
         img, target = self.data[index], self.target[index]
         # print("svhn img:", img)
         # print("svhn target:", target)
@@ -247,6 +388,8 @@ class SVHN_custom(data.Dataset):
         return img, target
 
     def __len__(self):
+        if self.dataidxs is not None:
+            return len(self.dataidxs)
         return len(self.data)
 
 
@@ -429,12 +572,12 @@ class CelebA_custom(VisionDataset):
 
 
 
-class CIFAR10_truncated(data.Dataset):
+class CIFAR10_truncated(BaseIndexDataset):
 
     def __init__(self, root, dataidxs=None, train=True, transform=None, target_transform=None, download=False):
 
         self.root = root
-        self.dataidxs = dataidxs
+        self.dataidxs = None if dataidxs is None else np.asarray(dataidxs, dtype=np.int64)
         self.train = train
         self.transform = transform
         self.target_transform = target_transform
@@ -444,22 +587,19 @@ class CIFAR10_truncated(data.Dataset):
 
     def __build_truncated_dataset__(self):
 
-        cifar_dataobj = CIFAR10(self.root, self.train, self.transform, self.target_transform, self.download)
+        def load():
+            cifar_dataobj = CIFAR10(self.root, self.train, self.transform, self.target_transform, self.download)
+            return cifar_dataobj.data, np.array(cifar_dataobj.targets)
 
-        data = cifar_dataobj.data
-        target = np.array(cifar_dataobj.targets)
-
-        if self.dataidxs is not None:
-            data = data[self.dataidxs]
-            target = target[self.dataidxs]
-
-        return data, target
+        return get_base_dataset('cifar10', self.root, self.train, load)
 
     def truncate_channel(self, index):
-        for i in range(index.shape[0]):
-            gs_index = index[i]
-            self.data[gs_index, :, :, 1] = 0.0
-            self.data[gs_index, :, :, 2] = 0.0
+        if self.dataidxs is not None:
+            index = np.asarray(self.dataidxs)[index]
+        # self.data is the cached base array every client shares, so zero the channels in a private copy
+        self.data = self.data.copy()
+        self.data[index, :, :, 1] = 0.0
+        self.data[index, :, :, 2] = 0.0
 
     def __getitem__(self, index):
         """
@@ -469,6 +609,8 @@ class CIFAR10_truncated(data.Dataset):
         Returns:
             tuple: (image, target) where target is index of the target class.
         """
+        if self.dataidxs is not None:
+            index = self.dataidxs[index]
         img, target = self.data[index], self.target[index]
 
         # print("cifar10 img:", img)
@@ -483,6 +625,8 @@ class CIFAR10_truncated(data.Dataset):
         return img, target
 
     def __len__(self):
+        if self.dataidxs is not None:
+            return len(self.dataidxs)
         return len(self.data)
 
 def gen_bar_updater() -> Callable[[int, int, int], None]:
@@ -610,7 +754,7 @@ def download_and_extract_archive(
     print("Extracting {} to {}".format(archive, extract_root))
     extract_archive(archive, extract_root, remove_finished)
 
-class FEMNIST(MNIST):
+class FEMNIST(BaseIndexDataset, MNIST):
     """
     This dataset is derived from the Leaf repository
     (https://github.com/TalwalkarLab/leaf) pre-processing of the Extended MNIST
@@ -620,13 +764,15 @@ class FEMNIST(MNIST):
     resources = [
         ('https://raw.githubusercontent.com/tao-shen/FEMNIST_pytorch/master/femnist.tar.gz',
          '59c65cec646fc57fe92d27d83afdf0ed')]
+    base_fields = ('data', 'targets', 'users_index')
 
     def __init__(self, root, dataidxs=None, train=True, transform=None, target_transform=None,
-                 download=False):
+                 download=False, as_tensor=False):
         super(MNIST, self).__init__(root, transform=transform,
                                     target_transform=target_transform)
         self.train = train
-        self.dataidxs = dataidxs
+        self.dataidxs = None if dataidxs is None else np.asarray(dataidxs, dtype=np.int64)
+        self.as_tensor = as_tensor
 
         if download:
             self.download()
@@ -634,21 +780,28 @@ class FEMNIST(MNIST):
         if not self._check_exists():
             raise RuntimeError('Dataset not found.' +
                                ' You can use download=True to download it')
+
+        self.data, self.targets, self.users_index = self.__build_truncated_dataset__()
+
+    def __build_truncated_dataset__(self):
         if self.train:
             data_file = self.training_file
         else:
             data_file = self.test_file
-
-        self.data, self.targets, self.users_index = torch.load(os.path.join(self.processed_folder, data_file))
-
-        if self.dataidxs is not None:
-            self.data = self.data[self.dataidxs]
-            self.targets = self.targets[self.dataidxs]        
+        data, targets, users_index = get_base_dataset(
+            'femnist', self.root, self.train, lambda: torch.load(os.path.join(self.processed_folder, data_file)))
+        if self.as_tensor:
+            # mode 'F' images go through transforms.ToTensor unscaled
+            data, = get_base_dataset('femnist-tensor', self.root, self.train, lambda: (data.float().unsqueeze(1),))
+        return data, targets, users_index
 
 
     def __getitem__(self, index):
+        if self.dataidxs is not None:
+            index = self.dataidxs[index]
         img, target = self.data[index], int(self.targets[index])
-        img = Image.fromarray(img.numpy(), mode='F')
+        if not self.as_tensor:
+            img = Image.fromarray(img.numpy(), mode='F')
         if self.transform is not None:
             img = self.transform(img)
         if self.target_transform is not None:
@@ -676,38 +829,148 @@ class FEMNIST(MNIST):
         shutil.move(os.path.join(self.raw_folder, self.test_file), self.processed_folder)
 
     def __len__(self):
+        if self.dataidxs is not None:
+            return len(self.dataidxs)
         return len(self.data)
 
 
+def generated_dir(root, dataset):
+    return os.path.join(root, 'generated', dataset)
+
+
+def _save_array(path, array):
+    # write next to path and rename over it, so processes that have the old file memory-mapped keep
+    # reading the old data and new readers never see a partial file
+    tmp_path = path + '.tmp-%d' % os.getpid()
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def save_generated(root, dataset, X_train, y_train, X_test, y_test):
+    """
+    Store the arrays partition_data builds for the generated and svmlight datasets under
+    root/generated/<dataset>/, one .npy file per array so that load_generated can memory-map them.
+    A scipy sparse X is stored as the data/indices/indptr/shape arrays of its CSR form.
+    """
+    directory = generated_dir(root, dataset)
+    mkdirs(directory)
+    for split, X, y in (('train', X_train, y_train), ('test', X_test, y_test)):
+        if scipy.sparse.issparse(X):
+            X = X.tocsr()
+            for part in ('data', 'indices', 'indptr'):
+                _save_array(os.path.join(directory, 'X_%s.%s.npy' % (split, part)), getattr(X, part))
+            _save_array(os.path.join(directory, 'X_%s.shape.npy' % split), np.array(X.shape, dtype=np.int64))
+        else:
+            _save_array(os.path.join(directory, 'X_%s.npy' % split), np.asarray(X))
+        _save_array(os.path.join(directory, 'y_%s.npy' % split), np.asarray(y))
+
+
+def load_generated(root, dataset, train=True, sparse=False):
+    """
+    Memory-map the (X, y) split written by save_generated. Nothing is read until it is indexed and the
+    pages are shared with every other client and process that maps the same files.
+    """
+    directory = generated_dir(root, dataset)
+    split = 'train' if train else 'test'
+    def load(name):
+        # plain ndarray view of the mapping, indexing a np.memmap is slower
+        return np.load(os.path.join(directory, name), mmap_mode='r').view(np.ndarray)
+
+    y = load('y_%s.npy' % split)
+    if not sparse:
+        return load('X_%s.npy' % split), y
+    data, indices, indptr = (load('X_%s.%s.npy' % (split, part)) for part in ('data', 'indices', 'indptr'))
+    shape = tuple(int(n) for n in np.load(os.path.join(directory, 'X_%s.shape.npy' % split)))
+    return scipy.sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False), y
+
+
 class Generated(MNIST):
+    """
+    A split stored with save_generated under root/generated/<dataset>/. The arrays are memory-mapped and
+    a client's dataset only keeps its dataidxs into them, so clients do not copy the data.
+    """
+    sparse = False
 
     def __init__(self, root, dataidxs=None, train=True, transform=None, target_transform=None,
-                 download=False):
+                 download=False, dataset='generated'):
         super(MNIST, self).__init__(root, transform=transform,
                                     target_transform=target_transform)
         self.train = train
-        self.dataidxs = dataidxs
+        self.dataset = dataset
+        self.dataidxs = None if dataidxs is None else np.asarray(dataidxs, dtype=np.int64)
+        self.data, self.targets = load_generated(root, dataset, train, sparse=self.sparse)
 
-        if self.train:
-            self.data = np.load("data/generated/X_train.npy")
-            self.targets = np.load("data/generated/y_train.npy")
-        else:
-            self.data = np.load("data/generated/X_test.npy")
-            self.targets = np.load("data/generated/y_test.npy")            
+    def __getitem__(self, index):
+        if self.dataidxs is not None:
+            index = self.dataidxs[index]
+        # copy the row out of the read-only mapping
+        return np.array(self.data[index]), self.targets[index]
+
+    def __getitems__(self, indices):
+        # one gather for the whole batch instead of a copy per row
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.dataidxs is not None:
+            indices = self.dataidxs[indices]
+        return list(zip(self.data[indices], self.targets[indices]))
 
+    def __len__(self):
         if self.dataidxs is not None:
-            self.data = self.data[self.dataidxs]
-            self.targets = self.targets[self.dataidxs]        
+            return len(self.dataidxs)
+        return self.data.shape[0]
+
+    def __getstate__(self):
+        # worker processes map the files themselves instead of receiving a pickled copy of the arrays
+        state = self.__dict__.copy()
+        del state['data'], state['targets']
+        return state
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data, self.targets = load_generated(self.root, self.dataset, self.train, sparse=self.sparse)
+
+
+class SparseGenerated(Generated):
+    """
+    Generated for datasets kept as scipy CSR matrices (rcv1) instead of dense arrays. An item is a
+    1 x d CSR row; __getitems__ slices a whole batch out of the matrix at once and sparse_collate
+    turns it into a torch sparse tensor.
+    """
+    sparse = True
 
     def __getitem__(self, index):
-        data, target = self.data[index], self.targets[index]
-        return data, target
+        if self.dataidxs is not None:
+            index = self.dataidxs[index]
+        return self.data[index], self.targets[index]
 
-    def __len__(self):
-        return len(self.data)
+    def __getitems__(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.dataidxs is not None:
+            indices = self.dataidxs[indices]
+        return self.data[indices], np.array(self.targets[indices])
 
 
+def sparse_collate(batch):
+    """
+    collate_fn for SparseGenerated: a (CSR matrix, targets) batch from __getitems__, or a list of
+    (CSR row, target) items, becomes a sparse COO float tensor and a target tensor.
+    """
+    if isinstance(batch, list):
+        batch = scipy.sparse.vstack([x for x, _ in batch], format='csr'), np.array([target for _, target in batch])
+    x, target = batch
+    if not x.has_canonical_format:
+        x.sum_duplicates()
+    # row-major COO of a canonical CSR matrix is already coalesced
+    x = x.tocoo()
+    indices = torch.from_numpy(np.vstack((x.row, x.col)).astype(np.int64))
+    values = torch.from_numpy(x.data.astype(np.float32))
+    try:
+        x = torch.sparse_coo_tensor(indices, values, x.shape, check_invariants=False, is_coalesced=True)
+    except TypeError:
+        # torch versions without these arguments
+        x = torch.sparse_coo_tensor(indices, values, x.shape).coalesce()
+    return x, torch.from_numpy(np.asarray(target))
+
 
 class genData(MNIST):
     def __init__(self, data, targets):
@@ -719,12 +982,12 @@ class genData(MNIST):
     def __len__(self):
         return len(self.data)
 
-class CIFAR100_truncated(data.Dataset):
+class CIFAR100_truncated(BaseIndexDataset):
 
     def __init__(self, root, dataidxs=None, train=True, transform=None, target_transform=None, download=False):
 
         self.root = root
-        self.dataidxs = dataidxs
+        self.dataidxs = None if dataidxs is None else np.asarray(dataidxs, dtype=np.int64)
         self.train = train
         self.transform = transform
         self.target_transform = target_transform
@@ -734,22 +997,16 @@ class CIFAR100_truncated(data.Dataset):
 
     def __build_truncated_dataset__(self):
 
-        cifar_dataobj = CIFAR100(self.root, self.train, self.transform, self.target_transform, self.download)
-
-        if torchvision.__version__ == '0.2.1':
-            if self.train:
-                data, target = cifar_dataobj.train_data, np.array(cifar_dataobj.train_labels)
-            else:
-                data, target = cifar_dataobj.test_data, np.array(cifar_dataobj.test_labels)
-        else:
-            data = cifar_dataobj.data
-            target = np.array(cifar_dataobj.targets)
+        def load():
+            cifar_dataobj = CIFAR100(self.root, self.train, self.transform, self.target_transform, self.download)
 
-        if self.dataidxs is not None:
-            data = data[self.dataidxs]
-            target = target[self.dataidxs]
+            if torchvision.__version__ == '0.2.1':
+                if self.train:
+                    return cifar_dataobj.train_data, np.array(cifar_dataobj.train_labels)
+                return cifar_dataobj.test_data, np.array(cifar_dataobj.test_labels)
+            return cifar_dataobj.data, np.array(cifar_dataobj.targets)
 
-        return data, target
+        return get_base_dataset('cifar100', self.root, self.train, load)
 
     def __getitem__(self, index):
         """
@@ -758,6 +1015,8 @@ class CIFAR100_truncated(data.Dataset):
         Returns:
             tuple: (image, target) where target is index of the target class.
         """
+        if self.dataidxs is not None:
+            index = self.dataidxs[index]
         img, target = self.data[index], self.target[index]
         img = Image.fromarray(img)
         # print("cifar10 img:", img)
@@ -772,6 +1031,8 @@ class CIFAR100_truncated(data.Dataset):
         return img, target
 
     def __len__(self):
+        if self.dataidxs is not None:
+            return len(self.dataidxs)
         return len(self.data)
 
 
@@ -780,7 +1041,7 @@ class CIFAR100_truncated(data.Dataset):
 class ImageFolder_custom(DatasetFolder):
     def __init__(self, root, dataidxs=None, train=True, transform=None, target_transform=None, download=None):
         self.root = root
-        self.dataidxs = dataidxs
+        self.dataidxs = None if dataidxs is None else np.asarray(dataidxs, dtype=np.int64)
         self.train = train
         self.transform = transform
         self.target_transform = target_transform
@@ -13,7 +13,9 @@ import os
 import copy
 from math import *
 import random
+import atexit
 import dill as pickle
+import torch.multiprocessing as mp
 
 import datetime
 #from torch.utils.tensorboard import SummaryWriter
@@ -22,8 +24,12 @@ from model import *
 from utils import *
 from vggmodel import *
 from resnetcifar import *
+import datasets
+from checkpoint import Checkpointer, get_rng_states, set_rng_states
+from stacked import StackedClients, supports_stacked
+from aggregation import StateLayout, ScaffoldCorrection, ProximalTerm, accumulate, fedavg_aggregate, fednova_aggregate, scaffold_update_c
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--model', type=str, default='MLP', help='neural network used in training')
     parser.add_argument('--dataset', type=str, default='mnist', help='dataset used for training')
@@ -53,11 +59,27 @@ def get_args():
     parser.add_argument('--log_file_name', type=str, default=None, help='The log file name')
     parser.add_argument('--optimizer', type=str, default='sgd', help='the optimizer')
     parser.add_argument('--mu', type=float, default=1, help='the mu parameter for fedprox')
+    parser.add_argument('--fedprox_mode', type=str, default='grad', choices=['grad', 'loss'],
+                        help='apply the fedprox term as a gradient update (grad) or by adding it to the loss (loss)')
     parser.add_argument('--noise', type=float, default=0, help='how much noise we add to some party')
     parser.add_argument('--noise_type', type=str, default='level', help='Different level of noise or different space of noise')
     parser.add_argument('--rho', type=float, default=0, help='Parameter controlling the momentum SGD')
     parser.add_argument('--sample', type=float, default=1, help='Sample ratio for each communication round')
-    args = parser.parse_args()
+    parser.add_argument('--workers', type=int, default=1, help='number of processes training the selected clients of a round in parallel')
+    parser.add_argument('--shared_memory', type=int, default=0, help='with --workers > 1, keep the datasets in shared memory that the worker processes attach to')
+    parser.add_argument('--stacked_clients', type=int, default=0,
+                        help='train the selected fedavg clients of mlp/perceptron (any device) and simple-cnn models (GPU) together with torch.func.vmap')
+    parser.add_argument('--checkpoint_every', type=int, default=0, help='checkpoint the run every k communication rounds (0: never)')
+    parser.add_argument('--checkpoint_dir', type=str, default='./checkpoints/', help='Checkpoint directory path')
+    parser.add_argument('--resume', type=int, default=0, help='resume from the last checkpoint of the same run if there is one')
+    parser.add_argument('--partition_cache', type=str, default='./partitions/', help='directory caching the data partitions as .npz files (empty: no cache)')
+    parser.add_argument('--eval_every', type=int, default=1, help='evaluate the global model every k rounds (the last round is always evaluated)')
+    parser.add_argument('--eval_final_only', type=int, default=0, help='evaluate the global model only after the last round')
+    parser.add_argument('--eval_global_train', type=int, default=1, help='whether to compute the global model accuracy on the full training set')
+    parser.add_argument('--eval_subsample', type=int, default=0, help='evaluate test accuracy on a fixed random subset of this many samples (0: full test set)')
+    parser.add_argument('--local_eval', type=str, default='all', choices=['all', 'post', 'none'],
+                        help='client accuracy passes: before and after local training, only after, or none')
+    args = parser.parse_args(argv)
     return args
 
 def init_nets(net_configs, dropout_p, n_parties, args):
@@ -153,14 +175,54 @@ def init_nets(net_configs, dropout_p, n_parties, args):
     return nets, model_meta_data, layer_type
 
 
+eval_policy = EvalPolicy()
+
+def local_accuracy(net, train_dataloader, test_dataloader, stage, moon_model=False, device="cpu"):
+    """
+    Client train/test accuracy before ('pre') or after ('post') local training; None when eval_policy skips it.
+    The passes leave the random state untouched, so training does not depend on the eval policy.
+    """
+    if not eval_policy.local(stage):
+        return None, None
+    rng_states = get_rng_states()
+    train_acc = compute_accuracy(net, train_dataloader, moon_model=moon_model, device=device)
+    test_acc, conf_matrix = compute_accuracy(net, eval_policy.test_loader(test_dataloader), get_confusion_matrix=True, moon_model=moon_model, device=device)
+    set_rng_states(rng_states)
+
+    if stage == 'pre':
+        logger.info('>> Pre-Training Training accuracy: {}'.format(train_acc))
+        logger.info('>> Pre-Training Test accuracy: {}'.format(test_acc))
+    else:
+        logger.info('>> Training accuracy: %f' % train_acc)
+        logger.info('>> Test accuracy: %f' % test_acc)
+    return train_acc, test_acc
+
+
+def global_accuracy(global_model, train_dataloader, test_dataloader, moon_model=False, device="cpu"):
+    """
+    Global model train/test accuracy for the current round; None for the passes eval_policy skips.
+    Like local_accuracy, the passes leave the random state untouched.
+    """
+    train_acc, test_acc = None, None
+    if not eval_policy.global_round():
+        eval_policy.skip('global test accuracy')
+        if eval_policy.global_train:
+            eval_policy.skip('global train accuracy')
+        return train_acc, test_acc
+    rng_states = get_rng_states()
+    if eval_policy.global_train:
+        train_acc = compute_accuracy(global_model, train_dataloader, moon_model=moon_model, device=device)
+    else:
+        eval_policy.skip('global train accuracy')
+    test_acc, conf_matrix = compute_accuracy(global_model, eval_policy.test_loader(test_dataloader), get_confusion_matrix=True, moon_model=moon_model, device=device)
+    set_rng_states(rng_states)
+    return train_acc, test_acc
+
+
 def train_net(net_id, net, train_dataloader, test_dataloader, epochs, lr, args_optimizer, device="cpu"):
     logger.info('Training network %s' % str(net_id))
 
-    train_acc = compute_accuracy(net, train_dataloader, device=device)
-    test_acc, conf_matrix = compute_accuracy(net, test_dataloader, get_confusion_matrix=True, device=device)
-
-    logger.info('>> Pre-Training Training accuracy: {}'.format(train_acc))
-    logger.info('>> Pre-Training Test accuracy: {}'.format(test_acc))
+    train_acc, test_acc = local_accuracy(net, train_dataloader, test_dataloader, 'pre', device=device)
 
     if args_optimizer == 'adam':
         optimizer = optim.Adam(filter(lambda p: p.requires_grad, net.parameters()), lr=lr, weight_decay=args.reg)
@@ -217,11 +279,7 @@ def train_net(net_id, net, train_dataloader, test_dataloader, epochs, lr, args_o
         #     logger.info('>> Training accuracy: %f' % train_acc)
         #     logger.info('>> Test accuracy: %f' % test_acc)
 
-    train_acc = compute_accuracy(net, train_dataloader, device=device)
-    test_acc, conf_matrix = compute_accuracy(net, test_dataloader, get_confusion_matrix=True, device=device)
-
-    logger.info('>> Training accuracy: %f' % train_acc)
-    logger.info('>> Test accuracy: %f' % test_acc)
+    train_acc, test_acc = local_accuracy(net, train_dataloader, test_dataloader, 'post', device=device)
 
 
     logger.info(' ** Training complete **')
@@ -233,11 +291,7 @@ def train_net_fedprox(net_id, net, global_net, train_dataloader, test_dataloader
     logger.info('n_training: %d' % len(train_dataloader))
     logger.info('n_test: %d' % len(test_dataloader))
 
-    train_acc = compute_accuracy(net, train_dataloader, device=device)
-    test_acc, conf_matrix = compute_accuracy(net, test_dataloader, get_confusion_matrix=True, device=device)
-
-    logger.info('>> Pre-Training Training accuracy: {}'.format(train_acc))
-    logger.info('>> Pre-Training Test accuracy: {}'.format(test_acc))
+    train_acc, test_acc = local_accuracy(net, train_dataloader, test_dataloader, 'pre', device=device)
 
 
     if args_optimizer == 'adam':
@@ -254,6 +308,7 @@ def train_net_fedprox(net_id, net, global_net, train_dataloader, test_dataloader
     # mu = 0.001
     loss_total = 0.0
     global_weight_collector = list(global_net.to(device).parameters())
+    proximal = ProximalTerm(net, global_net, mu)
 
     for epoch in range(epochs):
         epoch_loss_collector = []
@@ -269,14 +324,17 @@ def train_net_fedprox(net_id, net, global_net, train_dataloader, test_dataloader
             loss = criterion(out, target)
 
             #for fedprox
-            fed_prox_reg = 0.0
-            for param_index, param in enumerate(net.parameters()):
-                fed_prox_reg += ((mu / 2) * torch.norm((param - global_weight_collector[param_index]))**2)
-            loss += fed_prox_reg
+            if args.fedprox_mode == 'grad':
+                loss.backward()
+                loss = loss.detach() + proximal.step()
+            else:
+                fed_prox_reg = 0.0
+                for param_index, param in enumerate(net.parameters()):
+                    fed_prox_reg += ((mu / 2) * torch.norm((param - global_weight_collector[param_index]))**2)
+                loss += fed_prox_reg
+                loss.backward()
             loss_total += loss.item()
 
-
-            loss.backward()
             optimizer.step()
 
             cnt += 1
@@ -292,11 +350,7 @@ def train_net_fedprox(net_id, net, global_net, train_dataloader, test_dataloader
         #     logger.info('>> Training accuracy: %f' % train_acc)
         #     logger.info('>> Test accuracy: %f' % test_acc)
 
-    train_acc = compute_accuracy(net, train_dataloader, device=device)
-    test_acc, conf_matrix = compute_accuracy(net, test_dataloader, get_confusion_matrix=True, device=device)
-
-    logger.info('>> Training accuracy: %f' % train_acc)
-    logger.info('>> Test accuracy: %f' % test_acc)
+    train_acc, test_acc = local_accuracy(net, train_dataloader, test_dataloader, 'post', device=device)
 
 
     logger.info(' ** Training complete **')
@@ -359,11 +413,7 @@ def train_net_fedprox_ft(net_id, net, train_dataloader, test_dataloader, epochs,
 
 def train_net_scaffold(net_id, net, global_model, c_local, c_global, train_dataloader, test_dataloader, epochs, lr, args_optimizer, device="cpu"):
     logger.info('Training network %s' % str(net_id))
-    train_acc = compute_accuracy(net, train_dataloader, device=device)
-    test_acc, conf_matrix = compute_accuracy(net, test_dataloader, get_confusion_matrix=True, device=device)
-
-    logger.info('>> Pre-Training Training accuracy: {}'.format(train_acc))
-    logger.info('>> Pre-Training Test accuracy: {}'.format(test_acc))
+    train_acc, test_acc = local_accuracy(net, train_dataloader, test_dataloader, 'pre', device=device)
     loss_total = 0.0
     if args_optimizer == 'adam':
         optimizer = optim.Adam(filter(lambda p: p.requires_grad, net.parameters()), lr=lr, weight_decay=args.reg)
@@ -384,6 +434,7 @@ def train_net_scaffold(net_id, net, global_model, c_local, c_global, train_datal
 
     c_global_para = c_global.state_dict()
     c_local_para = c_local.state_dict()
+    correction = ScaffoldCorrection(net, c_global, c_local, args.lr)
 
     for epoch in range(epochs):
         epoch_loss_collector = []
@@ -403,10 +454,7 @@ def train_net_scaffold(net_id, net, global_model, c_local, c_global, train_datal
                 loss.backward()
                 optimizer.step()
 
-                net_para = net.state_dict()
-                for key in net_para:
-                    net_para[key] = net_para[key] - args.lr * (c_global_para[key] - c_local_para[key])
-                net.load_state_dict(net_para)
+                correction.step()
 
                 cnt += 1
                 epoch_loss_collector.append(loss.item())
@@ -425,11 +473,7 @@ def train_net_scaffold(net_id, net, global_model, c_local, c_global, train_datal
     c_local.load_state_dict(c_new_para)
 
 
-    train_acc = compute_accuracy(net, train_dataloader, device=device)
-    test_acc, conf_matrix = compute_accuracy(net, test_dataloader, get_confusion_matrix=True, device=device)
-
-    logger.info('>> Training accuracy: %f' % train_acc)
-    logger.info('>> Test accuracy: %f' % test_acc)
+    train_acc, test_acc = local_accuracy(net, train_dataloader, test_dataloader, 'post', device=device)
 
 
     logger.info(' ** Training complete **')
@@ -438,11 +482,7 @@ def train_net_scaffold(net_id, net, global_model, c_local, c_global, train_datal
 def train_net_fednova(net_id, net, global_model, train_dataloader, test_dataloader, epochs, lr, args_optimizer, device="cpu"):
     logger.info('Training network %s' % str(net_id))
 
-    train_acc = compute_accuracy(net, train_dataloader, device=device)
-    test_acc, conf_matrix = compute_accuracy(net, test_dataloader, get_confusion_matrix=True, device=device)
-
-    logger.info('>> Pre-Training Training accuracy: {}'.format(train_acc))
-    logger.info('>> Pre-Training Test accuracy: {}'.format(test_acc))
+    train_acc, test_acc = local_accuracy(net, train_dataloader, test_dataloader, 'pre', device=device)
 
     optimizer = optim.SGD(filter(lambda p: p.requires_grad, net.parameters()), lr=lr, momentum=args.rho, weight_decay=args.reg)
     criterion = nn.CrossEntropyLoss().to(device)
@@ -490,11 +530,7 @@ def train_net_fednova(net_id, net, global_model, train_dataloader, test_dataload
     for key in norm_grad:
         #norm_grad[key] = (global_model_para[key] - net_para[key]) / a_i
         norm_grad[key] = torch.true_divide(global_model_para[key]-net_para[key], a_i)
-    train_acc = compute_accuracy(net, train_dataloader, device=device)
-    test_acc, conf_matrix = compute_accuracy(net, test_dataloader, get_confusion_matrix=True, device=device)
-
-    logger.info('>> Training accuracy: %f' % train_acc)
-    logger.info('>> Test accuracy: %f' % test_acc)
+    train_acc, test_acc = local_accuracy(net, train_dataloader, test_dataloader, 'post', device=device)
 
 
     logger.info(' ** Training complete **')
@@ -506,11 +542,7 @@ def train_net_moon(net_id, net, global_net, previous_nets, train_dataloader, tes
 
     logger.info('Training network %s' % str(net_id))
 
-    train_acc = compute_accuracy(net, train_dataloader, moon_model=True, device=device)
-    test_acc, conf_matrix = compute_accuracy(net, test_dataloader, get_confusion_matrix=True, moon_model=True, device=device)
-
-    logger.info('>> Pre-Training Training accuracy: {}'.format(train_acc))
-    logger.info('>> Pre-Training Test accuracy: {}'.format(test_acc))
+    train_acc, test_acc = local_accuracy(net, train_dataloader, test_dataloader, 'pre', moon_model=True, device=device)
 
     # conloss = ContrastiveLoss(temperature)
 
@@ -600,11 +632,7 @@ def train_net_moon(net_id, net, global_net, previous_nets, train_dataloader, tes
     if args.loss != 'l2norm':
         for previous_net in previous_nets:
             previous_net.to('cpu')
-    train_acc = compute_accuracy(net, train_dataloader, moon_model=True, device=device)
-    test_acc, conf_matrix = compute_accuracy(net, test_dataloader, get_confusion_matrix=True, moon_model=True, device=device)
-
-    logger.info('>> Training accuracy: %f' % train_acc)
-    logger.info('>> Test accuracy: %f' % test_acc)
+    train_acc, test_acc = local_accuracy(net, train_dataloader, test_dataloader, 'post', moon_model=True, device=device)
     net.to('cpu')
     logger.info(' ** Training complete **')
     return train_acc, test_acc
@@ -617,35 +645,184 @@ def view_image(train_dataloader):
         exit(0)
 
 
-def local_train_net(nets, selected, args, net_dataidx_map, test_dl = None, device="cpu"):
+def get_client_dataloader(net_id, dataidxs, args):
+    noise_level = args.noise
+    if net_id == args.n_parties - 1:
+        noise_level = 0
+
+    if args.noise_type == 'space':
+        return get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level, net_id, args.n_parties-1)
+    noise_level = args.noise / (args.n_parties - 1) * net_id
+    return get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level)
+
+
+_client_pool = None
+_worker_test_dl = None
+
+def init_client_worker(worker_args, test_ds, test_bs, num_threads, log_path, collate_fn=None, shared_bases=None):
+    global args, eval_policy, _worker_test_dl
+    if shared_bases:
+        datasets.attach_shared_bases(shared_bases)
+    args = worker_args
+    eval_policy = EvalPolicy.from_args(worker_args)
+    _worker_test_dl = data.DataLoader(dataset=test_ds, batch_size=test_bs, shuffle=False, collate_fn=collate_fn)
+    torch.set_num_threads(num_threads)
+    if log_path is not None:
+        logging.basicConfig(filename=log_path, format='%(asctime)s %(levelname)-8s %(message)s',
+                            datefmt='%m-%d %H:%M', level=logging.DEBUG, filemode='a')
+        logging.getLogger().setLevel(logging.DEBUG)
+
+
+def get_client_pool(args, test_dl):
+    """
+    Spawn pool used for --workers > 1. It lives for the whole run so every worker loads the base dataset once.
+    """
+    global _client_pool
+    if _client_pool is None:
+        num_threads = max(1, torch.get_num_threads() // args.workers)
+        log_path = None
+        for handler in logging.root.handlers:
+            if isinstance(handler, logging.FileHandler):
+                log_path = handler.baseFilename
+        _client_pool = mp.get_context('spawn').Pool(args.workers, initializer=init_client_worker,
+                                                    initargs=(args, test_dl.dataset, test_dl.batch_size, num_threads, log_path, test_dl.collate_fn,
+                                                              datasets.shared_base_handles()))
+        atexit.register(close_client_pool)
+    return _client_pool
+
+
+def close_client_pool():
+    global _client_pool
+    if _client_pool is not None:
+        _client_pool.close()
+        _client_pool.join()
+        _client_pool = None
+
+
+def train_client(job, test_dl=None):
+    """
+    Train one selected client. Runs in the main process or in a pool worker and only
+    returns the trained state_dict plus what the algorithm needs for aggregation.
+    """
+    alg, net_id, net, dataidxs, extra, device, seed = job
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    if test_dl is None:
+        test_dl = _worker_test_dl
+
+    logger.info("Training network %s. n_training: %d" % (str(net_id), len(dataidxs)))
+    # move the model to cuda device:
+    net.to(device)
+    train_dl_local, test_dl_local, _, _ = get_client_dataloader(net_id, dataidxs, args)
+    n_epoch = args.epochs
+
+    if alg == 'fedavg':
+        trainacc, testacc, local_loss = train_net(net_id, net, train_dl_local, test_dl, n_epoch, args.lr, args.optimizer, device=device)
+        out = ()
+    elif alg == 'fedprox':
+        global_model, = extra
+        trainacc, testacc, local_loss = train_net_fedprox(net_id, net, global_model, train_dl_local, test_dl, n_epoch, args.lr, args.optimizer, args.mu, device=device)
+        out = ()
+    elif alg == 'scaffold':
+        global_model, c_local, c_global = extra
+        global_model.to(device)
+        c_global.to(device)
+        c_local.to(device)
+        trainacc, testacc, c_delta_para, local_loss = train_net_scaffold(net_id, net, global_model, c_local, c_global, train_dl_local, test_dl, n_epoch, args.lr, args.optimizer, device=device)
+        c_local.to('cpu')
+        out = (c_local.state_dict(), c_delta_para)
+    elif alg == 'fednova':
+        global_model, = extra
+        global_model.to(device)
+        trainacc, testacc, a_i, d_i, local_loss = train_net_fednova(net_id, net, global_model, train_dl_local, test_dl, n_epoch, args.lr, args.optimizer, device=device)
+        out = (a_i, d_i, len(train_dl_local))
+    return net_id, net.state_dict(), trainacc, testacc, local_loss, out
+
+
+def run_clients(jobs, args, test_dl):
+    """
+    Train the jobs sequentially (--workers 1) or on the client pool. Every client gets its own
+    seed drawn from the torch RNG, so both paths produce the same models for a fixed --init_seed.
+    """
+    eval_policy.skip_local(len(jobs))
+    seeds = torch.randint(0, 2**31 - 1, (len(jobs),)).tolist()
+    jobs = [job + (seed,) for job, seed in zip(jobs, seeds)]
+    if args.workers > 1:
+        return get_client_pool(args, test_dl).map(train_client, jobs, chunksize=1)
+
+    results = []
+    for job in jobs:
+        py_state, np_state, torch_state = random.getstate(), np.random.get_state(), torch.get_rng_state()
+        results.append(train_client(job, test_dl))
+        random.setstate(py_state)
+        np.random.set_state(np_state)
+        torch.set_rng_state(torch_state)
+    return results
+
+
+def local_train_net_stacked(nets, selected, args, net_dataidx_map, test_dl = None, device="cpu"):
+    """
+    local_train_net for --stacked_clients: one vmap'd SGD step trains all selected clients at once.
+    """
+    eval_policy.skip_local(len(selected))
+    seeds = torch.randint(0, 2**31 - 1, (len(selected),)).tolist()
+    py_state, np_state, torch_state = random.getstate(), np.random.get_state(), torch.get_rng_state()
+
+    # every client is seeded as in train_client and keeps its own torch RNG state, which
+    # StackedClients switches to while fetching the client's batches
+    net_ids = [net_id for net_id in nets if net_id in selected]
+    train_dls = {}
+    client_rng_states = []
+    for net_id, seed in zip(net_ids, seeds):
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        logger.info("Training network %s. n_training: %d" % (str(net_id), len(net_dataidx_map[net_id])))
+        nets[net_id].to(device)
+        train_dls[net_id], _, _, _ = get_client_dataloader(net_id, net_dataidx_map[net_id], args)
+        local_accuracy(nets[net_id], train_dls[net_id], test_dl, 'pre', device=device)
+        client_rng_states.append(torch.get_rng_state())
+
+    trainer = StackedClients([nets[net_id] for net_id in net_ids], args.lr, momentum=args.rho, weight_decay=args.reg, device=device)
+    epoch_losses = trainer.train([train_dls[net_id] for net_id in net_ids], args.epochs, rng_states=client_rng_states)
+    trainer.write_back()
+
     avg_acc = 0.0
     loss_total = 0
+    for net_id, client_losses in zip(net_ids, epoch_losses):
+        logger.info('Training network %s' % str(net_id))
+        for epoch, losses in enumerate(client_losses):
+            logger.info('Epoch: %d Loss: %f' % (epoch, sum(losses) / len(losses)))
+            loss_total += sum(losses)
+        train_acc, test_acc = local_accuracy(nets[net_id], train_dls[net_id], test_dl, 'post', device=device)
+        if test_acc is not None:
+            logger.info("net %d final test acc %f" % (net_id, test_acc))
+            avg_acc += test_acc
+    avg_acc /= len(selected)
+    if args.alg == 'local_training':
+        logger.info("avg test acc %f" % avg_acc)
 
-    for net_id, net in nets.items():
-        if net_id not in selected:
-            continue
-        dataidxs = net_dataidx_map[net_id]
-
-        logger.info("Training network %s. n_training: %d" % (str(net_id), len(dataidxs)))
-        # move the model to cuda device:
-        net.to(device)
+    random.setstate(py_state)
+    np.random.set_state(np_state)
+    torch.set_rng_state(torch_state)
+    nets_list = list(nets.values())
+    return nets_list, loss_total
 
-        noise_level = args.noise
-        if net_id == args.n_parties - 1:
-            noise_level = 0
 
-        if args.noise_type == 'space':
-            train_dl_local, test_dl_local, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level, net_id, args.n_parties-1)
-        else:
-            noise_level = args.noise / (args.n_parties - 1) * net_id
-            train_dl_local, test_dl_local, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level)
-        train_dl_global, test_dl_global, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32)
-        n_epoch = args.epochs
+def local_train_net(nets, selected, args, net_dataidx_map, test_dl = None, device="cpu"):
+    if args.stacked_clients and args.dataset not in SPARSE_DATASETS and supports_stacked(nets[selected[0]], args.optimizer, device):
+        return local_train_net_stacked(nets, selected, args, net_dataidx_map, test_dl=test_dl, device=device)
+    avg_acc = 0.0
+    loss_total = 0
 
-        trainacc, testacc, local_net_loss = train_net(net_id, net, train_dl_local, test_dl, n_epoch, args.lr, args.optimizer, device=device)
+    jobs = [('fedavg', net_id, net, net_dataidx_map[net_id], (), device) for net_id, net in nets.items() if net_id in selected]
+    for net_id, net_para, trainacc, testacc, local_net_loss, _ in run_clients(jobs, args, test_dl):
+        nets[net_id].load_state_dict(net_para)
         loss_total += local_net_loss
-        logger.info("net %d final test acc %f" % (net_id, testacc))
-        avg_acc += testacc
+        if testacc is not None:
+            logger.info("net %d final test acc %f" % (net_id, testacc))
+            avg_acc += testacc
         # saving the trained models here
         # save_model(net, net_id, args)
         # else:
@@ -662,31 +839,13 @@ def local_train_net_fedprox(nets, selected, global_model, args, net_dataidx_map,
     avg_acc = 0.0
     loss_total = 0.0
 
-    for net_id, net in nets.items():
-        if net_id not in selected:
-            continue
-        dataidxs = net_dataidx_map[net_id]
-
-        print("Training network %s. n_training: %d" % (str(net_id), len(dataidxs)))
-        # move the model to cuda device:
-        net.to(device)
-
-        noise_level = args.noise
-        if net_id == args.n_parties - 1:
-            noise_level = 0
-
-        if args.noise_type == 'space':
-            train_dl_local, test_dl_local, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level, net_id, args.n_parties-1)
-        else:
-            noise_level = args.noise / (args.n_parties - 1) * net_id
-            train_dl_local, test_dl_local, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level)
-        train_dl_global, test_dl_global, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32)
-        n_epoch = args.epochs
-
-        trainacc, testacc, local_net_loss = train_net_fedprox(net_id, net, global_model, train_dl_local, test_dl, n_epoch, args.lr, args.optimizer, args.mu, device=device)
+    jobs = [('fedprox', net_id, net, net_dataidx_map[net_id], (global_model,), device) for net_id, net in nets.items() if net_id in selected]
+    for net_id, net_para, trainacc, testacc, local_net_loss, _ in run_clients(jobs, args, test_dl):
+        nets[net_id].load_state_dict(net_para)
         loss_total += local_net_loss
-        print("net %d final test acc %f" % (net_id, testacc))
-        avg_acc += testacc
+        if testacc is not None:
+            print("net %d final test acc %f" % (net_id, testacc))
+            avg_acc += testacc
     avg_acc /= len(selected)
     if args.alg == 'local_training':
         logger.info("avg test acc %f" % avg_acc)
@@ -698,56 +857,24 @@ def local_train_net_scaffold(nets, selected, global_model, c_nets, c_global, arg
     avg_acc = 0.0
     loss_total = 0.0
 
-    total_delta = copy.deepcopy(global_model.state_dict())
-    for key in total_delta:
-        total_delta[key] = 0.0
+    layout = StateLayout(c_global.state_dict())
+    total_delta = None
     c_global.to(device)
     global_model.to(device)
-    for net_id, net in nets.items():
-        if net_id not in selected:
-            continue
-        dataidxs = net_dataidx_map[net_id]
-
-        logger.info("Training network %s. n_training: %d" % (str(net_id), len(dataidxs)))
-        # move the model to cuda device:
-        net.to(device)
-
-        c_nets[net_id].to(device)
-
-        noise_level = args.noise
-        if net_id == args.n_parties - 1:
-            noise_level = 0
-
-        if args.noise_type == 'space':
-            train_dl_local, test_dl_local, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level, net_id, args.n_parties-1)
-        else:
-            noise_level = args.noise / (args.n_parties - 1) * net_id
-            train_dl_local, test_dl_local, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level)
-        train_dl_global, test_dl_global, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32)
-        n_epoch = args.epochs
 
-
-        trainacc, testacc, c_delta_para, local_loss = train_net_scaffold(net_id, net, global_model, c_nets[net_id], c_global, train_dl_local, test_dl, n_epoch, args.lr, args.optimizer, device=device)
+    jobs = [('scaffold', net_id, net, net_dataidx_map[net_id], (global_model, c_nets[net_id], c_global), device)
+            for net_id, net in nets.items() if net_id in selected]
+    for net_id, net_para, trainacc, testacc, local_loss, (c_local_para, c_delta_para) in run_clients(jobs, args, test_dl):
+        nets[net_id].load_state_dict(net_para)
+        c_nets[net_id].load_state_dict(c_local_para)
         loss_total += local_loss
-        c_nets[net_id].to('cpu')
-        for key in total_delta:
-            total_delta[key] += c_delta_para[key]
+        total_delta = accumulate(layout, total_delta, c_delta_para)
 
 
-        logger.info("net %d final test acc %f" % (net_id, testacc))
-        avg_acc += testacc
-    for key in total_delta:
-        total_delta[key] /= args.n_parties
-    c_global_para = c_global.state_dict()
-    for key in c_global_para:
-        if c_global_para[key].type() == 'torch.LongTensor':
-            c_global_para[key] += total_delta[key].type(torch.LongTensor)
-        elif c_global_para[key].type() == 'torch.cuda.LongTensor':
-            c_global_para[key] += total_delta[key].type(torch.cuda.LongTensor)
-        else:
-            #print(c_global_para[key].type())
-            c_global_para[key] += total_delta[key]
-    c_global.load_state_dict(c_global_para)
+        if testacc is not None:
+            logger.info("net %d final test acc %f" % (net_id, testacc))
+            avg_acc += testacc
+    scaffold_update_c(layout, c_global.state_dict(), total_delta, args.n_parties)
 
     avg_acc /= len(selected)
     if args.alg == 'local_training':
@@ -763,36 +890,17 @@ def local_train_net_fednova(nets, selected, global_model, args, net_dataidx_map,
     d_list = []
     n_list = []
     global_model.to(device)
-    for net_id, net in nets.items():
-        if net_id not in selected:
-            continue
-        dataidxs = net_dataidx_map[net_id]
 
-        logger.info("Training network %s. n_training: %d" % (str(net_id), len(dataidxs)))
-        # move the model to cuda device:
-        net.to(device)
-
-        noise_level = args.noise
-        if net_id == args.n_parties - 1:
-            noise_level = 0
-
-        if args.noise_type == 'space':
-            train_dl_local, test_dl_local, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level, net_id, args.n_parties-1)
-        else:
-            noise_level = args.noise / (args.n_parties - 1) * net_id
-            train_dl_local, test_dl_local, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level)
-        train_dl_global, test_dl_global, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32)
-        n_epoch = args.epochs
-
-
-        trainacc, testacc, a_i, d_i, local_loss = train_net_fednova(net_id, net, global_model, train_dl_local, test_dl, n_epoch, args.lr, args.optimizer, device=device)
+    jobs = [('fednova', net_id, net, net_dataidx_map[net_id], (global_model,), device) for net_id, net in nets.items() if net_id in selected]
+    for net_id, net_para, trainacc, testacc, local_loss, (a_i, d_i, n_i) in run_clients(jobs, args, test_dl):
+        nets[net_id].load_state_dict(net_para)
         loss_total += local_loss
         a_list.append(a_i)
         d_list.append(d_i)
-        n_i = len(train_dl_local)
         n_list.append(n_i)
-        logger.info("net %d final test acc %f" % (net_id, testacc))
-        avg_acc += testacc
+        if testacc is not None:
+            logger.info("net %d final test acc %f" % (net_id, testacc))
+            avg_acc += testacc
 
 
     avg_acc /= len(selected)
@@ -804,6 +912,7 @@ def local_train_net_fednova(nets, selected, global_model, args, net_dataidx_map,
 
 def local_train_net_moon(nets, selected, args, net_dataidx_map, test_dl=None, global_model = None, prev_model_pool = None, round=None, device="cpu"):
     avg_acc = 0.0
+    eval_policy.skip_local(len(selected))
     global_model.to(device)
     for net_id, net in nets.items():
         if net_id not in selected:
@@ -813,16 +922,7 @@ def local_train_net_moon(nets, selected, args, net_dataidx_map, test_dl=None, gl
         logger.info("Training network %s. n_training: %d" % (str(net_id), len(dataidxs)))
         net.to(device)
 
-        noise_level = args.noise
-        if net_id == args.n_parties - 1:
-            noise_level = 0
-
-        if args.noise_type == 'space':
-            train_dl_local, test_dl_local, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level, net_id, args.n_parties-1)
-        else:
-            noise_level = args.noise / (args.n_parties - 1) * net_id
-            train_dl_local, test_dl_local, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level)
-        train_dl_global, test_dl_global, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32)
+        train_dl_local, test_dl_local, _, _ = get_client_dataloader(net_id, dataidxs, args)
         n_epoch = args.epochs
 
         prev_models=[]
@@ -830,8 +930,9 @@ def local_train_net_moon(nets, selected, args, net_dataidx_map, test_dl=None, gl
             prev_models.append(prev_model_pool[i][net_id])
         trainacc, testacc = train_net_moon(net_id, net, global_model, prev_models, train_dl_local, test_dl, n_epoch, args.lr,
                                               args.optimizer, args.mu, args.temperature, args, round, device=device)
-        logger.info("net %d final test acc %f" % (net_id, testacc))
-        avg_acc += testacc
+        if testacc is not None:
+            logger.info("net %d final test acc %f" % (net_id, testacc))
+            avg_acc += testacc
 
     avg_acc /= len(selected)
     if args.alg == 'local_training':
@@ -841,6 +942,29 @@ def local_train_net_moon(nets, selected, args, net_dataidx_map, test_dl=None, gl
     return nets_list
 
 
+def get_checkpointer(args):
+    run_key = '%s-%s-%s-%s-%d-%s-%d' % (args.alg, args.dataset, args.model, args.partition, args.n_parties, args.beta, args.init_seed)
+    return Checkpointer(os.path.join(args.checkpoint_dir, run_key), args.checkpoint_every, run_key)
+
+
+def resume_checkpoint(checkpointer, singles, groups):
+    """
+    Restore the last checkpoint when --resume is set. Returns the first round to run and the
+    (communication_round, valid_accuracy, training_loss) history.
+    """
+    if not args.resume or not checkpointer.exists():
+        return 0, ([], [], [])
+    start_round, state = checkpointer.restore(singles, groups)
+    eval_policy.skipped = state['eval_skipped']
+    logger.info('Resuming from %s at round %d' % (checkpointer.directory, start_round))
+    return start_round, state['history']
+
+
+def save_checkpoint(checkpointer, round, singles, groups, history=()):
+    if checkpointer.should_save(round, args.comm_round):
+        checkpointer.save(round, singles, groups, {'history': history, 'eval_skipped': eval_policy.skipped})
+
+
 def get_partition_dict(dataset, partition, n_parties, init_seed=0, datadir='./data', logdir='./logs', beta=0.5):
     seed = init_seed
     np.random.seed(seed)
@@ -881,6 +1005,8 @@ if __name__ == '__main__':
     logger.setLevel(logging.DEBUG)
     logger.info(device)
 
+    eval_policy = EvalPolicy.from_args(args)
+    datasets.SHARED_MEMORY_ENABLED = bool(args.shared_memory and args.workers > 1)
     seed = args.init_seed
     logger.info("#" * 100)
     np.random.seed(seed)
@@ -888,7 +1014,8 @@ if __name__ == '__main__':
     random.seed(seed)
     logger.info("Partitioning data")
     X_train, y_train, X_test, y_test, net_dataidx_map, traindata_cls_counts = partition_data(
-        args.dataset, args.datadir, args.logdir, args.partition, args.n_parties, beta=args.beta)
+        args.dataset, args.datadir, args.logdir, args.partition, args.n_parties, beta=args.beta,
+        seed=seed, cache_dir=args.partition_cache)
     n_classes = len(np.unique(y_train))
 
     train_dl_global, test_dl_global, train_ds_global, test_ds_global = get_dataloader(args.dataset,
@@ -913,10 +1040,10 @@ if __name__ == '__main__':
                 noise_level = 0
 
             if args.noise_type == 'space':
-                train_dl_local, test_dl_local, train_ds_local, test_ds_local = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level, party_id, args.n_parties-1)
+                train_dl_local, test_dl_local, train_ds_local, test_ds_local = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level, party_id, args.n_parties-1, batch_augment=False)
             else:
                 noise_level = args.noise / (args.n_parties - 1) * party_id
-                train_dl_local, test_dl_local, train_ds_local, test_ds_local = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level)
+                train_dl_local, test_dl_local, train_ds_local, test_ds_local = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level, batch_augment=False)
             train_all_in_list.append(train_ds_local)
             test_all_in_list.append(test_ds_local)
         train_all_in_ds = data.ConcatDataset(train_all_in_list)
@@ -934,6 +1061,7 @@ if __name__ == '__main__':
         nets, local_model_meta_data, layer_type = init_nets(args.net_config, args.dropout_p, args.n_parties, args)
         global_models, global_model_meta_data, global_layer_type = init_nets(args.net_config, 0, 1, args)
         global_model = global_models[0]
+        layout = StateLayout(global_model.state_dict())
 
         global_para = global_model.state_dict()
         if args.is_same_initial:
@@ -941,8 +1069,11 @@ if __name__ == '__main__':
                 net.load_state_dict(global_para)
 
 
-        for round in range(args.comm_round):
+        checkpointer = get_checkpointer(args)
+        start_round, (communication_round, valid_accuracy, training_loss) = resume_checkpoint(checkpointer, {'global_model': global_model}, {'nets': nets})
+        for round in range(start_round, args.comm_round):
             communication_round += [round]
+            eval_policy.start_round(round, args.comm_round)
             print("in comm round:" + str(round))
 
             arr = np.arange(args.n_parties)
@@ -965,30 +1096,26 @@ if __name__ == '__main__':
             total_data_points = sum([len(net_dataidx_map[r]) for r in selected])
             fed_avg_freqs = [len(net_dataidx_map[r]) / total_data_points for r in selected]
 
-            for idx in range(len(selected)):
-                net_para = nets[selected[idx]].cpu().state_dict()
-                if idx == 0:
-                    for key in net_para:
-                        global_para[key] = net_para[key] * fed_avg_freqs[idx]
-                else:
-                    for key in net_para:
-                        global_para[key] += net_para[key] * fed_avg_freqs[idx]
+            global_para = fedavg_aggregate(layout, (nets[r].cpu().state_dict() for r in selected), fed_avg_freqs)
             global_model.load_state_dict(global_para)
 
             logger.info('global n_training: %d' % len(train_dl_global))
             logger.info('global n_test: %d' % len(test_dl_global))
 
             global_model.to(device)
-            train_acc = compute_accuracy(global_model, train_dl_global, device=device)
-            test_acc, conf_matrix = compute_accuracy(global_model, test_dl_global, get_confusion_matrix=True, device=device)
+            train_acc, test_acc = global_accuracy(global_model, train_dl_global, test_dl_global, device=device)
 
-            print('>> Global Model Train accuracy: %f' % train_acc)
-            print('>> Global Model Test accuracy: %f' % test_acc)
+            if train_acc is not None:
+                print('>> Global Model Train accuracy: %f' % train_acc)
+            if test_acc is not None:
+                print('>> Global Model Test accuracy: %f' % test_acc)
             valid_accuracy += [test_acc]
             training_loss += [loss_total]
 
             logger.info(' -- comm_round' + ' '.join(map(str, communication_round)) + ': valid : ' + ' '.join(map(str, valid_accuracy)))
             print(' -- comm_round' + ' '.join(map(str, communication_round)) + ': valid : ' + ' '.join(map(str, valid_accuracy)) + ': loss : ' + ' '.join(map(str, training_loss)))
+            checkpointer.mark_dirty('nets', selected)
+            save_checkpoint(checkpointer, round, {'global_model': global_model}, {'nets': nets}, (communication_round, valid_accuracy, training_loss))
         with open(f'{args.alg}beta{args.beta}.pickle', 'wb') as handle:
             pickle.dump((communication_round, valid_accuracy, training_loss), handle, protocol=pickle.HIGHEST_PROTOCOL)
 
@@ -997,6 +1124,7 @@ if __name__ == '__main__':
         nets, local_model_meta_data, layer_type = init_nets(args.net_config, args.dropout_p, args.n_parties, args)
         global_models, global_model_meta_data, global_layer_type = init_nets(args.net_config, 0, 1, args)
         global_model = global_models[0]
+        layout = StateLayout(global_model.state_dict())
 
         global_para = global_model.state_dict()
 
@@ -1004,8 +1132,11 @@ if __name__ == '__main__':
             for net_id, net in nets.items():
                 net.load_state_dict(global_para)
 
-        for round in range(args.comm_round):
+        checkpointer = get_checkpointer(args)
+        start_round, (communication_round, valid_accuracy, training_loss) = resume_checkpoint(checkpointer, {'global_model': global_model}, {'nets': nets})
+        for round in range(start_round, args.comm_round):
             communication_round += [round]
+            eval_policy.start_round(round, args.comm_round)
             print("in comm round:" + str(round))
 
             arr = np.arange(args.n_parties)
@@ -1028,14 +1159,7 @@ if __name__ == '__main__':
             total_data_points = sum([len(net_dataidx_map[r]) for r in selected])
             fed_avg_freqs = [len(net_dataidx_map[r]) / total_data_points for r in selected]
 
-            for idx in range(len(selected)):
-                net_para = nets[selected[idx]].cpu().state_dict()
-                if idx == 0:
-                    for key in net_para:
-                        global_para[key] = net_para[key] * fed_avg_freqs[idx]
-                else:
-                    for key in net_para:
-                        global_para[key] += net_para[key] * fed_avg_freqs[idx]
+            global_para = fedavg_aggregate(layout, (nets[r].cpu().state_dict() for r in selected), fed_avg_freqs)
             global_model.load_state_dict(global_para)
 
 
@@ -1044,14 +1168,17 @@ if __name__ == '__main__':
 
 
             global_model.to(device)
-            train_acc = compute_accuracy(global_model, train_dl_global, device=device)
-            test_acc, conf_matrix = compute_accuracy(global_model, test_dl_global, get_confusion_matrix=True, device=device)
+            train_acc, test_acc = global_accuracy(global_model, train_dl_global, test_dl_global, device=device)
             valid_accuracy += [test_acc]
             training_loss += [loss_total]
 
-            print('>> Global Model Train accuracy: %f' % train_acc)
-            print('>> Global Model Test accuracy: %f' % test_acc)
+            if train_acc is not None:
+                print('>> Global Model Train accuracy: %f' % train_acc)
+            if test_acc is not None:
+                print('>> Global Model Test accuracy: %f' % test_acc)
             print(' -- comm_round' + ' '.join(map(str, communication_round)) + ': valid : ' + ' '.join(map(str, valid_accuracy)) + ': loss : ' + ' '.join(map(str, training_loss)))
+            checkpointer.mark_dirty('nets', selected)
+            save_checkpoint(checkpointer, round, {'global_model': global_model}, {'nets': nets}, (communication_round, valid_accuracy, training_loss))
         
         for net_id, net in nets.items():
             dataidxs = net_dataidx_map[net_id]
@@ -1072,6 +1199,7 @@ if __name__ == '__main__':
         nets, local_model_meta_data, layer_type = init_nets(args.net_config, args.dropout_p, args.n_parties, args)
         global_models, global_model_meta_data, global_layer_type = init_nets(args.net_config, 0, 1, args)
         global_model = global_models[0]
+        layout = StateLayout(global_model.state_dict())
 
         c_nets, _, _ = init_nets(args.net_config, args.dropout_p, args.n_parties, args)
         c_globals, _, _ = init_nets(args.net_config, 0, 1, args)
@@ -1085,8 +1213,11 @@ if __name__ == '__main__':
             for net_id, net in nets.items():
                 net.load_state_dict(global_para)
 
-        for round in range(args.comm_round):
+        checkpointer = get_checkpointer(args)
+        start_round, (communication_round, valid_accuracy, training_loss) = resume_checkpoint(checkpointer, {'global_model': global_model, 'c_global': c_global}, {'nets': nets, 'c_nets': c_nets})
+        for round in range(start_round, args.comm_round):
             communication_round += [round]
+            eval_policy.start_round(round, args.comm_round)
 
             print("in comm round:" + str(round))
 
@@ -1110,28 +1241,25 @@ if __name__ == '__main__':
             total_data_points = sum([len(net_dataidx_map[r]) for r in selected])
             fed_avg_freqs = [len(net_dataidx_map[r]) / total_data_points for r in selected]
 
-            for idx in range(len(selected)):
-                net_para = nets[selected[idx]].cpu().state_dict()
-                if idx == 0:
-                    for key in net_para:
-                        global_para[key] = net_para[key] * fed_avg_freqs[idx]
-                else:
-                    for key in net_para:
-                        global_para[key] += net_para[key] * fed_avg_freqs[idx]
+            global_para = fedavg_aggregate(layout, (nets[r].cpu().state_dict() for r in selected), fed_avg_freqs)
             global_model.load_state_dict(global_para)
 
             print('global n_training: %d' % len(train_dl_global))
             print('global n_test: %d' % len(test_dl_global))
 
             global_model.to(device)
-            train_acc = compute_accuracy(global_model, train_dl_global, device=device)
-            test_acc, conf_matrix = compute_accuracy(global_model, test_dl_global, get_confusion_matrix=True, device=device)
+            train_acc, test_acc = global_accuracy(global_model, train_dl_global, test_dl_global, device=device)
             valid_accuracy += [test_acc]
             training_loss += [loss_total]
 
-            logger.info('>> Global Model Train accuracy: %f' % train_acc)
-            logger.info('>> Global Model Test accuracy: %f' % test_acc)
+            if train_acc is not None:
+                logger.info('>> Global Model Train accuracy: %f' % train_acc)
+            if test_acc is not None:
+                logger.info('>> Global Model Test accuracy: %f' % test_acc)
             print(' -- comm_round' + ' '.join(map(str, communication_round)) + ': valid : ' + ' '.join(map(str, valid_accuracy)) + ': loss : ' + ' '.join(map(str, training_loss)))
+            checkpointer.mark_dirty('nets', selected)
+            checkpointer.mark_dirty('c_nets', selected)
+            save_checkpoint(checkpointer, round, {'global_model': global_model, 'c_global': c_global}, {'nets': nets, 'c_nets': c_nets}, (communication_round, valid_accuracy, training_loss))
         for net_id, net in nets.items():
             dataidxs = net_dataidx_map[net_id]
 
@@ -1155,14 +1283,7 @@ if __name__ == '__main__':
         nets, local_model_meta_data, layer_type = init_nets(args.net_config, args.dropout_p, args.n_parties, args)
         global_models, global_model_meta_data, global_layer_type = init_nets(args.net_config, 0, 1, args)
         global_model = global_models[0]
-
-        d_list = [copy.deepcopy(global_model.state_dict()) for i in range(args.n_parties)]
-        d_total_round = copy.deepcopy(global_model.state_dict())
-        for i in range(args.n_parties):
-            for key in d_list[i]:
-                d_list[i][key] = 0
-        for key in d_total_round:
-            d_total_round[key] = 0
+        layout = StateLayout(global_model.state_dict())
 
         data_sum = 0
         for i in range(args.n_parties):
@@ -1176,8 +1297,11 @@ if __name__ == '__main__':
             for net_id, net in nets.items():
                 net.load_state_dict(global_para)
 
-        for round in range(args.comm_round):
+        checkpointer = get_checkpointer(args)
+        start_round, (communication_round, valid_accuracy, training_loss) = resume_checkpoint(checkpointer, {'global_model': global_model}, {'nets': nets})
+        for round in range(start_round, args.comm_round):
             communication_round += [round]
+            eval_policy.start_round(round, args.comm_round)
 
             logger.info("in comm round:" + str(round))
 
@@ -1197,57 +1321,31 @@ if __name__ == '__main__':
             _, a_list, d_list, n_list, loss_total = local_train_net_fednova(nets, selected, global_model, args, net_dataidx_map, test_dl = test_dl_global, device=device)
             total_n = sum(n_list)
             #print("total_n:", total_n)
-            d_total_round = copy.deepcopy(global_model.state_dict())
-            for key in d_total_round:
-                d_total_round[key] = 0.0
-
-            for i in range(len(selected)):
-                d_para = d_list[i]
-                for key in d_para:
-                    #if d_total_round[key].type == 'torch.LongTensor':
-                    #    d_total_round[key] += (d_para[key] * n_list[i] / total_n).type(torch.LongTensor)
-                    #else:
-                    d_total_round[key] += d_para[key] * n_list[i] / total_n
-
-
-            # for i in range(len(selected)):
-            #     d_total_round = d_total_round + d_list[i] * n_list[i] / total_n
-
-            # local_train_net(nets, args, net_dataidx_map, local_split=False, device=device)
-
             # update global model
             coeff = 0.0
             for i in range(len(selected)):
                 coeff = coeff + a_list[i] * n_list[i]/total_n
 
-            updated_model = global_model.state_dict()
-            for key in updated_model:
-                #print(updated_model[key])
-                if updated_model[key].type() == 'torch.LongTensor':
-                    updated_model[key] -= (coeff * d_total_round[key]).type(torch.LongTensor)
-                elif updated_model[key].type() == 'torch.cuda.LongTensor':
-                    updated_model[key] -= (coeff * d_total_round[key]).type(torch.cuda.LongTensor)
-                else:
-                    #print(updated_model[key].type())
-                    #print((coeff*d_total_round[key].type()))
-                    updated_model[key] -= coeff * d_total_round[key]
-            global_model.load_state_dict(updated_model)
+            fednova_aggregate(layout, global_model.state_dict(), d_list, [n_i / total_n for n_i in n_list], coeff)
 
 
             logger.info('global n_training: %d' % len(train_dl_global))
             logger.info('global n_test: %d' % len(test_dl_global))
 
             global_model.to(device)
-            train_acc = compute_accuracy(global_model, train_dl_global, device=device)
-            test_acc, conf_matrix = compute_accuracy(global_model, test_dl_global, get_confusion_matrix=True, device=device)
+            train_acc, test_acc = global_accuracy(global_model, train_dl_global, test_dl_global, device=device)
             valid_accuracy += [test_acc]
             training_loss += [loss_total]
 
 
-            logger.info('>> Global Model Train accuracy: %f' % train_acc)
-            logger.info('>> Global Model Test accuracy: %f' % test_acc)
+            if train_acc is not None:
+                logger.info('>> Global Model Train accuracy: %f' % train_acc)
+            if test_acc is not None:
+                logger.info('>> Global Model Test accuracy: %f' % test_acc)
             print('pickle name: ' + f'{args.alg}beta{args.beta}.pickle')
             print(' -- comm_round' + ' '.join(map(str, communication_round)) + ': valid : ' + ' '.join(map(str, valid_accuracy)) + ': loss : ' + ' '.join(map(str, training_loss)))
+            checkpointer.mark_dirty('nets', selected)
+            save_checkpoint(checkpointer, round, {'global_model': global_model}, {'nets': nets}, (communication_round, valid_accuracy, training_loss))
         with open(f'{args.alg}beta{args.beta}.pickle', 'wb') as handle:
             pickle.dump((communication_round, valid_accuracy, training_loss), handle, protocol=pickle.HIGHEST_PROTOCOL)
 
@@ -1256,6 +1354,7 @@ if __name__ == '__main__':
         nets, local_model_meta_data, layer_type = init_nets(args.net_config, args.dropout_p, args.n_parties, args)
         global_models, global_model_meta_data, global_layer_type = init_nets(args.net_config, 0, 1, args)
         global_model = global_models[0]
+        layout = StateLayout(global_model.state_dict())
 
         global_para = global_model.state_dict()
         if args.is_same_initial:
@@ -1269,7 +1368,12 @@ if __name__ == '__main__':
             for param in net.parameters():
                 param.requires_grad = False
 
-        for round in range(args.comm_round):
+        checkpointer = get_checkpointer(args)
+        start_round, _ = resume_checkpoint(checkpointer, {'global_model': global_model}, {'nets': nets, 'old_nets_pool': old_nets})
+        if start_round > 0:
+            old_nets_pool.append(old_nets)
+        for round in range(start_round, args.comm_round):
+            eval_policy.start_round(round, args.comm_round)
             logger.info("in comm round:" + str(round))
 
             arr = np.arange(args.n_parties)
@@ -1293,26 +1397,20 @@ if __name__ == '__main__':
             total_data_points = sum([len(net_dataidx_map[r]) for r in selected])
             fed_avg_freqs = [len(net_dataidx_map[r]) / total_data_points for r in selected]
 
-            for idx in range(len(selected)):
-                net_para = nets[selected[idx]].cpu().state_dict()
-                if idx == 0:
-                    for key in net_para:
-                        global_para[key] = net_para[key] * fed_avg_freqs[idx]
-                else:
-                    for key in net_para:
-                        global_para[key] += net_para[key] * fed_avg_freqs[idx]
+            global_para = fedavg_aggregate(layout, (nets[r].cpu().state_dict() for r in selected), fed_avg_freqs)
             global_model.load_state_dict(global_para)
 
             logger.info('global n_training: %d' % len(train_dl_global))
             logger.info('global n_test: %d' % len(test_dl_global))
 
 
-            train_acc = compute_accuracy(global_model, train_dl_global, moon_model=True)
-            test_acc, conf_matrix = compute_accuracy(global_model, test_dl_global, get_confusion_matrix=True, moon_model=True)
+            train_acc, test_acc = global_accuracy(global_model, train_dl_global, test_dl_global, moon_model=True)
 
 
-            logger.info('>> Global Model Train accuracy: %f' % train_acc)
-            logger.info('>> Global Model Test accuracy: %f' % test_acc)
+            if train_acc is not None:
+                logger.info('>> Global Model Train accuracy: %f' % train_acc)
+            if test_acc is not None:
+                logger.info('>> Global Model Test accuracy: %f' % test_acc)
 
             old_nets = copy.deepcopy(nets)
             for _, net in old_nets.items():
@@ -1323,6 +1421,9 @@ if __name__ == '__main__':
                 old_nets_pool.append(old_nets)
             else:
                 old_nets_pool[0] = old_nets
+            checkpointer.mark_dirty('nets', selected)
+            checkpointer.mark_dirty('old_nets_pool', selected)
+            save_checkpoint(checkpointer, round, {'global_model': global_model}, {'nets': nets, 'old_nets_pool': old_nets_pool[0]})
 
     elif args.alg == 'local_training':
         logger.info("Initializing nets")
@@ -1338,5 +1439,7 @@ if __name__ == '__main__':
 
         logger.info("All in test acc: %f" % testacc)
 
+    logger.info(eval_policy.summary())
+
    # Fine tuning locally
 
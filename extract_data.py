@@ -30,6 +30,8 @@ debug = True
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--calculate', default=False, required=False, action='store_true', help='whether to calculate price values instead of loading from pickle')
+    parser.add_argument('--truncnorm_table', type=int, default=4097, help='points of the truncated normal CDF interpolation table, 0 to call scipy directly')
+    parser.add_argument('--truncnorm_interpolation', type=str, default='cubic', choices=['linear', 'cubic'], help='interpolation of the truncated normal CDF table')
     args = parser.parse_args()
     return args
 
@@ -424,6 +426,8 @@ def generate_coalition_table(i, coalition, theta_max, filename=None, is_uniform=
 
 if __name__ == '__main__':
     args = get_args()
+    bestresponse.TRUNCNORM_TABLE_SIZE = args.truncnorm_table
+    bestresponse.TRUNCNORM_INTERPOLATION = args.truncnorm_interpolation
     print('--- Parsing Logs ---')
     coalitions = parse_logs()
 
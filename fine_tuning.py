@@ -23,6 +23,8 @@ from model import *
 from utils import *
 from vggmodel import *
 from resnetcifar import *
+from artifacts import artifact_exists, load_artifact
+from scaffold_train import init_nets
 
 
 MAX_EPOCHS_BEFORE_STOPPING = 10
@@ -153,8 +155,14 @@ if __name__ == '__main__':
         for lr, optimizer, batch_size in product(learning_rates, optimizers, batch_sizes):
             current_params = f'lr={lr}, optimizer={optimizer}, batch_size={batch_size}'
             logger.info(f'Testing {current_params}')
+            artifact = f'./artifacts/{args.partition}_{args.alg}_{args.abc.lower()}_{c}_{args.C_size}_{beta_string}'
             filename = f'./pickle/{args.partition}_{args.alg}_{args.abc.lower()}_{c}_{args.C_size}_{beta_string}.pickle'
-            if os.path.exists(filename):
+            if artifact_exists(artifact):
+                (net_id, net, global_model, train_dl_local, test_dl_global, current_params, lr, optimizer, batch_size) = load_artifact(artifact, init_nets)
+                # Ensure net is using global model parameters
+                net.load_state_dict(global_model.state_dict())
+            elif os.path.exists(filename):
+                # pickles written by scaffold_train.py before the artifact format
                 with open(filename, 'rb') as handle:
                     (net_id, net, global_model, train_dl_local, test_dl_global, current_params, lr, optimizer, batch_size) = pickle.load(handle)
                     # Ensure net is using global model parameters
@@ -1,4 +1,4 @@
-from bestresponse import sigma, H
+from bestresponse import sigma, H, vectorized_H
 
 import numpy as np
 import copy
@@ -25,30 +25,35 @@ def setup_logger():
     return exp_dir
 
 def market_share(p, A, theta_max, mean, sd, is_squared):
-    sorted_indices = np.argsort(A)[::-1]
-    # print(f"A (Performance in original order): {A}")
-    # print(f"p (Strategy in original order): {p}")
-    A = A[sorted_indices]
-    p = p[sorted_indices]
-    N = len(p)
-    
-    sigma_values = np.zeros((N, N))
-    for m in range(N):
-        for n in range(m+1, N):
-            sigma_values[m, n] = sigma(m, n, p, A, is_squared)
-            sigma_values[n, m] = sigma(n, m, p, A, is_squared)
-    
-    M = np.zeros(N)
-    M[0] = H(theta_max, mean, sd, theta_max) - H(np.max(sigma_values[0, 1:]), mean, sd, theta_max)
-    for i in range(1, N-1):
-        M[i] = H(sigma_values[i-1, i] - np.max([*sigma_values[i, i+1:], 0]), mean, sd, theta_max)
-    M[-1] = H(np.min(np.append(sigma_values[:-1, -1], theta_max)), mean, sd, theta_max) - H(0, mean, sd, theta_max)
-
-    reverse_indices = np.argsort(sorted_indices)
-    M_original = M[reverse_indices]
-
-    # print(f"M (Market shares in original order): {M_original}")
-
+    """
+    Market share of each of the N firms, for one profile (p and A of shape (N,)) or a batch of them
+    ((..., N)). The firms are ranked by A; the pairwise sigma matrix is built at once and the
+    shares read off it with the uniform H.
+    """
+    p = np.asarray(p, dtype=float)
+    A = np.asarray(A, dtype=float)
+    p, A = np.broadcast_arrays(p, A)
+    sorted_indices = np.argsort(A, axis=-1)[..., ::-1]
+    A = np.take_along_axis(A, sorted_indices, axis=-1)
+    p = np.take_along_axis(p, sorted_indices, axis=-1)
+    N = p.shape[-1]
+
+    q = A ** 2 if is_squared else A
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma_values = (p[..., :, None] - p[..., None, :]) / (q[..., :, None] - q[..., None, :])
+        # max over the firms ranked below each firm, -inf for the last one
+        row_max = np.where(np.triu(np.ones((N, N), dtype=bool), k=1), sigma_values, -np.inf).max(axis=-1)
+        theta = np.empty(p.shape)
+        theta[..., 0] = row_max[..., 0]
+        theta[..., 1:-1] = np.diagonal(sigma_values, offset=1, axis1=-2, axis2=-1)[..., :-1] - np.maximum(row_max[..., 1:-1], 0)
+        theta[..., -1] = np.minimum(sigma_values[..., :-1, -1].min(axis=-1), theta_max)
+
+    M = vectorized_H(theta, mean, sd, theta_max)
+    M[..., 0] = vectorized_H(theta_max, mean, sd, theta_max) - M[..., 0]
+    M[..., -1] -= vectorized_H(0, mean, sd, theta_max)
+
+    M_original = np.empty_like(M)
+    np.put_along_axis(M_original, sorted_indices, M, axis=-1)
     return M_original
 
 def W_n(n, p, A, theta_max, mean, sd, is_squared):
@@ -139,12 +144,13 @@ def create_tables(exp_dir):
 
     return price_df, quality_df
 
-exp_dir = setup_logger()
+if __name__ == '__main__':
+    exp_dir = setup_logger()
 
-run_competition(exp_dir)
-price_df, quality_df = create_tables(exp_dir)
+    run_competition(exp_dir)
+    price_df, quality_df = create_tables(exp_dir)
 
-logging.info("Price history:")
-logging.info(price_df)
-logging.info("\nQuality history:")
-logging.info(quality_df)
+    logging.info("Price history:")
+    logging.info(price_df)
+    logging.info("\nQuality history:")
+    logging.info(quality_df)
@@ -99,10 +99,15 @@ class FcNet(nn.Module):
 
     def forward(self, x):
 
-        x = x.view(-1, self.input_dim)
+        if not x.is_sparse:
+            x = x.view(-1, self.input_dim)
 
         for i, layer in enumerate(self.layers):
-            x = layer(x)
+            if i == 0 and x.is_sparse:
+                # sparse batches (rcv1) only multiply their nonzeros; no gradient is needed for the data itself
+                x = torch.sparse.mm(x.detach(), layer.weight.t()) + layer.bias
+            else:
+                x = layer(x)
 
             # Do not apply ReLU on the final layer
             if i < (len(self.layers) - 1):
@@ -0,0 +1,334 @@
+import logging
+import os
+import random
+import tempfile
+import zlib
+
+import numpy as np
+
+logger = logging.getLogger()
+
+BINARY_DATASETS = ('celeba', 'covtype', 'a9a', 'rcv1', 'SUSY')
+
+
+def num_classes(dataset):
+    if dataset in BINARY_DATASETS:
+        return 2
+    if dataset == 'cifar100':
+        return 100
+    if dataset == 'tinyimagenet':
+        return 200
+    return 10
+
+
+def label_order(y_train, n_classes):
+    """
+    Indices of y_train grouped by label with one stable argsort. The indices of label k are
+    order[bounds[k]:bounds[k+1]], in ascending order like np.where(y_train == k)[0].
+    """
+    order = np.argsort(y_train, kind='stable')
+    bounds = np.searchsorted(y_train[order], np.arange(n_classes + 1), side='left')
+    return order, bounds
+
+
+def group_by_party(indices, owners, n_parties):
+    """
+    Split indices into one array per party. owners[i] is the party of indices[i]; every party's
+    indices keep their relative order.
+    """
+    grouped = indices[np.argsort(owners, kind='stable')]
+    counts = np.bincount(owners, minlength=n_parties)
+    return dict(enumerate(np.split(grouped, np.cumsum(counts)[:-1])))
+
+
+def split_labels(order, bounds, n_parties, proportions_for):
+    """
+    Shuffle the indices of every label and cut them into n_parties consecutive chunks at the
+    cumulative proportions proportions_for(k, counts), where counts holds the number of samples
+    each party has been given so far. Returns the shuffled indices, the party of each index and the
+    per-party counts.
+    """
+    n_classes = len(bounds) - 1
+    indices = order[bounds[0]:bounds[-1]].copy()
+    owners = np.empty(len(indices), dtype=np.int64)
+    counts = np.zeros(n_parties, dtype=np.int64)
+    for k in range(n_classes):
+        start, end = bounds[k] - bounds[0], bounds[k + 1] - bounds[0]
+        idx_k = indices[start:end]
+        np.random.shuffle(idx_k)
+        proportions = proportions_for(k, counts)
+        split_points = np.minimum((np.cumsum(proportions) * len(idx_k)).astype(int)[:-1], len(idx_k))
+        sizes = np.diff(split_points, prepend=0, append=len(idx_k))
+        owners[start:end] = np.repeat(np.arange(n_parties), sizes)
+        counts += sizes
+    return indices, owners, counts
+
+
+def shuffle_parties(net_dataidx_map):
+    for j in range(len(net_dataidx_map)):
+        np.random.shuffle(net_dataidx_map[j])
+    return net_dataidx_map
+
+
+def dirichlet_label_split(y_train, n_parties, beta, n_classes, min_require_size=10, balance_n=None):
+    """
+    noniid-labeldir: every label is spread over the parties with proportions drawn from
+    Dir(beta), leaving out parties that already hold balance_n / n_parties samples. Redrawn until
+    every party has at least min_require_size samples.
+    """
+    order, bounds = label_order(y_train, n_classes)
+    N = y_train.shape[0] if balance_n is None else balance_n
+
+    def proportions_for(k, counts):
+        proportions = np.random.dirichlet(np.repeat(beta, n_parties))
+        proportions = proportions * (counts < N / n_parties)
+        return proportions / proportions.sum()
+
+    min_size = 0
+    while min_size < min_require_size:
+        indices, owners, counts = split_labels(order, bounds, n_parties, proportions_for)
+        min_size = counts.min()
+    return shuffle_parties(group_by_party(indices, owners, n_parties))
+
+
+def proportional_label_split(y_train, n_parties, n_classes, stat):
+    """
+    Spread every label k over the parties in the fixed proportions stat[:, k].
+    """
+    order, bounds = label_order(y_train, n_classes)
+    indices, owners, _ = split_labels(order, bounds, n_parties,
+                                      lambda k, counts: stat[:, k] / stat[:, k].sum())
+    return shuffle_parties(group_by_party(indices, owners, n_parties))
+
+
+def assign_label_chunks(y_train, n_parties, n_classes, contain, chunks_for):
+    """
+    Shuffle the indices of every label in turn, cut them with chunks_for(k, idx_k) and hand the
+    chunks out, in party order, to the parties whose contain list has the label.
+    """
+    order, bounds = label_order(y_train, n_classes)
+    pieces = [[] for _ in range(n_parties)]
+    for k in range(n_classes):
+        idx_k = order[bounds[k]:bounds[k + 1]].copy()
+        np.random.shuffle(idx_k)
+        split = chunks_for(k, idx_k)
+        ids = 0
+        for j in range(n_parties):
+            if k in contain[j]:
+                pieces[j].append(split[ids])
+                ids += 1
+    return {j: np.concatenate(pieces[j] or [np.zeros(0, dtype=np.int64)]).astype(np.int64) for j in range(n_parties)}
+
+
+def label_count_split(y_train, n_parties, num, n_classes):
+    """
+    noniid-#label<num>: every party gets samples of `num` labels, its own i % K plus random others;
+    each label is split evenly between the parties holding it.
+    """
+    if num == 10:
+        contain = [range(10)] * n_parties
+        return assign_label_chunks(y_train, n_parties, 10, contain, lambda k, idx_k: np.array_split(idx_k, n_parties))
+    times = [0 for i in range(n_classes)]
+    contain = []
+    for i in range(n_parties):
+        current = [i % n_classes]
+        times[i % n_classes] += 1
+        j = 1
+        while j < num:
+            ind = random.randint(0, n_classes - 1)
+            if ind not in current:
+                j = j + 1
+                current.append(ind)
+                times[ind] += 1
+        contain.append(current)
+    return assign_label_chunks(y_train, n_parties, n_classes, contain, lambda k, idx_k: np.array_split(idx_k, times[k]))
+
+
+def mixed_split(y_train, n_parties, beta, n_classes):
+    """
+    mixed: every party holds two labels and every label is shared by two parties in Dir(beta)
+    proportions.
+    """
+    times = [1 for i in range(10)]
+    contain = []
+    for i in range(n_parties):
+        current = [i % n_classes]
+        j = 1
+        while j < 2:
+            ind = random.randint(0, n_classes - 1)
+            if ind not in current and times[ind] < 2:
+                j = j + 1
+                current.append(ind)
+                times[ind] += 1
+        contain.append(current)
+
+    # the party-level proportions are unused but still drawn, which keeps the random stream (and so
+    # the split of a given seed) unchanged
+    min_size = 0
+    while min_size < 10:
+        proportions = np.random.dirichlet(np.repeat(beta, n_parties))
+        proportions = proportions / proportions.sum()
+        min_size = np.min(proportions * y_train.shape[0])
+
+    def chunks_for(k, idx_k):
+        proportions_k = np.random.dirichlet(np.repeat(beta, 2))
+        return np.split(idx_k, (np.cumsum(proportions_k) * len(idx_k)).astype(int)[:-1])
+
+    return assign_label_chunks(y_train, n_parties, n_classes, contain, chunks_for)
+
+
+def quantity_split(n_train, n_parties, beta):
+    """
+    iid-diff-quantity: a random permutation cut into Dir(beta) sized chunks of at least 10 samples.
+    """
+    idxs = np.random.permutation(n_train)
+    min_size = 0
+    while min_size < 10:
+        proportions = np.random.dirichlet(np.repeat(beta, n_parties))
+        proportions = proportions / proportions.sum()
+        min_size = np.min(proportions * len(idxs))
+    proportions = (np.cumsum(proportions) * len(idxs)).astype(int)[:-1]
+    return dict(enumerate(np.split(idxs, proportions)))
+
+
+def concat_ranges(starts, lengths):
+    """
+    np.concatenate([np.arange(s, s + l) for s, l in zip(starts, lengths)]) without the Python loop.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    ends = np.cumsum(lengths)
+    return np.arange(ends[-1] if len(ends) else 0, dtype=np.int64) + np.repeat(np.asarray(starts, dtype=np.int64) - (ends - lengths), lengths)
+
+
+def user_split(u_train, n_parties):
+    """
+    real (FEMNIST): the writers are dealt out to the parties; u_train holds each writer's sample count
+    and a writer's samples are consecutive in the training set.
+    """
+    counts = np.asarray(u_train, dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    no = np.random.permutation(counts.shape[0])
+    batch_idxs = np.array_split(no, n_parties)
+    return {i: concat_ranges(offsets[batch_idxs[i]], counts[batch_idxs[i]]) for i in range(n_parties)}
+
+
+def custom_quantity_split(y_train, clients_split, n_classes=10):
+    """
+    custom-quantity: party i gets clients_split[i] // n_classes samples of every label.
+    """
+    np.random.permutation(y_train.shape[0])  # unused, kept for the random stream
+    subsample = [x // n_classes for x in clients_split]
+    starts = np.cumsum([0] + subsample)
+    order, bounds = label_order(y_train, n_classes)
+    pieces = [[] for _ in clients_split]
+    for k in range(n_classes):
+        idx_k = order[bounds[k]:bounds[k + 1]].copy()
+        np.random.shuffle(idx_k)
+        for i in range(len(clients_split)):
+            pieces[i].append(idx_k[starts[i]:starts[i + 1]])
+    return {i: np.concatenate(pieces[i]) for i in range(len(clients_split))}
+
+
+def split_indices(dataset, partition, y_train, n_parties, beta=0.4, u_train=None):
+    """
+    The partitions of utils.partition_data: maps every party to the indices of its samples in y_train.
+    """
+    n_train = y_train.shape[0]
+    binary_k = 2 if dataset in BINARY_DATASETS else 10
+    if partition == "homo":
+        idxs = np.random.permutation(n_train)
+        return dict(enumerate(np.array_split(idxs, n_parties)))
+    elif partition == "noniid-labeldir":
+        return dirichlet_label_split(y_train, n_parties, beta, num_classes(dataset))
+    elif partition > "noniid-#label0" and partition <= "noniid-#label9":
+        num = eval(partition[13:])
+        if dataset in BINARY_DATASETS:
+            num = 1
+        return label_count_split(y_train, n_parties, num, num_classes(dataset))
+    elif partition == "iid-diff-quantity":
+        return quantity_split(n_train, n_parties, beta)
+    elif partition == "mixed":
+        return mixed_split(y_train, n_parties, beta, binary_k)
+    elif partition == "real" and dataset == "femnist":
+        return user_split(u_train, n_parties)
+    elif partition == "transfer-from-femnist":
+        stat = np.load("femnist-dis.npy")
+        chosen = np.random.permutation(stat.shape[0])[:n_parties]
+        return proportional_label_split(y_train, n_parties, binary_k, stat[chosen, :])
+    elif partition == "transfer-from-criteo":
+        stat0 = np.load("criteo-dis.npy")
+        while True:
+            chosen = np.random.permutation(stat0.shape[0])[:n_parties]
+            stat = stat0[chosen, :]
+            # every label must occur at some party
+            if (stat[:, :10] > 0).any(axis=0).all():
+                break
+        if dataset in BINARY_DATASETS:
+            stat[:, 0] = np.sum(stat[:, :5], axis=1)
+            stat[:, 1] = np.sum(stat[:, 5:], axis=1)
+        return proportional_label_split(y_train, n_parties, binary_k, stat)
+    raise ValueError('unknown partition %s for dataset %s' % (partition, dataset))
+
+
+def _rng_arrays():
+    np_state = np.random.get_state()
+    py_version, py_state, py_gauss = random.getstate()
+    return {
+        'np_keys': np_state[1], 'np_pos': np.array(np_state[2]),
+        'np_gauss': np.array([np_state[3], np_state[4]], dtype=np.float64),
+        'py_state': np.array((py_version,) + py_state, dtype=np.int64),
+        'py_gauss': np.array([] if py_gauss is None else [py_gauss], dtype=np.float64),
+    }
+
+
+def _set_rng_arrays(cached):
+    has_gauss, cached_gaussian = cached['np_gauss']
+    np.random.set_state(('MT19937', cached['np_keys'], int(cached['np_pos']), int(has_gauss), float(cached_gaussian)))
+    py_state = [int(v) for v in cached['py_state']]
+    py_gauss = float(cached['py_gauss'][0]) if len(cached['py_gauss']) else None
+    random.setstate((py_state[0], tuple(py_state[1:]), py_gauss))
+
+
+def labels_digest(y_train):
+    return zlib.crc32(np.ascontiguousarray(y_train).tobytes()) & 0xffffffff
+
+
+def cache_path(cache_dir, key):
+    return os.path.join(cache_dir, '_'.join(str(part) for part in key).replace('/', '-') + '.npz')
+
+
+def cached_split(cache_dir, key, y_train, split):
+    """
+    Return split() through an .npz cache in cache_dir. key identifies the partition, normally
+    (dataset, partition, n_parties, beta, C_size, seed). Besides the indices the file holds the
+    numpy and python RNG states after the split, which are restored on a hit so that everything
+    drawn after the partition is the same as in an uncached run. A file made for different labels
+    is recomputed. An empty cache_dir disables the cache.
+    """
+    if not cache_dir:
+        return split()
+    path = cache_path(cache_dir, key)
+    digest = labels_digest(y_train)
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            if int(cached['labels_digest']) == digest:
+                _set_rng_arrays(cached)
+                offsets = cached['offsets']
+                indices = cached['indices']
+                logger.info('Loaded partition from %s' % path)
+                return {j: indices[offsets[j]:offsets[j + 1]] for j in range(len(offsets) - 1)}
+
+    net_dataidx_map = split()
+    parts = [np.asarray(net_dataidx_map[j], dtype=np.int64) for j in range(len(net_dataidx_map))]
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, indices=np.concatenate(parts), offsets=np.cumsum([0] + [len(p) for p in parts]),
+                     labels_digest=np.array(digest), **_rng_arrays())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return net_dataidx_map
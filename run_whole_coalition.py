@@ -2,6 +2,12 @@ import subprocess
 import time
 import argparse
 
+import torch
+import torch.multiprocessing as mp
+
+import datasets
+import scaffold_train
+
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -11,10 +17,63 @@ def get_args():
     parser.add_argument('--partition', type=str, default='noniid-labeldir', help='the data partitioning strategy')
     parser.add_argument('--coalitions', nargs='+', type=str, default=['ABC', 'AB', 'BC', 'AC', 'A', 'B', 'C'])
     parser.add_argument('--python_ver', type=str, default=None, help='If 3, append 3 to python')
+    parser.add_argument('--driver', type=str, default='process', choices=['process', 'pool', 'subprocess'],
+                        help='train the coalitions in this process, in a worker pool sharing one partition, or one scaffold_train.py subprocess each')
+    parser.add_argument('--workers', type=int, default=2, help='number of pool processes for --driver pool')
+    parser.add_argument('--shared_memory', type=int, default=0, help='with --driver pool, keep the datasets in shared memory that the pool processes attach to')
     args = parser.parse_args()
     return args
 
 
+def coalition_argvs(args_dict):
+    """
+    scaffold_train.py argument lists for the grid in args_dict, one per coalition and setting.
+    """
+    argvs = [[]]
+    for arg, values in args_dict.items():
+        argvs = [argv + [arg, str(value)] for value in values for argv in argvs]
+    return argvs
+
+
+def init_coalition_worker(num_threads, shared_bases=None):
+    torch.set_num_threads(num_threads)
+    if shared_bases:
+        datasets.attach_shared_bases(shared_bases)
+
+
+def train_coalition_job(job):
+    argv, net_dataidx_map, rng_states = job
+    coalition_args = scaffold_train.setup_coalition(scaffold_train.get_args(argv))
+    scaffold_train.logger.info("#" * 100)
+    scaffold_train.logger.info("Using the shared data partition")
+    scaffold_train.train_coalition(coalition_args, net_dataidx_map, rng_states)
+    return coalition_args.abc
+
+
+def run_coalitions(argvs, driver='process', workers=2, shared_memory=False):
+    """
+    Partition the data once and train every coalition on it, in this process or on a spawn pool.
+    Each coalition starts from the RNG states right after partitioning, like its own scaffold_train.py run.
+    """
+    datasets.SHARED_MEMORY_ENABLED = bool(shared_memory and driver == 'pool')
+    jobs = []
+    partitions = {}
+    for argv in argvs:
+        # coalitions that only differ in --abc share one partition
+        key = tuple((argv[i], argv[i + 1]) for i in range(0, len(argv), 2) if argv[i] != '--abc')
+        if key not in partitions:
+            partitions[key] = scaffold_train.partition_coalition_data(scaffold_train.get_args(argv))
+        net_dataidx_map, rng_states = partitions[key]
+        jobs.append((argv, net_dataidx_map, rng_states))
+
+    if driver == 'pool':
+        num_threads = max(1, torch.get_num_threads() // workers)
+        with mp.get_context('spawn').Pool(workers, initializer=init_coalition_worker,
+                                          initargs=(num_threads, datasets.shared_base_handles())) as pool:
+            return pool.map(train_coalition_job, jobs, chunksize=1)
+    return [train_coalition_job(job) for job in jobs]
+
+
 if __name__ == '__main__':
     runtime_settings = get_args()
 
@@ -38,21 +97,24 @@ if __name__ == '__main__':
         '--abc': runtime_settings.coalitions,
     }
 
-        
-    cmd_base = 'python scaffold_train.py'
-    if runtime_settings.python_ver == '3':
-        cmd_base = 'python3 scaffold_train.py'
-    cmds = ['']
-    for arg, values in args_dict.items():
-        new_cmds = []
-        for value in values:
-            for cmd in cmds:
-                new_cmds.append(cmd + f' {arg} {value}')
-        cmds = new_cmds
-    #[print(cmd, '\n') for cmd in cmds]
-
-    # Run the commands
-    for cmd in cmds:
-        full_cmd = f'{cmd_base}{cmd}'
-        subprocess.call(full_cmd, shell=True)
-        time.sleep(1)
+    if runtime_settings.driver != 'subprocess':
+        run_coalitions(coalition_argvs(args_dict), runtime_settings.driver, runtime_settings.workers,
+                       runtime_settings.shared_memory)
+    else:
+        cmd_base = 'python scaffold_train.py'
+        if runtime_settings.python_ver == '3':
+            cmd_base = 'python3 scaffold_train.py'
+        cmds = ['']
+        for arg, values in args_dict.items():
+            new_cmds = []
+            for value in values:
+                for cmd in cmds:
+                    new_cmds.append(cmd + f' {arg} {value}')
+            cmds = new_cmds
+        #[print(cmd, '\n') for cmd in cmds]
+
+        # Run the commands
+        for cmd in cmds:
+            full_cmd = f'{cmd_base}{cmd}'
+            subprocess.call(full_cmd, shell=True)
+            time.sleep(1)
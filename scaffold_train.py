@@ -24,10 +24,14 @@ from model import *
 from utils import *
 from vggmodel import *
 from resnetcifar import *
+from artifacts import save_artifact
+from checkpoint import Checkpointer, GradState, get_rng_states, set_rng_states
+from partition import cached_split, custom_quantity_split, dirichlet_label_split
+from aggregation import StateLayout, ScaffoldCorrection, accumulate, fedavg_aggregate, scaffold_update_c
 
 MAX_EPOCHS_BEFORE_STOPPING = 10
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--model', type=str, default='MLP', help='neural network used in training')
     parser.add_argument('--dataset', type=str, default='mnist', help='dataset used for training')
@@ -62,7 +66,11 @@ def get_args():
     parser.add_argument('--sample', type=float, default=1, help='Sample ratio for each communication round')
     parser.add_argument('--abc', type=str, default=None, help='Input as ABC, AB, AC, BC, A, B, or C')
     parser.add_argument('--C_size', type=int, default=8000, help='Data points that C has')
-    args = parser.parse_args()
+    parser.add_argument('--checkpoint_every', type=int, default=0, help='checkpoint every k communication rounds, or k epochs for a single client (0: never)')
+    parser.add_argument('--checkpoint_dir', type=str, default='./checkpoints/', help='Checkpoint directory path')
+    parser.add_argument('--resume', type=int, default=0, help='resume from the last checkpoint of the same run if there is one')
+    parser.add_argument('--partition_cache', type=str, default='./partitions/', help='directory caching the data partitions as .npz files (empty: no cache)')
+    args = parser.parse_args(argv)
     return args
 
 
@@ -135,6 +143,7 @@ def train_net_scaffold(net_id, net, global_model, c_local, c_global, train_datal
 
     c_global_para = c_global.state_dict()
     c_local_para = c_local.state_dict()
+    correction = ScaffoldCorrection(net, c_global, c_local, args.lr)
 
     for epoch in range(epochs):
         epoch_loss_collector = []
@@ -154,10 +163,7 @@ def train_net_scaffold(net_id, net, global_model, c_local, c_global, train_datal
                 loss.backward()
                 optimizer.step()
 
-                net_para = net.state_dict()
-                for key in net_para:
-                    net_para[key] = net_para[key] - args.lr * (c_global_para[key] - c_local_para[key])
-                net.load_state_dict(net_para)
+                correction.step()
 
                 cnt += 1
                 epoch_loss_collector.append(loss.item())
@@ -190,11 +196,13 @@ def train_net_scaffold(net_id, net, global_model, c_local, c_global, train_datal
 def train_net(net_id, net, train_dataloader, test_dataloader, epochs, lr, args_optimizer, device="cpu"):
     logger.info('Training network %s' % str(net_id))
 
+    # test_dataloader=None leaves the test accuracy to the caller (see local_train_net)
     train_acc = compute_accuracy(net, train_dataloader, device=device)
-    test_acc, conf_matrix = compute_accuracy(net, test_dataloader, get_confusion_matrix=True, device=device)
-
     logger.info('>> Pre-Training Training accuracy: {}'.format(train_acc))
-    logger.info('>> Pre-Training Test accuracy: {}'.format(test_acc))
+    test_acc = None
+    if test_dataloader is not None:
+        test_acc, conf_matrix = compute_accuracy(net, test_dataloader, get_confusion_matrix=True, device=device)
+        logger.info('>> Pre-Training Test accuracy: {}'.format(test_acc))
 
     if args_optimizer == 'adam':
         optimizer = optim.Adam(filter(lambda p: p.requires_grad, net.parameters()), lr=lr, weight_decay=args.reg)
@@ -252,10 +260,10 @@ def train_net(net_id, net, train_dataloader, test_dataloader, epochs, lr, args_o
         #     logger.info('>> Test accuracy: %f' % test_acc)
 
     train_acc = compute_accuracy(net, train_dataloader, device=device)
-    test_acc, conf_matrix = compute_accuracy(net, test_dataloader, get_confusion_matrix=True, device=device)
-
     logger.info('>> Training accuracy: %f' % train_acc)
-    logger.info('>> Test accuracy: %f' % test_acc)
+    if test_dataloader is not None:
+        test_acc, conf_matrix = compute_accuracy(net, test_dataloader, get_confusion_matrix=True, device=device)
+        logger.info('>> Test accuracy: %f' % test_acc)
 
 
     logger.info(' ** Training complete **')
@@ -266,6 +274,14 @@ def local_train_net(nets, selected, args, net_dataidx_map, test_dl = None, devic
     avg_acc = 0.0
     loss_total = 0
 
+    # the clients share test_dl, so their test accuracies are computed in one pass before and after training
+    selected_ids = [net_id for net_id in nets if net_id in selected]
+    for net_id in selected_ids:
+        nets[net_id].to(device)
+    pre_test_accs = compute_accuracy_multi([nets[net_id] for net_id in selected_ids], test_dl, device=device)
+    for net_id, testacc in zip(selected_ids, pre_test_accs):
+        logger.info('>> net %d Pre-Training Test accuracy: %f' % (net_id, testacc))
+
     for net_id, net in nets.items():
         if net_id not in selected:
             continue
@@ -284,17 +300,19 @@ def local_train_net(nets, selected, args, net_dataidx_map, test_dl = None, devic
         else:
             noise_level = args.noise / (args.n_parties - 1) * net_id
             train_dl_local, test_dl_local, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level)
-        train_dl_global, test_dl_global, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32)
         n_epoch = args.epochs
 
-        trainacc, testacc, local_net_loss = train_net(net_id, net, train_dl_local, test_dl, n_epoch, args.lr, args.optimizer, device=device)
+        trainacc, _, local_net_loss = train_net(net_id, net, train_dl_local, None, n_epoch, args.lr, args.optimizer, device=device)
         loss_total += local_net_loss
-        logger.info("net %d final test acc %f" % (net_id, testacc))
-        avg_acc += testacc
         # saving the trained models here
         # save_model(net, net_id, args)
         # else:
         #     load_model(net, net_id, device=device)
+
+    test_accs = compute_accuracy_multi([nets[net_id] for net_id in selected_ids], test_dl, device=device)
+    for net_id, testacc in zip(selected_ids, test_accs):
+        logger.info("net %d final test acc %f" % (net_id, testacc))
+        avg_acc += testacc
     avg_acc /= len(selected)
     if args.alg == 'local_training':
         logger.info("avg test acc %f" % avg_acc)
@@ -307,9 +325,8 @@ def local_train_net_scaffold(nets, selected, global_model, c_nets, c_global, arg
     avg_acc = 0.0
     loss_total = 0.0
 
-    total_delta = copy.deepcopy(global_model.state_dict())
-    for key in total_delta:
-        total_delta[key] = 0.0
+    layout = StateLayout(c_global.state_dict())
+    total_delta = None
     c_global.to(device)
     global_model.to(device)
     for net_id, net in nets.items():
@@ -332,48 +349,32 @@ def local_train_net_scaffold(nets, selected, global_model, c_nets, c_global, arg
         else:
             noise_level = args.noise / (args.n_parties - 1) * net_id
             train_dl_local, test_dl_local, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level)
-        train_dl_global, test_dl_global, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32)
         n_epoch = args.epochs
 
 
         trainacc, testacc, c_delta_para, local_loss = train_net_scaffold(net_id, net, global_model, c_nets[net_id], c_global, train_dl_local, test_dl, n_epoch, args.lr, args.optimizer, device=device)
         loss_total += local_loss
         c_nets[net_id].to('cpu')
-        for key in total_delta:
-            total_delta[key] += c_delta_para[key]
+        total_delta = accumulate(layout, total_delta, c_delta_para)
 
         print("net %d final test acc %f" % (net_id, testacc))
         logger.info("net %d final test acc %f" % (net_id, testacc))
         avg_acc += testacc
-    for key in total_delta:
-        total_delta[key] /= args.n_parties
-    c_global_para = c_global.state_dict()
-    for key in c_global_para:
-        if c_global_para[key].type() == 'torch.LongTensor':
-            c_global_para[key] += total_delta[key].type(torch.LongTensor)
-        elif c_global_para[key].type() == 'torch.cuda.LongTensor':
-            c_global_para[key] += total_delta[key].type(torch.cuda.LongTensor)
-        else:
-            #logger.info(c_global_para[key].type())
-            c_global_para[key] += total_delta[key]
-    c_global.load_state_dict(c_global_para)
+    scaffold_update_c(layout, c_global.state_dict(), total_delta, args.n_parties)
 
     avg_acc /= len(selected)
 
     nets_list = list(nets.values())
     return nets_list, loss_total
 
-def partition_data(dataset, datadir, logdir, partition, n_parties, clients_split=[3000, 3000, 3000], beta=0.4):
+def partition_data(dataset, datadir, logdir, partition, n_parties, clients_split=[3000, 3000, 3000], beta=0.4, seed=None, cache_dir=None):
     if dataset == 'cifar10':
         X_train, y_train, X_test, y_test = load_cifar10_data(datadir)
     n_train = y_train.shape[0]
     if partition == "noniid-labeldir":
         clients_split = [3000] * args.n_parties
-        min_size = 0
-        min_require_size = 10
         K = 10
         N = y_train.shape[0]
-        net_dataidx_map = {}
         n_subsamples = sum(clients_split)
         samples_per_label = n_subsamples // K
 
@@ -389,56 +390,23 @@ def partition_data(dataset, datadir, logdir, partition, n_parties, clients_split
         X_train = np.concatenate(X_train_subsampled, axis=0)
         y_train = np.concatenate(y_train_subsampled, axis=0)
 
-        while min_size < min_require_size:
-            idx_batch = [[] for _ in range(n_parties)]
-            for k in range(K):
-                idx_k = np.where(y_train == k)[0]
-                print(f'count of k: {k} is {np.count_nonzero(y_train == k)}')
-                np.random.shuffle(idx_k)
-                proportions = np.random.dirichlet(np.repeat(beta, n_parties))
-                # Balance
-                proportions = np.array([p * (len(idx_j) < N / n_parties) for p, idx_j in zip(proportions, idx_batch)])
-                proportions = proportions / proportions.sum()
-                proportions = (np.cumsum(proportions) * len(idx_k)).astype(int)[:-1]
-                idx_batch = [idx_j + idx.tolist() for idx_j, idx in zip(idx_batch, np.split(idx_k, proportions))]
-                min_size = min([len(idx_j) for idx_j in idx_batch])
-
-        for j in range(n_parties):
-            np.random.shuffle(idx_batch[j])
-            net_dataidx_map[j] = idx_batch[j]
-            print(f'party {j} in map len {len(net_dataidx_map[j])}')
-            # print('net', net_dataidx_map.values())
+        split = lambda: dirichlet_label_split(y_train, n_parties, beta, K, balance_n=N)
 
     elif partition == "custom-quantity":
         if args.n_parties == 3:
             clients_split = [1000, 3000, args.C_size]
         if args.n_parties == 10:
             clients_split = [2000] * 10
-        min_size = 0
-        K = 10
-        N = y_train.shape[0]
-        net_dataidx_map = {}
+        split = lambda: custom_quantity_split(y_train, clients_split[:n_parties])
 
-        idxs = np.random.permutation(n_train)
-        start_idx = 0
-        for k in range(K):
-            idx_k = np.where(y_train == k)[0]
-            np.random.shuffle(idx_k)
-            subsample = [x//10 for x in clients_split]
-            start_idx = 0
-            for i in range(n_parties):
-                if i not in net_dataidx_map:
-                    net_dataidx_map[i] = idx_k[start_idx:start_idx+subsample[i]]
-                else:
-                    net_dataidx_map[i] = np.append(net_dataidx_map[i], idx_k[start_idx:start_idx+subsample[i]])
-                start_idx += subsample[i]
-        for i in range(n_parties):
-            print('party i:', i, 'length:', len(net_dataidx_map[i]))
+    net_dataidx_map = cached_split(cache_dir, (dataset, partition, n_parties, beta, args.C_size, seed), y_train, split)
+    for i in range(n_parties):
+        logger.info('party %d length: %d' % (i, len(net_dataidx_map[i])))
     traindata_cls_counts = record_net_data_stats(y_train, net_dataidx_map, logdir)
     return (X_train, y_train, X_test, y_test, net_dataidx_map, traindata_cls_counts, )
 
 
-def train_single(net_id, net, train_dataloader, test_dataloader, arg_optimizer, arg_lr, device="cpu"):
+def train_single(net_id, net, train_dataloader, test_dataloader, arg_optimizer, arg_lr, device="cpu", checkpointer=None):
     if arg_optimizer == 'adam':
         optimizer = optim.Adam(filter(lambda p: p.requires_grad, net.parameters()), lr=arg_lr, weight_decay=args.reg)
     elif arg_optimizer == 'amsgrad':
@@ -456,7 +424,15 @@ def train_single(net_id, net, train_dataloader, test_dataloader, arg_optimizer,
     losses = []
     valid_accuracies = []
 
-    for epoch in range(args.epochs):
+    # gradients are never zeroed here, so they are part of the training state
+    singles = {'net': net, 'optimizer': optimizer, 'grads': GradState(net)}
+    start_epoch = 0
+    if checkpointer is not None and args.resume and checkpointer.exists():
+        start_epoch, state = checkpointer.restore(singles)
+        epochs_list, losses, valid_accuracies = state['history']
+        logger.info('Resuming from %s at epoch %d' % (checkpointer.directory, start_epoch))
+
+    for epoch in range(start_epoch, args.epochs):
         epoch_loss_collector = []
         epochs_list += [epoch]
         for batch_idx, (x, target) in enumerate(train_dataloader):
@@ -478,24 +454,30 @@ def train_single(net_id, net, train_dataloader, test_dataloader, arg_optimizer,
         valid_accuracies += [test_acc]
         losses += [epoch_loss]
         logger.info('Epoch: %d Loss: %f Best Valid seen: %f Valid: %f' % (epoch, epoch_loss, max(valid_accuracies), test_acc))
+        if checkpointer is not None and checkpointer.should_save(epoch, args.epochs):
+            checkpointer.save(epoch, singles, state={'history': (epochs_list, losses, valid_accuracies)})
     return max(valid_accuracies), net_id, net
 
 
-if __name__ == '__main__':
-    args = get_args()
+def setup_coalition(args):
+    """
+    Normalise the coalition name and point the root logger at the coalition's own log file.
+    """
+    global logger
     beta_string = str(args.beta).replace('.', '')
+    if args.abc is None:
+        raise ValueError('No setup specified: choose ABC, AB, AC, BC, A, B, C')
     args.abc = args.abc.upper()
     if len(args.abc) == 1:
         args.epochs = 200
     mkdirs(args.logdir)
     mkdirs(args.modeldir)
     mkdirs('./pickle')
+    mkdirs('./artifacts')
     args.logdir = args.logdir.replace("'", "")
-    device = torch.device(args.device)
     for handler in logging.root.handlers[:]:
         logging.root.removeHandler(handler)
-    if args.abc is None:
-        raise ValueError('No setup specified: choose ABC, AB, AC, BC, A, B, C')
+        handler.close()
     if args.log_file_name is None:
         args.log_file_name = f'{args.abc.upper()}-{args.partition}-{args.C_size}-{beta_string}-{datetime.datetime.now().strftime("%Y-%m-%d-%H_%M-%S")}' 
     log_path=f'{args.log_file_name}.log'
@@ -508,18 +490,35 @@ if __name__ == '__main__':
         filemode='w')
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
-    logger.info(device)
+    logger.info(torch.device(args.device))
     logger.info(f'args: {str(args)}')
+    return args
+
+
+def get_checkpointer(args):
+    run_key = f'{args.alg}-{args.abc}-{args.dataset}-{args.model}-{args.partition}-{args.C_size}-{args.beta}-{args.init_seed}'
+    return Checkpointer(os.path.join(args.checkpoint_dir, run_key), args.checkpoint_every, run_key)
+
+
+def partition_coalition_data(partition_args):
+    """
+    Seed and partition the parties' data. The partition does not depend on the coalition, so it is
+    computed once and shared by all coalitions together with the RNG states right after it, which
+    are the states a separate scaffold_train.py run for the coalition would continue from.
+    """
+    global args
+    args = partition_args
     seed = args.init_seed
-    logger.info("#" * 100)
     np.random.seed(seed)
     torch.manual_seed(seed)
     random.seed(seed)
-    logger.info("Partitioning data")
     X_train, y_train, X_test, y_test, net_dataidx_map, traindata_cls_counts = partition_data(
-        args.dataset, args.datadir, args.logdir, args.partition, args.n_parties, beta=args.beta)
-    n_classes = len(np.unique(y_train))
+        args.dataset, args.datadir, args.logdir, args.partition, args.n_parties, beta=args.beta,
+        seed=seed, cache_dir=args.partition_cache)
+    return net_dataidx_map, get_rng_states()
 
+
+def get_global_dataloaders(args, net_dataidx_map):
     train_dl_global, test_dl_global, train_ds_global, test_ds_global = get_dataloader(args.dataset,
                                                                                         args.datadir,
                                                                                         args.batch_size,
@@ -542,17 +541,32 @@ if __name__ == '__main__':
                 noise_level = 0
 
             if args.noise_type == 'space':
-                train_dl_local, test_dl_local, train_ds_local, test_ds_local = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level, party_id, args.n_parties-1)
+                train_dl_local, test_dl_local, train_ds_local, test_ds_local = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level, party_id, args.n_parties-1, batch_augment=False)
             else:
                 noise_level = args.noise / (args.n_parties - 1) * party_id
-                train_dl_local, test_dl_local, train_ds_local, test_ds_local = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level)
+                train_dl_local, test_dl_local, train_ds_local, test_ds_local = get_dataloader(args.dataset, args.datadir, args.batch_size, 32, dataidxs, noise_level, batch_augment=False)
             train_all_in_list.append(train_ds_local)
             test_all_in_list.append(test_ds_local)
         train_all_in_ds = data.ConcatDataset(train_all_in_list)
         train_dl_global = data.DataLoader(dataset=train_all_in_ds, batch_size=args.batch_size, shuffle=True)
         test_all_in_ds = data.ConcatDataset(test_all_in_list)
         test_dl_global = data.DataLoader(dataset=test_all_in_ds, batch_size=32, shuffle=False)
+    return train_dl_global, test_dl_global
+
+
+def train_coalition(coalition_args, net_dataidx_map, rng_states):
+    """
+    Train one coalition (args.abc, set up with setup_coalition) on a precomputed partition,
+    starting from the RNG states partition_coalition_data left behind. Writes the coalition's
+    pickles.
+    """
+    global args
+    args = coalition_args
+    beta_string = str(args.beta).replace('.', '')
+    device = torch.device(args.device)
+    set_rng_states(rng_states)
 
+    train_dl_global, test_dl_global = get_global_dataloaders(args, net_dataidx_map)
 
     best_valid_acc = 0.0
     learning_rates = [0.001]
@@ -574,9 +588,16 @@ if __name__ == '__main__':
             nets, local_model_meta_data, layer_type = init_nets(args.net_config, args.dropout_p, args.n_parties, args)
             global_models, global_model_meta_data, global_layer_type = init_nets(args.net_config, 0, 1, args)
             global_model = global_models[0]
+            layout = StateLayout(global_model.state_dict())
 
             global_para = global_model.state_dict()
-            for round in range(args.comm_round):
+            checkpointer = get_checkpointer(args)
+            start_round = 0
+            if args.resume and checkpointer.exists() and len(args.abc) > 1:
+                start_round, state = checkpointer.restore({'global_model': global_model}, {'nets': nets})
+                communication_round, valid_accuracy, training_loss = state['history']
+                logger.info('Resuming from %s at round %d' % (checkpointer.directory, start_round))
+            for round in range(start_round, args.comm_round):
                 communication_round += [round]
 
                 logger.info("in comm round:" + str(round))
@@ -613,7 +634,7 @@ if __name__ == '__main__':
                         noise_level = args.noise / (args.n_parties - 1) * net_id
                         train_dl_local, test_dl_local, _, _ = get_dataloader(args.dataset, args.datadir, batch_size, 32, dataidxs, noise_level)
                     train_dl_global, test_dl_global, _, _ = get_dataloader(args.dataset, args.datadir, batch_size, 32)
-                    best_valid_from_run, net_id, net = train_single(net_id, nets[net_id], train_dl_local, test_dl_global, optimizer, lr, device="cpu")
+                    best_valid_from_run, net_id, net = train_single(net_id, nets[net_id], train_dl_local, test_dl_global, optimizer, lr, device="cpu", checkpointer=checkpointer)
                     print(f'Done training, best score: {best_valid_from_run} found with params {current_params}')
                     if best_valid_from_run > best_valid_acc:
                         print(f'New best score: {best_valid_from_run} found with params {current_params}')
@@ -648,14 +669,7 @@ if __name__ == '__main__':
                 total_data_points = sum([len(net_dataidx_map[r]) for r in selected])
                 fed_avg_freqs = [len(net_dataidx_map[r]) / total_data_points for r in selected]
 
-                for idx in range(len(selected)):
-                    net_para = nets[selected[idx]].cpu().state_dict()
-                    if idx == 0:
-                        for key in net_para:
-                            global_para[key] = net_para[key] * fed_avg_freqs[idx]
-                    else:
-                        for key in net_para:
-                            global_para[key] += net_para[key] * fed_avg_freqs[idx]
+                global_para = fedavg_aggregate(layout, (nets[r].cpu().state_dict() for r in selected), fed_avg_freqs)
                 global_model.load_state_dict(global_para)
 
                 logger.info('global n_training: %d' % len(train_dl_global))
@@ -673,6 +687,10 @@ if __name__ == '__main__':
                 logger.info('best valid so far' + str(max(valid_accuracy)) + ' -- comm_round' + ' '.join(map(str, communication_round)) + ': valid : ' + ' '.join(map(str, valid_accuracy)) + ': loss : ' + ' '.join(map(str, training_loss)))
                 print(' -- comm_round' + ' '.join(map(str, communication_round)) + ': valid : ' + ' '.join(map(str, valid_accuracy)))
                 print('best valid so far' + str(max(valid_accuracy)) + ' -- comm_round' + ' '.join(map(str, communication_round)) + ': valid : ' + ' '.join(map(str, valid_accuracy)) + ': loss : ' + ' '.join(map(str, training_loss)))
+                checkpointer.mark_dirty('nets', selected)
+                if checkpointer.should_save(round, args.comm_round):
+                    checkpointer.save(round, {'global_model': global_model}, {'nets': nets},
+                                      {'history': (communication_round, valid_accuracy, training_loss)})
             if len(args.abc) == 1:
                 continue
             if max(valid_accuracy) > best_valid_acc:
@@ -690,10 +708,21 @@ if __name__ == '__main__':
                     train_dl_global, test_dl_global, _, _ = get_dataloader(args.dataset, args.datadir, args.batch_size, 32)
                     if net_id in selected:
                         int_to_str = {0: 'a', 1: 'b', 2: 'c', 3: 'd', 4: 'e', 5: 'f', 6: 'g', 7: 'h', 8: 'i', 9: 'j'}
-                        print('creating pickle with net_id:', net_id)
-                        print(f'{args.partition}_{args.alg}_{args.abc.lower()}_{int_to_str[net_id]}_{args.C_size}_{beta_string}.pickle')
-                        with open(f'./pickle/{args.partition}_{args.alg}_{args.abc.lower()}_{int_to_str[net_id]}_{args.C_size}_{beta_string}.pickle', 'wb') as handle:
-                            pickle.dump((net_id, net, global_model, train_dl_local, test_dl_global, current_params, lr, optimizer, batch_size), handle, protocol=pickle.HIGHEST_PROTOCOL)
+                        print('creating artifact with net_id:', net_id)
+                        print(f'{args.partition}_{args.alg}_{args.abc.lower()}_{int_to_str[net_id]}_{args.C_size}_{beta_string}')
+                        save_artifact(f'./artifacts/{args.partition}_{args.alg}_{args.abc.lower()}_{int_to_str[net_id]}_{args.C_size}_{beta_string}',
+                                      net_id, net, global_model, args, dataidxs, noise_level,
+                                      params={'current_params': current_params, 'lr': lr, 'optimizer': optimizer, 'batch_size': batch_size},
+                                      metrics={'communication_round': communication_round, 'valid_accuracy': valid_accuracy,
+                                               'training_loss': training_loss, 'best_valid_acc': best_valid_acc})
                     
                 # with open(f'TrainingInfo{args.partition}_{args.alg}_{args.abc}_{int_to_str[net_id]}_{args.C_size}_{beta_string}.pickle', 'wb') as handle:
                     # pickle.dump((communication_round, valid_accuracy, training_loss), handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+if __name__ == '__main__':
+    args = setup_coalition(get_args())
+    logger.info("#" * 100)
+    logger.info("Partitioning data")
+    net_dataidx_map, rng_states = partition_coalition_data(args)
+    train_coalition(args, net_dataidx_map, rng_states)
@@ -0,0 +1,136 @@
+import torch
+import torch.nn.functional as F
+
+from model import FcNet, PerceptronModel, SimpleCNN, SimpleCNNMNIST
+
+try:
+    from torch.func import functional_call, grad, vmap
+except ImportError:
+    functional_call = grad = vmap = None
+
+
+STACKED_MODELS = (FcNet, PerceptronModel, SimpleCNN, SimpleCNNMNIST)
+# vmap turns a per-client conv2d into a grouped convolution, which is slower than separate
+# convolutions on CPU, so the conv models are only stacked on accelerators
+CONV_MODELS = (SimpleCNN, SimpleCNNMNIST)
+
+
+def supports_stacked(net, args_optimizer, device="cpu"):
+    """
+    Stacked training covers the small buffer-free models trained with plain (momentum) SGD.
+    """
+    if vmap is None or type(net) not in STACKED_MODELS or args_optimizer != 'sgd' or list(net.buffers()):
+        return False
+    return torch.device(device).type != 'cpu' or type(net) not in CONV_MODELS
+
+
+class StackedClients(object):
+    """
+    Local SGD of several clients at once. The clients' parameters are stacked along a leading
+    client dimension and every step runs the forward/backward pass of all clients with a single
+    vmap(grad(functional_call(...))), replacing one Python-level training loop per client.
+
+    Clients see their own batches in their own order. Batches are padded to the same size and
+    clients that have run out of batches are masked, so a client's update, momentum buffer and
+    loss are the ones torch.optim.SGD would give it on its own.
+    """
+    def __init__(self, nets, lr, momentum=0, weight_decay=0, device="cpu"):
+        self.nets = nets
+        self.base = nets[0]
+        self.lr = lr
+        self.momentum = momentum
+        self.weight_decay = weight_decay
+        self.device = device
+        self.names = [name for name, _ in self.base.named_parameters()]
+        self.params = {name: torch.stack([dict(net.named_parameters())[name].detach() for net in nets]).to(device)
+                       for name in self.names}
+        self.momentum_buffers = {name: torch.zeros_like(param) for name, param in self.params.items()}
+
+        def client_loss(params, x, target, mask):
+            out = functional_call(self.base, params, (x,))
+            losses = F.cross_entropy(out, target, reduction='none')
+            loss = (losses * mask).sum() / mask.sum().clamp(min=1)
+            return loss, loss.detach()
+
+        self.grad_and_loss = vmap(grad(client_loss, has_aux=True), randomness='different')
+
+    def step(self, x, target, mask, active):
+        """
+        One SGD step for every client. x/target/mask have a leading client dimension and a padded
+        batch dimension; active marks the clients that have a batch this step. Returns the clients'
+        batch losses.
+        """
+        grads, losses = self.grad_and_loss(self.params, x, target, mask)
+        with torch.no_grad():
+            for name in self.names:
+                param = self.params[name]
+                active_ = active.view((-1,) + (1,) * (param.dim() - 1))
+                d_p = grads[name]
+                if self.weight_decay != 0:
+                    d_p = d_p + self.weight_decay * param
+                if self.momentum != 0:
+                    buf = self.momentum_buffers[name]
+                    buf.copy_(torch.where(active_, self.momentum * buf + d_p, buf))
+                    d_p = buf
+                param.copy_(torch.where(active_, param - self.lr * d_p, param))
+        return losses
+
+    def train(self, dataloaders, epochs, rng_states=None):
+        """
+        Run `epochs` local epochs over each client's dataloader. Returns per client the list of
+        batch losses of every epoch. With rng_states (a torch RNG state per client) each client's
+        batches are drawn from its own stream, so shuffling and augmentation match training the
+        client on its own.
+        """
+        n_clients = len(self.nets)
+        rng_states = rng_states or [None] * n_clients
+        iterators = [self._batches(dataloader, epochs, rng_state) for dataloader, rng_state in zip(dataloaders, rng_states)]
+        epoch_losses = [[[] for _ in range(epochs)] for _ in range(n_clients)]
+        while True:
+            batches = [next(iterator, None) for iterator in iterators]
+            if all(batch is None for batch in batches):
+                break
+            batch_size = max(len(batch[2]) for batch in batches if batch is not None)
+            template = next(batch for batch in batches if batch is not None)
+            x = torch.zeros((n_clients, batch_size) + tuple(template[1].shape[1:]), dtype=template[1].dtype)
+            target = torch.zeros((n_clients, batch_size), dtype=torch.long)
+            mask = torch.zeros((n_clients, batch_size))
+            for i, batch in enumerate(batches):
+                if batch is None:
+                    continue
+                _, batch_x, batch_target = batch
+                x[i, :len(batch_target)] = batch_x
+                target[i, :len(batch_target)] = batch_target.long()
+                mask[i, :len(batch_target)] = 1
+            active = torch.tensor([batch is not None for batch in batches], device=self.device)
+            losses = self.step(x.to(self.device), target.to(self.device), mask.to(self.device), active).tolist()
+            for i, batch in enumerate(batches):
+                if batch is not None:
+                    epoch_losses[i][batch[0]].append(losses[i])
+        return epoch_losses
+
+    def _batches(self, dataloader, epochs, rng_state=None):
+        if rng_state is None:
+            for epoch in range(epochs):
+                for x, target in dataloader:
+                    yield epoch, x, target
+            return
+        outer_state = torch.get_rng_state()
+        torch.set_rng_state(rng_state)
+        for epoch in range(epochs):
+            for x, target in dataloader:
+                rng_state = torch.get_rng_state()
+                torch.set_rng_state(outer_state)
+                yield epoch, x, target
+                outer_state = torch.get_rng_state()
+                torch.set_rng_state(rng_state)
+        torch.set_rng_state(outer_state)
+
+    def write_back(self):
+        """
+        Copy the trained parameters back into the client nets.
+        """
+        with torch.no_grad():
+            for i, net in enumerate(self.nets):
+                for name, param in net.named_parameters():
+                    param.copy_(self.params[name][i])
@@ -7,14 +7,14 @@ import torch.utils.data as data
 from torch.autograd import Variable
 import torch.nn.functional as F
 import random
-from sklearn.metrics import confusion_matrix
 from torch.utils.data import DataLoader
 import copy
-from collections import Counter
+from functools import partial
 
 from model import *
-from datasets import MNIST_truncated, CIFAR10_truncated, CIFAR100_truncated, ImageFolder_custom, SVHN_custom, FashionMNIST_truncated, CustomTensorDataset, CelebA_custom, FEMNIST, Generated, genData
+from datasets import MNIST_truncated, CIFAR10_truncated, CIFAR100_truncated, ImageFolder_custom, SVHN_custom, FashionMNIST_truncated, CustomTensorDataset, CelebA_custom, FEMNIST, Generated, SparseGenerated, genData, save_generated, sparse_collate
 from math import sqrt
+from partition import cached_split, split_indices
 
 import torch.nn as nn
 
@@ -32,6 +32,9 @@ logging.basicConfig()
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# datasets kept as scipy CSR matrices and fed to the models as torch sparse batches
+SPARSE_DATASETS = ('rcv1',)
+
 def mkdirs(dirpath):
     try:
         os.makedirs(dirpath)
@@ -177,9 +180,14 @@ def record_net_data_stats(y_train, net_dataidx_map, logdir):
 
     return net_cls_counts
 
-def partition_data(dataset, datadir, logdir, partition, n_parties, beta=0.4):
+def partition_data(dataset, datadir, logdir, partition, n_parties, beta=0.4, seed=None, cache_dir=None):
+    """
+    Load the dataset and split its training set between the parties (see partition.split_indices).
+    With cache_dir and the seed the RNGs were seeded with, the split is cached as an .npz file.
+    """
     #np.random.seed(2020)
     #torch.manual_seed(2020)
+    u_train = None
 
     if dataset == 'mnist':
         X_train, y_train, X_test, y_test = load_mnist_data(datadir)
@@ -231,11 +239,7 @@ def partition_data(dataset, datadir, logdir, partition, n_parties, beta=0.4):
         idxs = np.linspace(0,3999,4000,dtype=np.int64)
         batch_idxs = np.array_split(idxs, n_parties)
         net_dataidx_map = {i: batch_idxs[i] for i in range(n_parties)}
-        mkdirs("data/generated/")
-        np.save("data/generated/X_train.npy",X_train)
-        np.save("data/generated/X_test.npy",X_test)
-        np.save("data/generated/y_train.npy",y_train)
-        np.save("data/generated/y_test.npy",y_test)
+        save_generated(datadir, dataset, X_train, y_train, X_test, y_test)
     
     #elif dataset == 'covtype':
     #    cov_type = sk.fetch_covtype('./data')
@@ -251,7 +255,20 @@ def partition_data(dataset, datadir, logdir, partition, n_parties, beta=0.4):
     #    np.save("data/generated/y_train.npy",y_train)
     #    np.save("data/generated/y_test.npy",y_test)
 
-    elif dataset in ('rcv1', 'SUSY', 'covtype'):
+    elif dataset in SPARSE_DATASETS:
+        X_train, y_train = load_svmlight_file(datadir+dataset, dtype=np.float32)
+        num_train = int(X_train.shape[0] * 0.75)
+        y_train = (y_train+1)/2
+        idxs = np.random.permutation(X_train.shape[0])
+
+        X_test = X_train[idxs[num_train:]]
+        y_test = np.array(y_train[idxs[num_train:]], dtype=np.int32)
+        X_train = X_train[idxs[:num_train]]
+        y_train = np.array(y_train[idxs[:num_train]], dtype=np.int32)
+
+        save_generated(datadir, dataset, X_train, y_train, X_test, y_test)
+
+    elif dataset in ('SUSY', 'covtype'):
         X_train, y_train = load_svmlight_file(datadir+dataset)
         X_train = X_train.todense()
         num_train = int(X_train.shape[0] * 0.75)
@@ -266,11 +283,7 @@ def partition_data(dataset, datadir, logdir, partition, n_parties, beta=0.4):
         X_train = np.array(X_train[idxs[:num_train]], dtype=np.float32)
         y_train = np.array(y_train[idxs[:num_train]], dtype=np.int32)
 
-        mkdirs("data/generated/")
-        np.save("data/generated/X_train.npy",X_train)
-        np.save("data/generated/X_test.npy",X_test)
-        np.save("data/generated/y_train.npy",y_train)
-        np.save("data/generated/y_test.npy",y_test)
+        save_generated(datadir, dataset, X_train, y_train, X_test, y_test)
 
     elif dataset in ('a9a'):
         X_train, y_train = load_svmlight_file(datadir+"a9a")
@@ -286,264 +299,12 @@ def partition_data(dataset, datadir, logdir, partition, n_parties, beta=0.4):
         y_train = np.array(y_train, dtype=np.int32)
         y_test = np.array(y_test, dtype=np.int32)
 
-        mkdirs("data/generated/")
-        np.save("data/generated/X_train.npy",X_train)
-        np.save("data/generated/X_test.npy",X_test)
-        np.save("data/generated/y_train.npy",y_train)
-        np.save("data/generated/y_test.npy",y_test)
+        save_generated(datadir, dataset, X_train, y_train, X_test, y_test)
 
 
-    n_train = y_train.shape[0]
-
-    if partition == "homo":
-        idxs = np.random.permutation(n_train)
-        batch_idxs = np.array_split(idxs, n_parties)
-        net_dataidx_map = {i: batch_idxs[i] for i in range(n_parties)}
-
+    net_dataidx_map = cached_split(cache_dir, (dataset, partition, n_parties, beta, None, seed), y_train,
+                                   lambda: split_indices(dataset, partition, y_train, n_parties, beta, u_train))
 
-    elif partition == "noniid-labeldir":
-        min_size = 0
-        min_require_size = 10
-        K = 10
-        if dataset in ('celeba', 'covtype', 'a9a', 'rcv1', 'SUSY'):
-            K = 2
-            # min_require_size = 100
-        if dataset == 'cifar100':
-            K = 100
-        elif dataset == 'tinyimagenet':
-            K = 200
-
-        N = y_train.shape[0]
-        #np.random.seed(2020)
-        net_dataidx_map = {}
-
-        while min_size < min_require_size:
-            idx_batch = [[] for _ in range(n_parties)]
-            for k in range(K):
-                idx_k = np.where(y_train == k)[0]
-                np.random.shuffle(idx_k)
-                proportions = np.random.dirichlet(np.repeat(beta, n_parties))
-                print("proportions1: ", proportions)
-                print("sum pro1:", np.sum(proportions))
-                ## Balance
-                proportions = np.array([p * (len(idx_j) < N / n_parties) for p, idx_j in zip(proportions, idx_batch)])
-                print("proportions2: ", proportions)
-                proportions = proportions / proportions.sum()
-                print("proportions3: ", proportions)
-                proportions = (np.cumsum(proportions) * len(idx_k)).astype(int)[:-1]
-                print("proportions4: ", proportions)
-                idx_batch = [idx_j + idx.tolist() for idx_j, idx in zip(idx_batch, np.split(idx_k, proportions))]
-                min_size = min([len(idx_j) for idx_j in idx_batch])
-                # print('min_size', min_size)
-                # if K == 2 and n_parties <= 10:
-                #     if np.min(proportions) < 200:
-                #         min_size = 0
-                #         break
-
-
-        for j in range(n_parties):
-            np.random.shuffle(idx_batch[j])
-            net_dataidx_map[j] = idx_batch[j]
-            print('net', net_dataidx_map.values())
-
-    elif partition > "noniid-#label0" and partition <= "noniid-#label9":
-        num = eval(partition[13:])
-        if dataset in ('celeba', 'covtype', 'a9a', 'rcv1', 'SUSY'):
-            num = 1
-            K = 2
-        else:
-            K = 10
-        if dataset == "cifar100":
-            K = 100
-        elif dataset == "tinyimagenet":
-            K = 200
-        if num == 10:
-            net_dataidx_map ={i:np.ndarray(0,dtype=np.int64) for i in range(n_parties)}
-            for i in range(10):
-                idx_k = np.where(y_train==i)[0]
-                np.random.shuffle(idx_k)
-                split = np.array_split(idx_k,n_parties)
-                for j in range(n_parties):
-                    net_dataidx_map[j]=np.append(net_dataidx_map[j],split[j])
-        else:
-            times=[0 for i in range(K)]
-            contain=[]
-            for i in range(n_parties):
-                current=[i%K]
-                times[i%K]+=1
-                j=1
-                while (j<num):
-                    ind=random.randint(0,K-1)
-                    if (ind not in current):
-                        j=j+1
-                        current.append(ind)
-                        times[ind]+=1
-                contain.append(current)
-            net_dataidx_map ={i:np.ndarray(0,dtype=np.int64) for i in range(n_parties)}
-            for i in range(K):
-                idx_k = np.where(y_train==i)[0]
-                np.random.shuffle(idx_k)
-                split = np.array_split(idx_k,times[i])
-                ids=0
-                for j in range(n_parties):
-                    if i in contain[j]:
-                        net_dataidx_map[j]=np.append(net_dataidx_map[j],split[ids])
-                        ids+=1
-
-    elif partition == "iid-diff-quantity":
-        idxs = np.random.permutation(n_train)
-        min_size = 0
-        while min_size < 10:
-            proportions = np.random.dirichlet(np.repeat(beta, n_parties))
-            proportions = proportions/proportions.sum()
-            min_size = np.min(proportions*len(idxs))
-        proportions = (np.cumsum(proportions)*len(idxs)).astype(int)[:-1]
-        batch_idxs = np.split(idxs,proportions)
-        net_dataidx_map = {i: batch_idxs[i] for i in range(n_parties)}
-        
-    elif partition == "mixed":
-        min_size = 0
-        min_require_size = 10
-        K = 10
-        if dataset in ('celeba', 'covtype', 'a9a', 'rcv1', 'SUSY'):
-            K = 2
-            # min_require_size = 100
-
-        N = y_train.shape[0]
-        net_dataidx_map = {}
-
-        times=[1 for i in range(10)]
-        contain=[]
-        for i in range(n_parties):
-            current=[i%K]
-            j=1
-            while (j<2):
-                ind=random.randint(0,K-1)
-                if (ind not in current and times[ind]<2):
-                    j=j+1
-                    current.append(ind)
-                    times[ind]+=1
-            contain.append(current)
-        net_dataidx_map ={i:np.ndarray(0,dtype=np.int64) for i in range(n_parties)}
-        
-
-        min_size = 0
-        while min_size < 10:
-            proportions = np.random.dirichlet(np.repeat(beta, n_parties))
-            proportions = proportions/proportions.sum()
-            min_size = np.min(proportions*n_train)
-
-        for i in range(K):
-            idx_k = np.where(y_train==i)[0]
-            np.random.shuffle(idx_k)
-
-            proportions_k = np.random.dirichlet(np.repeat(beta, 2))
-            #proportions_k = np.ndarray(0,dtype=np.float64)
-            #for j in range(n_parties):
-            #    if i in contain[j]:
-            #        proportions_k=np.append(proportions_k ,proportions[j])
-
-            proportions_k = (np.cumsum(proportions_k)*len(idx_k)).astype(int)[:-1]
-
-            split = np.split(idx_k, proportions_k)
-            ids=0
-            for j in range(n_parties):
-                if i in contain[j]:
-                    net_dataidx_map[j]=np.append(net_dataidx_map[j],split[ids])
-                    ids+=1
-
-    elif partition == "real" and dataset == "femnist":
-        num_user = u_train.shape[0]
-        user = np.zeros(num_user+1,dtype=np.int32)
-        for i in range(1,num_user+1):
-            user[i] = user[i-1] + u_train[i-1]
-        no = np.random.permutation(num_user)
-        batch_idxs = np.array_split(no, n_parties)
-        net_dataidx_map = {i:np.zeros(0,dtype=np.int32) for i in range(n_parties)}
-        for i in range(n_parties):
-            for j in batch_idxs[i]:
-                net_dataidx_map[i]=np.append(net_dataidx_map[i], np.arange(user[j], user[j+1]))
-                
-    elif partition == "transfer-from-femnist":
-        stat = np.load("femnist-dis.npy")
-        n_total = stat.shape[0]
-        chosen = np.random.permutation(n_total)[:n_parties]
-        stat = stat[chosen,:]
-        
-        if dataset in ('celeba', 'covtype', 'a9a', 'rcv1', 'SUSY'):
-            K = 2
-        else:
-            K = 10
-        
-        N = y_train.shape[0]
-        #np.random.seed(2020)
-        net_dataidx_map = {}
-
-        idx_batch = [[] for _ in range(n_parties)]
-        for k in range(K):
-            idx_k = np.where(y_train == k)[0]
-            np.random.shuffle(idx_k)
-            proportions = stat[:,k]
-            # logger.info("proportions2: ", proportions)
-            proportions = proportions / proportions.sum()
-            # logger.info("proportions3: ", proportions)
-            proportions = (np.cumsum(proportions) * len(idx_k)).astype(int)[:-1]
-            # logger.info("proportions4: ", proportions)
-            idx_batch = [idx_j + idx.tolist() for idx_j, idx in zip(idx_batch, np.split(idx_k, proportions))]
-  
-
-        for j in range(n_parties):
-            np.random.shuffle(idx_batch[j])
-            net_dataidx_map[j] = idx_batch[j]
-
-    elif partition == "transfer-from-criteo":
-        stat0 = np.load("criteo-dis.npy")
-        
-        n_total = stat0.shape[0]
-        flag=True
-        while (flag):
-            chosen = np.random.permutation(n_total)[:n_parties]
-            stat = stat0[chosen,:]
-            check = [0 for i in range(10)]
-            for ele in stat:
-                for j in range(10):
-                    if ele[j]>0:
-                        check[j]=1
-            flag=False
-            for i in range(10):
-                if check[i]==0:
-                    flag=True
-                    break
-                    
-        
-        if dataset in ('celeba', 'covtype', 'a9a', 'rcv1', 'SUSY'):
-            K = 2
-            stat[:,0]=np.sum(stat[:,:5],axis=1)
-            stat[:,1]=np.sum(stat[:,5:],axis=1)
-        else:
-            K = 10
-        
-        N = y_train.shape[0]
-        #np.random.seed(2020)
-        net_dataidx_map = {}
-
-        idx_batch = [[] for _ in range(n_parties)]
-        for k in range(K):
-            idx_k = np.where(y_train == k)[0]
-            np.random.shuffle(idx_k)
-            proportions = stat[:,k]
-            # logger.info("proportions2: ", proportions)
-            proportions = proportions / proportions.sum()
-            # logger.info("proportions3: ", proportions)
-            proportions = (np.cumsum(proportions) * len(idx_k)).astype(int)[:-1]
-            # logger.info("proportions4: ", proportions)
-            idx_batch = [idx_j + idx.tolist() for idx_j, idx in zip(idx_batch, np.split(idx_k, proportions))]
-  
-
-        for j in range(n_parties):
-            np.random.shuffle(idx_batch[j])
-            net_dataidx_map[j] = idx_batch[j]
-            
     traindata_cls_counts = record_net_data_stats(y_train, net_dataidx_map, logdir)
     return (X_train, y_train, X_test, y_test, net_dataidx_map, traindata_cls_counts)
 
@@ -580,116 +341,166 @@ def put_trainable_parameters(net,X):
             params.data.copy_(X[offset:offset+numel].data.view_as(params.data))
         offset+=numel
 
-def compute_accuracy(model, dataloader, get_confusion_matrix=False, moon_model=False, device="cpu"):
-
-    was_training = False
-    if model.training:
+def evaluate_models(models, dataloader, moon_model=False, device="cpu"):
+    """
+    One pass over dataloader (or a list of dataloaders) shared by all models: every batch is
+    loaded and moved to device once and then run through each model. A KxK confusion matrix
+    is accumulated per model with bincount, K being the model's output dimension, rows are
+    true labels. Returns a list of (accuracy, confusion matrix, per-class accuracy) with nan
+    per-class accuracy for absent classes.
+    """
+    was_training = [model.training for model in models]
+    for model in models:
         model.eval()
-        was_training = True
-
-    true_labels_list, pred_labels_list = np.array([]), np.array([])
 
     if type(dataloader) == type([1]):
         pass
     else:
         dataloader = [dataloader]
 
-    correct, total = 0, 0
+    conf_matrices = [None] * len(models)
     with torch.no_grad():
         for tmp in dataloader:
             for batch_idx, (x, target) in enumerate(tmp):
                 x, target = x.to(device), target.to(device,dtype=torch.int64)
-                if moon_model:
-                    _, _, out = model(x)
-                else:
-                    out = model(x)
-                _, pred_label = torch.max(out.data, 1)
-
-                total += x.data.size()[0]
-                correct += (pred_label == target.data).sum().item()
-
-                if device == "cpu":
-                    pred_labels_list = np.append(pred_labels_list, pred_label.numpy())
-                    true_labels_list = np.append(true_labels_list, target.data.numpy())
-                else:
-                    pred_labels_list = np.append(pred_labels_list, pred_label.cpu().numpy())
-                    true_labels_list = np.append(true_labels_list, target.data.cpu().numpy())
-
+                for i, model in enumerate(models):
+                    if moon_model:
+                        _, _, out = model(x)
+                    else:
+                        out = model(x)
+                    n_classes = out.shape[1]
+                    _, pred_label = torch.max(out.data, 1)
+                    counts = torch.bincount(target * n_classes + pred_label, minlength=n_classes * n_classes)
+                    if conf_matrices[i] is None:
+                        conf_matrices[i] = counts.view(n_classes, n_classes)
+                    else:
+                        conf_matrices[i] += counts.view(n_classes, n_classes)
+
+    for model, training in zip(models, was_training):
+        if training:
+            model.train()
+
+    results = []
+    for conf_matrix in conf_matrices:
+        conf_matrix = conf_matrix.cpu().numpy()
+        correct = np.diag(conf_matrix)
+        total = conf_matrix.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            per_class_acc = correct / total
+        results.append((float(correct.sum()) / float(total.sum()), conf_matrix, per_class_acc))
+    return results
+
+
+def evaluate(model, dataloader, moon_model=False, device="cpu"):
+    return evaluate_models([model], dataloader, moon_model=moon_model, device=device)[0]
+
+
+def compute_accuracy_multi(models, dataloader, get_confusion_matrix=False, moon_model=False, device="cpu"):
+    """
+    compute_accuracy for several models in a single pass over dataloader.
+    """
+    results = evaluate_models(models, dataloader, moon_model=moon_model, device=device)
     if get_confusion_matrix:
-        conf_matrix = confusion_matrix(true_labels_list, pred_labels_list)
+        return [(acc, conf_matrix) for acc, conf_matrix, _ in results]
+    return [acc for acc, _, _ in results]
 
-    if was_training:
-        model.train()
 
+def compute_accuracy(model, dataloader, get_confusion_matrix=False, moon_model=False, device="cpu"):
+    acc, conf_matrix, _ = evaluate(model, dataloader, moon_model=moon_model, device=device)
     if get_confusion_matrix:
-        return correct/float(total), conf_matrix
+        return acc, conf_matrix
 
-    return correct/float(total)
+    return acc
 
 
 def compute_accuracy_weighted(model, dataloader, train_dataloader, get_confusion_matrix=False, moon_model=False, device="cpu"):
+    """
+    Per-class accuracy weighted by the label distribution of train_dataloader.
+    """
+    _, conf_matrix, _ = evaluate(model, dataloader, moon_model=moon_model, device=device)
+    n_classes = conf_matrix.shape[0]
 
-    was_training = False
-    if model.training:
-        model.eval()
-        was_training = True
-
-    true_labels_list, pred_labels_list = np.array([]), np.array([])
-
-    if type(dataloader) == type([1]):
-        pass
-    else:
-        dataloader = [dataloader]
-
-    label_counts = Counter()
-
+    label_array = np.zeros(n_classes)
     for batch_idx, (x, y) in enumerate(train_dataloader):
-        label_counts.update(y.tolist())
-
-    label_array = np.zeros(10)
-    for label, count in label_counts.items():
-        label_array[label] = count
+        label_array += np.bincount(np.asarray(y, dtype=np.int64), minlength=n_classes)[:n_classes]
     label_array /= np.sum(label_array)
 
-    correct, total = [0]*10, [0]*10
-    with torch.no_grad():
-        for tmp in dataloader:
-            for batch_idx, (x, target) in enumerate(tmp):
-                x, target = x.to(device), target.to(device,dtype=torch.int64)
-                if moon_model:
-                    _, _, out = model(x)
-                else:
-                    out = model(x)
-                _, pred_label = torch.max(out.data, 1)
-
-                for i, plabel in enumerate(pred_label):
-                    correct[target.data[i]] += (plabel == target.data[i]).sum().item()
-
-                for label in target.data:
-                    total[label] += 1
-
-                if device == "cpu":
-                    pred_labels_list = np.append(pred_labels_list, pred_label.numpy())
-                    true_labels_list = np.append(true_labels_list, target.data.numpy())
-                else:
-                    pred_labels_list = np.append(pred_labels_list, pred_label.cpu().numpy())
-                    true_labels_list = np.append(true_labels_list, target.data.cpu().numpy())
-    correct *= label_array
-    total *= label_array
+    correct = np.diag(conf_matrix) * label_array
+    total = conf_matrix.sum(axis=1) * label_array
 
     frac_correct = correct.sum().item() / total.sum().item()
-    if get_confusion_matrix:
-        conf_matrix = confusion_matrix(true_labels_list, pred_labels_list)
-
-    if was_training:
-        model.train()
-
     if get_confusion_matrix:
         return frac_correct, conf_matrix
 
     return frac_correct
 
 
+class EvalPolicy(object):
+    """
+    Decides which accuracy passes a run spends time on and records the ones it skips.
+
+    The global model is evaluated every `every` rounds and always in the last round, or only in
+    the last round with final_only; global train accuracy can be turned off on its own. Client
+    models are evaluated before and after local training (local='all'), only after ('post') or
+    never ('none'). Test passes can run on a fixed random subset of `subsample` test samples.
+    """
+    def __init__(self, every=1, final_only=False, local='all', global_train=True, subsample=0, seed=0):
+        self.every = max(1, every)
+        self.final_only = final_only
+        self.local_eval = local
+        self.global_train = global_train
+        self.subsample = subsample
+        self.seed = seed
+        self.round = None
+        self.n_rounds = None
+        self.skipped = {}
+        self._test_loaders = {}
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.eval_every, args.eval_final_only, args.local_eval, args.eval_global_train,
+                   args.eval_subsample, args.init_seed)
+
+    def start_round(self, round, n_rounds):
+        self.round = round
+        self.n_rounds = n_rounds
+
+    def global_round(self):
+        if self.round is None:
+            return True
+        last = self.round == self.n_rounds - 1
+        if self.final_only:
+            return last
+        return last or (self.round + 1) % self.every == 0
+
+    def local(self, stage):
+        return self.local_eval == 'all' or (self.local_eval == 'post' and stage == 'post')
+
+    def skip(self, metric, count=1):
+        self.skipped.setdefault(metric, []).extend([self.round] * count)
+
+    def skip_local(self, n_clients):
+        for stage in ('pre', 'post'):
+            if not self.local(stage):
+                self.skip('client %s-training accuracy' % stage, n_clients)
+
+    def test_loader(self, dataloader):
+        if not self.subsample or self.subsample >= len(dataloader.dataset):
+            return dataloader
+        key = id(dataloader.dataset)
+        if key not in self._test_loaders:
+            idxs = np.sort(np.random.RandomState(self.seed).choice(len(dataloader.dataset), self.subsample, replace=False))
+            self._test_loaders[key] = data.DataLoader(dataset=data.Subset(dataloader.dataset, idxs),
+                                                      batch_size=dataloader.batch_size, shuffle=False,
+                                                      collate_fn=dataloader.collate_fn)
+        return self._test_loaders[key]
+
+    def summary(self):
+        if not self.skipped:
+            return 'eval policy: no accuracy passes skipped'
+        return 'eval policy skipped: ' + ', '.join('%s x%d' % (metric, len(rounds)) for metric, rounds in self.skipped.items())
+
+
 def save_model(model, model_index, args):
     logger.info("saving local model-{}".format(model_index))
     with open(args.modeldir+"trained_local_model"+str(model_index), "wb") as f_:
@@ -704,6 +515,9 @@ def load_model(model, model_index, device="cpu"):
     return model
 
 class AddGaussianNoise(object):
+    # spatial noise masks shared by all transforms of the same client, keyed by (rows, cols, image shape)
+    _masks = {}
+
     def __init__(self, mean=0., std=1., net_id=None, total=0):
         self.std = std
         self.mean = mean
@@ -711,55 +525,117 @@ class AddGaussianNoise(object):
         self.num = int(sqrt(total))
         if self.num * self.num < total:
             self.num = self.num + 1
+        if self.net_id is not None:
+            # the client's size x size block of pixels
+            size = int(28 / self.num)
+            row = int(self.net_id / size)
+            col = self.net_id % size
+            self.rows = tuple(range(row*size, (row+1)*size))
+            self.cols = tuple(range(col*size, (col+1)*size))
+
+    def mask(self, shape):
+        key = (self.rows, self.cols, tuple(shape))
+        if key not in AddGaussianNoise._masks:
+            filt = torch.zeros(shape)
+            filt[:, torch.tensor(self.rows, dtype=torch.long)[:, None], torch.tensor(self.cols, dtype=torch.long)] = 1
+            AddGaussianNoise._masks[key] = filt
+        return AddGaussianNoise._masks[key]
 
     def __call__(self, tensor):
         if self.net_id is None:
             return tensor + torch.randn(tensor.size()) * self.std + self.mean
         else:
-            tmp = torch.randn(tensor.size())
-            filt = torch.zeros(tensor.size())
-            size = int(28 / self.num)
-            row = int(self.net_id / size)
-            col = self.net_id % size
-            for i in range(size):
-                for j in range(size):
-                    filt[:,row*size+i,col*size+j] = 1
-            tmp = tmp * filt
+            tmp = torch.randn(tensor.size()) * self.mask(tensor.size())
             return tensor + tmp * self.std + self.mean
 
+    def apply_batch(self, x):
+        """
+        Add the noise to a whole (N, C, H, W) batch at once.
+        """
+        noise = torch.randn(x.size())
+        if self.net_id is not None:
+            noise.mul_(self.mask(x.size()[1:]))
+        return x + noise * self.std + self.mean
+
     def __repr__(self):
         return self.__class__.__name__ + '(mean={0}, std={1})'.format(self.mean, self.std)
 
-def get_dataloader(dataset, datadir, train_bs, test_bs, dataidxs=None, noise_level=0, net_id=None, total=0):
-    if dataset in ('mnist', 'femnist', 'fmnist', 'cifar10', 'svhn', 'generated', 'covtype', 'a9a', 'rcv1', 'SUSY', 'cifar100', 'tinyimagenet'):
-        if dataset == 'mnist':
-            dl_obj = MNIST_truncated
-
-            transform_train = transforms.Compose([
-                transforms.ToTensor(),
-                AddGaussianNoise(0., noise_level, net_id, total)])
+class CIFARBatchAugment(object):
+    """
+    collate_fn applying the CIFAR-10 training augmentation to a whole batch of raw uint8 HWC images:
+    reflect-pad by `padding`, random `size` x `size` crop and random horizontal flip, done as one
+    gather on the uint8 images, then scaling to [0, 1] and the optional AddGaussianNoise.
+    """
+    def __init__(self, noise=None, padding=4, size=32):
+        self.noise = noise
+        self.padding = padding
+        self.size = size
+
+    def __call__(self, batch):
+        imgs = torch.from_numpy(np.stack([img for img, _ in batch]))
+        target = torch.as_tensor(np.array([target for _, target in batch]))
+        n, height, width = imgs.shape[:3]
+
+        # crop window in padded coordinates, mapped back onto the image by reflection
+        offset = torch.arange(self.size)
+        rows = torch.randint(0, height + 2 * self.padding - self.size + 1, (n, 1)) + offset - self.padding
+        cols = torch.randint(0, width + 2 * self.padding - self.size + 1, (n, 1)) + offset - self.padding
+        flip = torch.rand(n) < 0.5
+        cols[flip] = cols[flip].flip(1)
+        rows = torch.where(rows < 0, -rows, torch.where(rows >= height, 2 * (height - 1) - rows, rows))
+        cols = torch.where(cols < 0, -cols, torch.where(cols >= width, 2 * (width - 1) - cols, cols))
+        imgs = imgs[torch.arange(n)[:, None, None], rows[:, :, None], cols[:, None, :]]
+
+        x = imgs.permute(0, 3, 1, 2).contiguous().float().div_(255)
+        if self.noise is not None:
+            x = self.noise.apply_batch(x)
+        return x, target
+
+class TensorBatch(object):
+    """
+    collate_fn for the as_tensor MNIST/FMNIST/FEMNIST datasets: takes the (images, targets) batch
+    from __getitems__, or a list of items, and adds the optional AddGaussianNoise to the whole batch.
+    """
+    def __init__(self, noise=None):
+        self.noise = noise
 
-            transform_test = transforms.Compose([
-                transforms.ToTensor(),
-                AddGaussianNoise(0., noise_level, net_id, total)])
+    def __call__(self, batch):
+        if isinstance(batch, tuple):
+            x, target = batch
+        else:
+            x = torch.stack([img for img, _ in batch])
+            target = torch.as_tensor([int(target) for _, target in batch])
+        if self.noise is not None:
+            x = self.noise.apply_batch(x)
+        return x, target
 
-        elif dataset == 'femnist':
-            dl_obj = FEMNIST
-            transform_train = transforms.Compose([
-                transforms.ToTensor(),
-                AddGaussianNoise(0., noise_level, net_id, total)])
-            transform_test = transforms.Compose([
-                transforms.ToTensor(),
-                AddGaussianNoise(0., noise_level, net_id, total)])
 
-        elif dataset == 'fmnist':
-            dl_obj = FashionMNIST_truncated
-            transform_train = transforms.Compose([
-                transforms.ToTensor(),
-                AddGaussianNoise(0., noise_level, net_id, total)])
-            transform_test = transforms.Compose([
-                transforms.ToTensor(),
-                AddGaussianNoise(0., noise_level, net_id, total)])
+def get_dataloader(dataset, datadir, train_bs, test_bs, dataidxs=None, noise_level=0, net_id=None, total=0, batch_augment=True):
+    """
+    batch_augment: for CIFAR-10 the training set returns raw uint8 images and the DataLoader augments
+    whole batches with CIFARBatchAugment; MNIST, FMNIST and FEMNIST index their pre-converted float
+    split batch by batch and add the noise in TensorBatch. Pass False where the datasets themselves
+    must yield transformed tensors (e.g. when train_ds is wrapped into a ConcatDataset).
+    """
+    if dataset in ('mnist', 'femnist', 'fmnist', 'cifar10', 'svhn', 'generated', 'covtype', 'a9a', 'rcv1', 'SUSY', 'cifar100', 'tinyimagenet'):
+        collate_fn = None
+        test_collate_fn = None
+        if dataset in ('mnist', 'femnist', 'fmnist'):
+            dl_obj = {'mnist': MNIST_truncated, 'femnist': FEMNIST, 'fmnist': FashionMNIST_truncated}[dataset]
+
+            if batch_augment:
+                dl_obj = partial(dl_obj, as_tensor=True)
+                transform_train = None
+                transform_test = None
+                collate_fn = TensorBatch(AddGaussianNoise(0., noise_level, net_id, total) if noise_level > 0 else None)
+                test_collate_fn = collate_fn
+            else:
+                transform_train = transforms.Compose([
+                    transforms.ToTensor(),
+                    AddGaussianNoise(0., noise_level, net_id, total)])
+                transform_test = transforms.Compose([
+                    transforms.ToTensor(),
+                    AddGaussianNoise(0., noise_level, net_id, total)])
 
         elif dataset == 'svhn':
             dl_obj = SVHN_custom
@@ -774,17 +650,21 @@ def get_dataloader(dataset, datadir, train_bs, test_bs, dataidxs=None, noise_lev
         elif dataset == 'cifar10':
             dl_obj = CIFAR10_truncated
 
-            transform_train = transforms.Compose([
-                transforms.ToTensor(),
-                transforms.Lambda(lambda x: F.pad(
-                    Variable(x.unsqueeze(0), requires_grad=False),
-                    (4, 4, 4, 4), mode='reflect').data.squeeze()),
-                transforms.ToPILImage(),
-                transforms.RandomCrop(32),
-                transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
-                AddGaussianNoise(0., noise_level, net_id, total)
-            ])
+            if batch_augment:
+                transform_train = None
+                collate_fn = CIFARBatchAugment(AddGaussianNoise(0., noise_level, net_id, total) if noise_level > 0 else None)
+            else:
+                transform_train = transforms.Compose([
+                    transforms.ToTensor(),
+                    transforms.Lambda(lambda x: F.pad(
+                        Variable(x.unsqueeze(0), requires_grad=False),
+                        (4, 4, 4, 4), mode='reflect').data.squeeze()),
+                    transforms.ToPILImage(),
+                    transforms.RandomCrop(32),
+                    transforms.RandomHorizontalFlip(),
+                    transforms.ToTensor(),
+                    AddGaussianNoise(0., noise_level, net_id, total)
+                ])
             # data prep for test set
             transform_test = transforms.Compose([
                 transforms.ToTensor(),
@@ -826,8 +706,15 @@ def get_dataloader(dataset, datadir, train_bs, test_bs, dataidxs=None, noise_lev
                 transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
             ])
 
+        elif dataset in SPARSE_DATASETS:
+            dl_obj = partial(SparseGenerated, dataset=dataset)
+            transform_train = None
+            transform_test = None
+            collate_fn = sparse_collate
+            test_collate_fn = sparse_collate
+
         else:
-            dl_obj = Generated
+            dl_obj = partial(Generated, dataset=dataset)
             transform_train = None
             transform_test = None
 
@@ -839,8 +726,8 @@ def get_dataloader(dataset, datadir, train_bs, test_bs, dataidxs=None, noise_lev
             train_ds = dl_obj(datadir, dataidxs=dataidxs, train=True, transform=transform_train, download=True)
             test_ds = dl_obj(datadir, train=False, transform=transform_test, download=True)
 
-        train_dl = data.DataLoader(dataset=train_ds, batch_size=train_bs, shuffle=True, drop_last=False)
-        test_dl = data.DataLoader(dataset=test_ds, batch_size=test_bs, shuffle=False, drop_last=False)
+        train_dl = data.DataLoader(dataset=train_ds, batch_size=train_bs, shuffle=True, drop_last=False, collate_fn=collate_fn)
+        test_dl = data.DataLoader(dataset=test_ds, batch_size=test_bs, shuffle=False, drop_last=False, collate_fn=test_collate_fn)
 
     return train_dl, test_dl, train_ds, test_ds
 